@@ -1,6 +1,17 @@
 import boto3
+import datetime
+import hashlib
+import json
 import os
+import threading
 from botocore.exceptions import ClientError, NoCredentialsError
+from .Inventory import Inventory
+from .LogPipeline import LogSampler, log_context
+from .RdsGate import RdsGate
+from .S3Snapshot import S3Snapshot
+from .ShardedLister import ShardedLister
+from .StackHistory import StackHistory
+from .WorkQueue import WorkQueue
 
 class AWS:
 
@@ -9,16 +20,22 @@ class AWS:
         self.set_logger(logger)
         self._set_account_id()
         self._set_region()
-        self.get_notification_variables()
         self.boto3_client_map = dict()
-        pass
+        self.boto3_client_lock = threading.Lock()
+        self.get_notification_variables()
+        self.rds_gate = None
+        self.log_sample_rate = int(os.getenv('ASS_LOG_SAMPLE_RATE', '1000'))
+        self.s3_workers = int(os.getenv('ASS_S3_WORKERS', '16'))
+        self.s3_list_workers = int(os.getenv('ASS_S3_LIST_WORKERS', '16'))
+        self.inventory = Inventory(self.logger, self, os.getenv('ASS_INVENTORY_FILE'),
+                                   int(os.getenv('ASS_INVENTORY_MAX_AGE', '0')))
 
     def get_notification_variables(self):
         # Get ASS_AWS_NOTIFICATION_MODE variable from SSM Parameter store.
         self.set_list_ssmparameters(['ASS_AWS_NOTIFICATION_MODE'])
         # Get variables depending on the ASS_AWS_NOTIFICATION_MODE variable from SSM Parameter store.
         if os.environ['NOTIFICATION_MODE'].upper() == "NONE":
-            self.logger.info(f'NOTIFICATION_MODE variable available. Mode:{os.environ["NOTIFICATION_MODE"]}')
+            self.logger.info('NOTIFICATION_MODE variable available. Mode:%s', os.environ['NOTIFICATION_MODE'])
         elif os.environ['NOTIFICATION_MODE'].upper() == "JIRA":
             self.logger.info('Getting Jira variables from Parameter store')
             self.set_list_ssmparameters(['ASS_AWS_JIRA_USER', 'ASS_AWS_JIRA_API_PASSWORD', 'ASS_AWS_JIRA_URL', 'ASS_AWS_JIRA_PROJECT'])
@@ -26,16 +43,16 @@ class AWS:
         elif os.environ['NOTIFICATION_MODE'].upper() == "GOOGLECHAT":
             self.logger.info('Getting Google Chat variable from Parameter store')
             self.set_list_ssmparameters(['ASS_AWS_CHATURL'])
-            self.logger.info(f'Google chat variable available.')
+            self.logger.info('Google chat variable available.')
         else:
             warning = "NOTIFICATION_MODE is unknown!!!"
             self.logger.warning(warning)
             raise Exception(warning)
 
-        self.logger.info(f"Parameters set from SSM Parameter store")
+        self.logger.info("Parameters set from SSM Parameter store")
 
     def set_list_ssmparameters(self, paramter_list: list):
-        ssm_client = boto3.client('ssm', region_name=self.get_region())
+        ssm_client = self.get_boto3_client('ssm')
         try:
             response = ssm_client.get_parameters(
                 Names=paramter_list, WithDecryption=True)
@@ -45,7 +62,7 @@ class AWS:
                 value = parameters['Value']
                 os.environ[str(key[8:])] = str(value)
         except Exception as e:
-            self.logger.error(f"Error occurred while getting the objects from the SSM ParameterStore")
+            self.logger.error("Error occurred while getting the objects from the SSM ParameterStore")
             raise
 
 
@@ -55,44 +72,181 @@ class AWS:
         else:
             raise Exception("Not a valid logger object")
 
+    def get_inventory(self):
+        return self.inventory
+
+    def begin_run(self, inventory_max_age):
+        """
+        Prepare a long-running process for the next run. The clients, the account and the notification settings
+        are kept, the inventory is refreshed incrementally (see Inventory.begin_run).
+        """
+        with self.boto3_client_lock:
+            self.rds_gate = None
+        self.inventory.begin_run(inventory_max_age)
+
+    def get_rds_gate(self):
+        rds_client = self.get_boto3_client('rds')
+        with self.boto3_client_lock:
+            if self.rds_gate is None:
+                self.rds_gate = RdsGate(self.logger, rds_client,
+                                        timeout=int(os.getenv('ASS_RDS_GATE_TIMEOUT', '3600')))
+        return self.rds_gate
+
+    def get_stack_history(self, state_bucket_name):
+        return StackHistory(self.logger, self.get_boto3_client('cloudformation'), self.get_boto3_client('s3'),
+                            state_bucket_name, os.getenv('ASS_STACK_HISTORY_FILE'))
+
+    def get_s3_snapshot(self, state_bucket_name):
+        return S3Snapshot(self.logger, self.get_boto3_client('s3'), self.get_lister(), state_bucket_name,
+                          workers=self.s3_workers)
+
+    def get_lister(self):
+        return ShardedLister(self.logger, self.get_boto3_client('s3'), list_workers=self.s3_list_workers)
+
+    def delete_all_objects(self, bucket_name):
+        """
+        Delete all objects, object versions and delete markers of bucket_name. The keys are listed with a sharded
+        listing and deleted with one DeleteObjects request per 1000 keys, s3_workers requests at a time.
+        """
+        s3_client = self.get_boto3_client('s3')
+
+        def delete(versions):
+            response = s3_client.delete_objects(Bucket=bucket_name, Delete={
+                'Objects': [{'Key': version['Key'], 'VersionId': version['VersionId']} for version in versions],
+                'Quiet': True
+            })
+            for error in response.get('Errors', []):
+                self.logger.error("Deleting %s from %s failed: %s", error['Key'], bucket_name, error['Message'])
+            self.logger.debug("Deleted a batch of %s objects from %s", len(versions), bucket_name)
+
+        ShardedLister.for_each_batch(self.get_lister().list(bucket_name, versions=True), delete, self.s3_workers)
+
     def empty_bucket(self, bucket):
-        s3client = boto3.client('s3', region_name= self.get_region())
         bucket_name = bucket['Name']
-        versioning_status = s3client.get_bucket_versioning(Bucket=bucket_name)
+        if not self.inventory.claim_bucket_emptying(bucket_name):
+            return
         try:
-            self.logger.info(f"Connect to bucket {bucket_name}")
-            s3 = boto3.resource('s3')
-            bucket = s3.Bucket(bucket_name)
-            self.logger.info(f"Start deletion of all objects in bucket {bucket_name}")
-            bucket.objects.all().delete()
-            bucket.object_versions.delete()
-            self.logger.info(f"Finished deletion of all objects in bucket {bucket_name}")
-        except AttributeError:
-            self.logger.info(f"{bucket_name} is empty")
+            self.logger.info("Connect to bucket %s", bucket_name)
+            self.logger.info("Start deletion of all objects in bucket %s", bucket_name)
+            self.delete_all_objects(bucket_name)
+            self.logger.info("Finished deletion of all objects in bucket %s", bucket_name)
         except ClientError as e:
             if e.response['Error']['Code'] == 'NoSuchBucket':
-                self.logger.warning(f"Bucket ({bucket_name}) does not exist error when deleting objects, continuing")
+                self.logger.warning("Bucket (%s) does not exist error when deleting objects, continuing", bucket_name)
         except Exception:
-            self.logger.error(f"Error occurred while deleting all objects in {bucket_name}")
+            self.logger.error("Error occurred while deleting all objects in %s", bucket_name)
             raise
 
+    def estimate_object_count(self, bucket_name, sample_pages=10):
+        """
+        Estimate the number of objects in a bucket. The daily NumberOfObjects CloudWatch metric is used when
+        available, otherwise the bucket is listed for at most sample_pages pages of 1000 keys. A listing that is
+        cut off or fails (e.g. AccessDenied) returns the number of keys seen so far, which is a lower bound.
+        """
+        try:
+            now = datetime.datetime.utcnow()
+            response = self.get_boto3_client('cloudwatch').get_metric_statistics(
+                Namespace='AWS/S3',
+                MetricName='NumberOfObjects',
+                Dimensions=[{'Name': 'BucketName', 'Value': bucket_name},
+                            {'Name': 'StorageType', 'Value': 'AllStorageTypes'}],
+                StartTime=now - datetime.timedelta(days=3),
+                EndTime=now,
+                Period=86400,
+                Statistics=['Average']
+            )
+            if len(response['Datapoints']) > 0:
+                latest = max(response['Datapoints'], key=lambda d: d['Timestamp'])
+                self.logger.debug("CloudWatch object count for %s is %s", bucket_name, int(latest['Average']))
+                return int(latest['Average'])
+        except ClientError as e:
+            self.logger.debug("Unable to get CloudWatch object count for %s: %s", bucket_name, e)
+
+        count = 0
+        paginator = self.get_boto3_client('s3').get_paginator('list_object_versions')
+        try:
+            for page in paginator.paginate(Bucket=bucket_name, PaginationConfig={'MaxItems': sample_pages * 1000}):
+                count += len(page.get('Versions', [])) + len(page.get('DeleteMarkers', []))
+        except ClientError as e:
+            self.logger.warning("Unable to sample the object count of %s, using the %s objects listed so far: %s",
+                                bucket_name, count, e)
+        self.logger.debug("Sampled object count for %s is %s", bucket_name, count)
+        return count
+
+    def get_lifecycle_state_key(self, bucket_name):
+        return f"s3-lifecycle/{bucket_name}.json"
+
+    def expire_bucket_with_lifecycle(self, bucket_name, state_bucket_name):
+        """
+        Empty a bucket asynchronously by replacing its lifecycle configuration with rules that expire all current
+        and noncurrent versions and delete markers. The previous configuration is saved in the state bucket so
+        restore_bucket_lifecycle can put it back on start.
+        """
+        s3_client = self.get_boto3_client('s3')
+        state_key = self.get_lifecycle_state_key(bucket_name)
+        try:
+            s3_client.head_object(Bucket=state_bucket_name, Key=state_key)
+            self.logger.info("Previous lifecycle configuration of %s already saved, not overwriting it", bucket_name)
+        except ClientError:
+            try:
+                previous_rules = s3_client.get_bucket_lifecycle_configuration(Bucket=bucket_name)['Rules']
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'NoSuchLifecycleConfiguration':
+                    raise
+                previous_rules = None
+            s3_client.put_object(Bucket=state_bucket_name, Key=state_key,
+                                 Body=json.dumps({'Rules': previous_rules}, default=str))
+            self.logger.info("Lifecycle configuration of %s saved to s3://%s/%s",
+                             bucket_name, state_bucket_name, state_key)
+
+        s3_client.put_bucket_lifecycle_configuration(
+            Bucket=bucket_name,
+            LifecycleConfiguration={'Rules': [
+                {
+                    'ID': 'ass-expire-all-objects',
+                    'Filter': {'Prefix': ''},
+                    'Status': 'Enabled',
+                    'Expiration': {'Days': 1},
+                    'NoncurrentVersionExpiration': {'NoncurrentDays': 1},
+                    'AbortIncompleteMultipartUpload': {'DaysAfterInitiation': 1}
+                },
+                {
+                    'ID': 'ass-expire-delete-markers',
+                    'Filter': {'Prefix': ''},
+                    'Status': 'Enabled',
+                    'Expiration': {'ExpiredObjectDeleteMarker': True}
+                }
+            ]}
+        )
+        self.logger.info("Expiration lifecycle rules applied to bucket %s", bucket_name)
+
+    def restore_bucket_lifecycle(self, bucket_name, state_bucket_name):
+        s3_client = self.get_boto3_client('s3')
+        state_key = self.get_lifecycle_state_key(bucket_name)
+        saved = json.loads(s3_client.get_object(Bucket=state_bucket_name, Key=state_key)['Body'].read())
+        if saved['Rules'] is None:
+            s3_client.delete_bucket_lifecycle(Bucket=bucket_name)
+            self.logger.info("Expiration lifecycle rules removed from bucket %s", bucket_name)
+        else:
+            s3_client.put_bucket_lifecycle_configuration(Bucket=bucket_name,
+                                                         LifecycleConfiguration={'Rules': saved['Rules']})
+            self.logger.info("Previous lifecycle configuration of bucket %s restored", bucket_name)
+        s3_client.delete_object(Bucket=state_bucket_name, Key=state_key)
+
     def is_aws_authenticated(self):
         return self.aws_authenticated
 
     def s3_has_tag(self, bucket_name, tag_name, tag_value):
-        self.logger.debug(f"Checking bucket {bucket_name} for tag {tag_name} with value {tag_value}")
-        s3_client = boto3.client('s3')
-        try:
-            response = s3_client.get_bucket_tagging(Bucket=bucket_name)
-            self.logger.debug(response)
-            for tag in response['TagSet']:
-                self.logger.debug(tag)
-                if tag['Key'] == tag_name and tag['Value'] == tag_value:
-                    self.logger.debug(f"Bucket {bucket_name} has tag {tag_name} with value {tag_value}")
-                    return True
-        except ClientError:
-            self.logger.debug(f"No TagSet found or bucket nog found for bucket {bucket_name}")
+        self.logger.debug("Checking bucket %s for tag %s with value %s", bucket_name, tag_name, tag_value)
+        tag_set = self.inventory.get_bucket_tags(bucket_name)
+        if len(tag_set) == 0:
+            self.logger.debug("No TagSet found or bucket nog found for bucket %s", bucket_name)
             return False
+        for tag in tag_set:
+            if tag['Key'] == tag_name and tag['Value'] == tag_value:
+                self.logger.debug("Bucket %s has tag %s with value %s", bucket_name, tag_name, tag_value)
+                return True
+        return False
 
     def resource_has_tag(self, client, resource_arn, tag_name, tag_value=None):
         """
@@ -109,32 +263,32 @@ class AWS:
             True or False if tag_value is passed
             The value of the tag or False if tag_value is not passed or None
         """
-        self.logger.debug(f"Checking resource {resource_arn} for tag {tag_name} with value {tag_value}")
+        self.logger.debug("Checking resource %s for tag %s with value %s", resource_arn, tag_name, tag_value)
         try:
             response = ""
             # Checking for type of client
             if "RDS" in str(client.__class__):
-                self.logger.debug(f"RDS Client detected")
+                self.logger.debug("RDS Client detected")
                 response = client.list_tags_for_resource(ResourceName=resource_arn)['TagList']
             elif "CloudFront" in str(client.__class__):
-                self.logger.debug(f"Cloudfront Client detected")
+                self.logger.debug("Cloudfront Client detected")
                 response = client.list_tags_for_resource(Resource=resource_arn)['Tags']['Items']
             else:
-                self.logger.debug(f"Unknown client detected!")
+                self.logger.debug("Unknown client detected!")
 
-            self.logger.debug(response)
             for tag in response:
                 if tag['Key'] == tag_name:
                     if tag_value is not None:
                         if tag['Value'] == tag_value:
-                            self.logger.debug(f"Resource {resource_arn} has tag {tag_name} with value {tag['Value']}")
+                            self.logger.debug("Resource %s has tag %s with value %s",
+                                              resource_arn, tag_name, tag['Value'])
                             return True
                         else:
-                            self.logger.debug(f"Resource {resource_arn} has tag {tag_name} but value {tag['Value']} "
-                                              f"does not match {tag_value}")
+                            self.logger.debug("Resource %s has tag %s but value %s does not match %s",
+                                              resource_arn, tag_name, tag['Value'], tag_value)
                             return False
                     else:
-                        self.logger.debug(f"Resource {resource_arn} has tag {tag_name} with value {tag['Value']}")
+                        self.logger.debug("Resource %s has tag %s with value %s", resource_arn, tag_name, tag['Value'])
                         return tag['Value']
         except Exception:
             return False
@@ -142,21 +296,16 @@ class AWS:
         return False
 
     def cfn_stack_exists(self, stack_name):
-        try:
-            response = self.get_boto3_client('cloudformation').describe_stacks(StackName=stack_name)
-            if len(response) > 0:
-                if response.get('Stacks')[0].get('StackStatus') in ['CREATE_COMPLETE', 'UPDATE_COMPLETE']:
-                    return True
-        except Exception:
-            return False
-
-        return False
+        stack = self.inventory.get_stack(stack_name)
+        return stack is not None and stack.get('StackStatus') in ['CREATE_COMPLETE', 'UPDATE_COMPLETE']
 
     def get_boto3_client(self, resource_type, region_name=None):
-        if resource_type not in self.boto3_client_map:
-            if region_name is None:
-                region_name = self.get_region()
-            self.boto3_client_map[resource_type] = boto3.client(resource_type, region_name=region_name)
+        # Phases run in parallel threads and creating clients from the default session is not thread safe
+        with self.boto3_client_lock:
+            if resource_type not in self.boto3_client_map:
+                if region_name is None:
+                    region_name = self.get_region()
+                self.boto3_client_map[resource_type] = boto3.client(resource_type, region_name=region_name)
 
         return self.boto3_client_map[resource_type]
 
@@ -180,17 +329,40 @@ class AWS:
         except NoCredentialsError:
             self.account_id = ""
 
+    def store_template(self, bucket_name, template_body):
+        """
+        Store a CloudFormation template body under its SHA-256 hash in bucket_name, so identical templates
+        are stored only once.
+        :return: the key of the template and the size of the template body in bytes
+        """
+        if not isinstance(template_body, str):
+            # boto3 returns JSON template bodies as a dict
+            template_body = json.dumps(template_body)
+        body = template_body.encode('utf-8')
+        key = f"templates/{hashlib.sha256(body).hexdigest()}.template"
+        s3_client = self.get_boto3_client('s3')
+        try:
+            s3_client.head_object(Bucket=bucket_name, Key=key)
+            self.logger.info("Template s3://%s/%s already stored", bucket_name, key)
+        except ClientError:
+            s3_client.put_object(Bucket=bucket_name, Key=key, Body=body, ServerSideEncryption='AES256')
+            self.logger.info("Template stored as s3://%s/%s", bucket_name, key)
+        return key, len(body)
+
+    def get_s3_object_url(self, bucket_name, key):
+        return f"https://{bucket_name}.s3.{self.get_region()}.amazonaws.com/{key}"
+
     def create_bucket(self, bucket_name, private_bucket=False):
         try:
-            self.logger.info(f"Create bucket {bucket_name} if it does not already exist.")
-            s3 = boto3.resource('s3')
-            s3_client = boto3.client('s3')
-            if s3.Bucket(bucket_name) in s3.buckets.all():
-                self.logger.info(f"Bucket {bucket_name} already exists")
+            self.logger.info("Create bucket %s if it does not already exist.", bucket_name)
+            s3_client = self.get_boto3_client('s3')
+            if self.inventory.bucket_exists(bucket_name):
+                self.logger.info("Bucket %s already exists", bucket_name)
             else:
-                self.logger.info(f"Start creation of bucket {bucket_name}")
-                s3.create_bucket(Bucket=bucket_name,
-                                 CreateBucketConfiguration={'LocationConstraint': self.get_region()})
+                self.logger.info("Start creation of bucket %s", bucket_name)
+                s3_client.create_bucket(Bucket=bucket_name,
+                                        CreateBucketConfiguration={'LocationConstraint': self.get_region()})
+                self.inventory.add_bucket(bucket_name)
                 if private_bucket:
                     s3_client.put_public_access_block(
                         Bucket=bucket_name,
@@ -201,71 +373,182 @@ class AWS:
                             'RestrictPublicBuckets': True
                         },
                     )
-                self.logger.info(f"Finished creation of bucket {bucket_name}")
+                self.logger.info("Finished creation of bucket %s", bucket_name)
         except Exception:
             raise
 
     def remove_bucket(self, bucket_name):
         try:
-            self.logger.info(f"Connect to bucket {bucket_name}")
-            s3 = boto3.resource('s3')
-            bucket = s3.Bucket(bucket_name)
-            self.logger.info(f"Start deletion of all objects in bucket {bucket_name}")
-            bucket.objects.all().delete()
-            self.logger.info(f"Start deletion of bucket {bucket_name}")
-            bucket.delete()
-            self.logger.info(f"Finished deletion of bucket {bucket_name}")
+            self.logger.info("Connect to bucket %s", bucket_name)
+            self.logger.info("Start deletion of all objects in bucket %s", bucket_name)
+            self.delete_all_objects(bucket_name)
+            self.logger.info("Start deletion of bucket %s", bucket_name)
+            self.get_boto3_client('s3').delete_bucket(Bucket=bucket_name)
+            self.inventory.remove_bucket(bucket_name)
+            self.logger.info("Finished deletion of bucket %s", bucket_name)
         except Exception:
-            self.logger.error(f"An error occurred while deleting bucket {bucket_name}")
+            self.logger.error("An error occurred while deleting bucket %s", bucket_name)
             raise
 
-    def backup_bucket(self, origin_bucket_name, backup_bucket_name):
+    @staticmethod
+    def _backup_object(s3_client, sampler, obj, origin_bucket_name, backup_bucket_name):
+        copy_source = {'Bucket': origin_bucket_name, 'Key': obj['Key']}
+        s3_client.copy(copy_source, backup_bucket_name, f"{origin_bucket_name}/{obj['Key']}")
+        sampler.debug("Copied %s to %s/%s", obj['Key'], backup_bucket_name, origin_bucket_name)
+
+    def backup_bucket(self, origin_bucket_name, backup_bucket_name, archive=None):
+        """
+        Copy all objects of origin_bucket_name to <backup_bucket_name>/<origin_bucket_name>/. When an
+        S3Archive is passed, small objects are packed in archives instead of being copied one by one.
+        """
         try:
-            self.logger.info(f"Connect to bucket {origin_bucket_name}")
-            s3 = boto3.client('s3')
-            s3_resource = boto3.resource('s3')
-            self.logger.info(f"Start backup of all objects in bucket {origin_bucket_name}")
-            # Get all objects
-            bucket = s3_resource.Bucket(origin_bucket_name)
-            objects = bucket.objects.all()
-            for obj in objects:
-                copy_source = {'Bucket': origin_bucket_name, 'Key': obj.key}
-                s3_resource.meta.client.copy(copy_source, backup_bucket_name, f"{origin_bucket_name}/{obj.key}")
-            self.logger.info(f"Finished backup of bucket {origin_bucket_name} to {backup_bucket_name}")
+            self.logger.info("Connect to bucket %s", origin_bucket_name)
+            if archive is not None:
+                self.logger.info("Start packed backup of all objects in bucket %s", origin_bucket_name)
+                archive.pack_bucket(origin_bucket_name, backup_bucket_name)
+                self.logger.info("Finished packed backup of bucket %s to %s", origin_bucket_name, backup_bucket_name)
+                return
+            s3_client = self.get_boto3_client('s3')
+            self.logger.info("Start backup of all objects in bucket %s", origin_bucket_name)
+            sampler = LogSampler(self.logger, self.log_sample_rate)
+
+            def copy(obj):
+                self._backup_object(s3_client, sampler, obj, origin_bucket_name, backup_bucket_name)
+
+            ShardedLister.for_each(self.get_lister().list(origin_bucket_name), copy, self.s3_workers)
+            self.logger.info("Finished backup of bucket %s to %s", origin_bucket_name, backup_bucket_name)
         except Exception:
-            self.logger.error(f"An error occurred while taking a backup of bucket {origin_bucket_name}")
+            self.logger.error("An error occurred while taking a backup of bucket %s", origin_bucket_name)
             raise
 
-    def restore_bucket(self, bucket_name, origin_bucket_name):
+    def get_restore_acl(self, bucket_name):
+        """
+        Return the canned ACL for restored objects: the value of the ass:s3:backup-and-empty-bucket-on-stop-acl
+        tag, private when the tag is not set.
+        """
+        for tag in self.inventory.get_bucket_tags(bucket_name):
+            if tag['Key'] == "ass:s3:backup-and-empty-bucket-on-stop-acl":
+                return tag['Value']
+        return "private"
+
+    def _restore_object(self, s3_client, sampler, obj, bucket_name, origin_bucket_name, acl):
+        # full path (e.g. bucket/folder/test.png)
+        origin_file_key = obj['Key']
+        # path (e.g. folder/test.png)
+        fn_new_bucket = "/".join(origin_file_key.strip("/").split('/')[1:])
+        if not origin_file_key.endswith("/"):
+            copy_source = {'Bucket': origin_bucket_name, 'Key': origin_file_key}
+            s3_client.copy(copy_source, bucket_name, fn_new_bucket, acl)
+            s3_client.delete_object(Bucket=origin_bucket_name, Key=origin_file_key)
+            sampler.debug("Restored %s to %s", fn_new_bucket, bucket_name)
+
+    def restore_bucket(self, bucket_name, origin_bucket_name, archive=None):
         try:
-            self.logger.info(f"Connect to bucket {origin_bucket_name}")
-            s3 = boto3.client('s3')
-            s3_resource = boto3.resource('s3')
+            self.logger.info("Connect to bucket %s", origin_bucket_name)
+            s3 = self.get_boto3_client('s3')
 
             # Get ACL tag
-            self.logger.info(f"Getting ACL from bucket: {bucket_name}")
+            self.logger.info("Getting ACL from bucket: %s", bucket_name)
             acl = ""
+            acl_tag = None
             for tag in s3.get_bucket_tagging(Bucket=f"{bucket_name}")['TagSet']:
                 if tag['Key'] == "ass:s3:backup-and-empty-bucket-on-stop-acl":
                     bucket_tag = tag['Value']
+                    acl_tag = bucket_tag
                     acl = {'ACL': f"{bucket_tag}"}
                 else:
                     acl = {'ACL': "private"}
 
+            # Restore packed objects first, the remaining objects were copied one by one. Without ACL tag,
+            # the packed objects get the ACL recorded in the archive index.
+            if archive is not None and archive.has_archive(bucket_name, origin_bucket_name):
+                self.logger.info("Start restore of archived objects of %s from %s", bucket_name, origin_bucket_name)
+                archive.unpack_bucket(bucket_name, origin_bucket_name, acl_tag)
+                self.logger.info("Finished restore of archived objects of %s", bucket_name)
+
             # Starting restore
-            self.logger.info(f"Start restore of all objects in bucket {origin_bucket_name}")
-            bucket = s3_resource.Bucket(origin_bucket_name)
-            objects = bucket.objects.all()
-            for obj in objects:
-                # full path (e.g. bucket/folder/test.png)
-                origin_file_key = obj.key
-                # path (e.g. folder/test.png)
-                fn_new_bucket = "/".join(origin_file_key.strip("/").split('/')[1:])
-                if not origin_file_key.endswith("/"):
-                    copy_source = {'Bucket': origin_bucket_name, 'Key': origin_file_key}
-                    s3_resource.meta.client.copy(copy_source, bucket_name, fn_new_bucket, acl)
-                    s3.delete_object(Bucket=origin_bucket_name, Key=origin_file_key)
-            self.logger.info(f"Finished backup of bucket {origin_bucket_name} to {bucket_name}")
+            self.logger.info("Start restore of all objects in bucket %s", origin_bucket_name)
+            s3_client = self.get_boto3_client('s3')
+            sampler = LogSampler(self.logger, self.log_sample_rate)
+
+            def restore(obj):
+                self._restore_object(s3_client, sampler, obj, bucket_name, origin_bucket_name, acl)
+
+            ShardedLister.for_each(self.get_lister().list(origin_bucket_name, prefix=f"{bucket_name}/"), restore,
+                                   self.s3_workers)
+            self.logger.info("Finished backup of bucket %s to %s", origin_bucket_name, bucket_name)
         except Exception:
-            self.logger.error(f"An error occurred while taking a backup of bucket {origin_bucket_name}")
+            self.logger.error("An error occurred while taking a backup of bucket %s", origin_bucket_name)
             raise
+
+    def get_work_queue(self, state_bucket_name, name):
+        return WorkQueue(self.logger, self.get_boto3_client('s3'), state_bucket_name, name,
+                         **self._work_queue_settings())
+
+    def get_open_work_queues(self, state_bucket_name):
+        return WorkQueue.list_open(self.logger, self.get_boto3_client('s3'), state_bucket_name,
+                                   **self._work_queue_settings())
+
+    @staticmethod
+    def _work_queue_settings():
+        return {
+            'units': int(os.getenv('ASS_WORK_QUEUE_UNITS', '4')),
+            'lease_seconds': int(os.getenv('ASS_WORK_QUEUE_LEASE_SECONDS', '300')),
+            'max_attempts': int(os.getenv('ASS_WORK_QUEUE_ATTEMPTS', '3')),
+            'poll_interval': int(os.getenv('ASS_WORK_QUEUE_POLL_INTERVAL', '10'))
+        }
+
+    def get_work_handlers(self):
+        """
+        Return the functions that do the work units of a WorkQueue, by payload kind.
+        """
+        return {'bucket-backup': self.backup_bucket_shard, 'bucket-restore': self.restore_bucket_shard}
+
+    def _plan_bucket_shards(self, kind, bucket_name, prefix, do_now, **payload):
+        """
+        Return the (id, payload) work units for the shards of bucket_name below prefix. The items found while
+        sharding are passed to do_now right away.
+        """
+        found = []
+        shards = self.get_lister().get_shards(bucket_name, prefix, False, found.append)
+        ShardedLister.for_each(found, do_now, self.s3_workers)
+        return [(f"{kind}-{payload['bucket']}-{index:05d}",
+                 dict(kind=kind, prefix=shard_prefix, lower=lower, upper=upper, **payload))
+                for index, (shard_prefix, lower, upper) in enumerate(shards)]
+
+    def plan_bucket_backup(self, origin_bucket_name, backup_bucket_name):
+        s3_client = self.get_boto3_client('s3')
+        sampler = LogSampler(self.logger, self.log_sample_rate)
+        return self._plan_bucket_shards(
+            'bucket-backup', origin_bucket_name, '',
+            lambda obj: self._backup_object(s3_client, sampler, obj, origin_bucket_name, backup_bucket_name),
+            bucket=origin_bucket_name, backup_bucket=backup_bucket_name)
+
+    def plan_bucket_restore(self, bucket_name, origin_bucket_name):
+        s3_client = self.get_boto3_client('s3')
+        sampler = LogSampler(self.logger, self.log_sample_rate)
+        acl = {'ACL': self.get_restore_acl(bucket_name)}
+        return self._plan_bucket_shards(
+            'bucket-restore', origin_bucket_name, f"{bucket_name}/",
+            lambda obj: self._restore_object(s3_client, sampler, obj, bucket_name, origin_bucket_name, acl),
+            bucket=bucket_name, backup_bucket=origin_bucket_name, acl=acl)
+
+    def backup_bucket_shard(self, payload):
+        s3_client = self.get_boto3_client('s3')
+        sampler = LogSampler(self.logger, self.log_sample_rate)
+        with log_context(bucket=payload['bucket']):
+            ShardedLister.for_each(
+                self.get_lister().list_shard(payload['bucket'], payload['prefix'], payload['lower'], payload['upper']),
+                lambda obj: self._backup_object(s3_client, sampler, obj, payload['bucket'], payload['backup_bucket']),
+                self.s3_workers)
+
+    def restore_bucket_shard(self, payload):
+        s3_client = self.get_boto3_client('s3')
+        sampler = LogSampler(self.logger, self.log_sample_rate)
+        with log_context(bucket=payload['bucket']):
+            ShardedLister.for_each(
+                self.get_lister().list_shard(payload['backup_bucket'], payload['prefix'], payload['lower'],
+                                             payload['upper']),
+                lambda obj: self._restore_object(s3_client, sampler, obj, payload['bucket'], payload['backup_bucket'],
+                                                 payload['acl']),
+                self.s3_workers)
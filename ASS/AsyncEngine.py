@@ -0,0 +1,199 @@
+import asyncio
+import contextlib
+import time
+from .LogPipeline import LogSampler, log_context
+
+
+class AsyncEngine:
+    """
+    asyncio execution engine for the S3 phases, selected with ASS_ENGINE=asyncio (requires aiobotocore).
+
+    All requests of a service share one client and are limited by a semaphore per service. Keys are streamed from
+    the listing into a bounded queue that is drained by worker coroutines, so thousands of requests can be in
+    flight from one process without keeping the key list in memory.
+    """
+
+    DEFAULT_CONCURRENCY = {'s3': 256}
+    # copy_object is limited to objects of 5 GB, larger objects are copied with the multipart copy of boto3
+    MAX_COPY_OBJECT_SIZE = 5 * 1024 * 1024 * 1024
+
+    def __init__(self, logger, region, s3_client, concurrency=None, default_concurrency=32, log_sample_rate=1000):
+        # aiobotocore is only imported when the engine is selected
+        try:
+            from aiobotocore.session import get_session
+        except ImportError:
+            raise Exception("ASS_ENGINE=asyncio requires the aiobotocore package")
+        self.logger = logger
+        self.region = region
+        # boto3 client for the multipart copies of objects larger than MAX_COPY_OBJECT_SIZE
+        self.s3_client = s3_client
+        self.concurrency = dict(self.DEFAULT_CONCURRENCY)
+        self.concurrency.update(concurrency or dict())
+        self.default_concurrency = default_concurrency
+        self.log_sample_rate = log_sample_rate
+        self.session = get_session()
+        self.exit_stack = None
+        self.client_lock = None
+        self.clients = dict()
+        self.semaphores = dict()
+
+    def run(self, coroutine_function, *args):
+        """
+        Run coroutine_function(*args) in a new event loop, the clients are closed when it returns.
+        """
+        async def runner():
+            async with contextlib.AsyncExitStack() as exit_stack:
+                self.exit_stack = exit_stack
+                self.client_lock = asyncio.Lock()
+                self.clients = dict()
+                self.semaphores = dict()
+                return await coroutine_function(*args)
+
+        return asyncio.run(runner())
+
+    def get_concurrency(self, service):
+        return self.concurrency.get(service, self.default_concurrency)
+
+    async def _client(self, service):
+        async with self.client_lock:
+            if service not in self.clients:
+                self.clients[service] = await self.exit_stack.enter_async_context(
+                    self.session.create_client(service, region_name=self.region)
+                )
+                self.semaphores[service] = asyncio.Semaphore(self.get_concurrency(service))
+        return self.clients[service]
+
+    async def call(self, service, operation, **kwargs):
+        client = await self._client(service)
+        async with self.semaphores[service]:
+            return await getattr(client, operation)(**kwargs)
+
+    async def paginate(self, service, operation, result_key, **kwargs):
+        client = await self._client(service)
+        async for page in client.get_paginator(operation).paginate(**kwargs):
+            for item in page.get(result_key, []):
+                yield item
+
+    async def stream(self, items, handler, workers):
+        """
+        Call handler for every item of the async iterator items with at most workers handlers running.
+        """
+        queue = asyncio.Queue(maxsize=workers * 2)
+
+        async def produce():
+            async for item in items:
+                await queue.put(item)
+            for _ in range(workers):
+                await queue.put(None)
+
+        async def worker():
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                await handler(item)
+
+        tasks = [asyncio.create_task(produce())] + [asyncio.create_task(worker()) for _ in range(workers)]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _copy(self, source_bucket_name, source_key, size, bucket_name, key, acl=None):
+        if size > self.MAX_COPY_OBJECT_SIZE:
+            # Fall back to the managed (multipart) copy of boto3 in a thread
+            extra_args = {'ACL': acl} if acl else None
+            await asyncio.to_thread(self.s3_client.copy,
+                                    {'Bucket': source_bucket_name, 'Key': source_key}, bucket_name, key, extra_args)
+            return
+        arguments = {'Bucket': bucket_name, 'Key': key, 'CopySource': {'Bucket': source_bucket_name, 'Key': source_key}}
+        if acl:
+            arguments['ACL'] = acl
+        await self.call('s3', 'copy_object', **arguments)
+
+    async def backup_bucket(self, origin_bucket_name, backup_bucket_name):
+        self.logger.info("Start async backup of all objects in bucket %s", origin_bucket_name)
+        sampler = LogSampler(self.logger, self.log_sample_rate)
+
+        async def copy(obj):
+            await self._copy(origin_bucket_name, obj['Key'], obj['Size'],
+                             backup_bucket_name, f"{origin_bucket_name}/{obj['Key']}")
+            sampler.debug("Copied %s to %s/%s", obj['Key'], backup_bucket_name, origin_bucket_name)
+
+        await self.stream(self.paginate('s3', 'list_objects_v2', 'Contents', Bucket=origin_bucket_name),
+                          copy, self.get_concurrency('s3'))
+        self.logger.info("Finished async backup of bucket %s to %s", origin_bucket_name, backup_bucket_name)
+
+    async def restore_bucket(self, bucket_name, backup_bucket_name, acl=None):
+        self.logger.info("Start async restore of bucket %s from %s", bucket_name, backup_bucket_name)
+        sampler = LogSampler(self.logger, self.log_sample_rate)
+
+        async def restore(obj):
+            # full path (e.g. bucket/folder/test.png) to path (e.g. folder/test.png)
+            key = "/".join(obj['Key'].strip("/").split('/')[1:])
+            if not obj['Key'].endswith("/"):
+                await self._copy(backup_bucket_name, obj['Key'], obj['Size'], bucket_name, key, acl)
+                await self.call('s3', 'delete_object', Bucket=backup_bucket_name, Key=obj['Key'])
+                sampler.debug("Restored %s to %s", key, bucket_name)
+
+        await self.stream(self.paginate('s3', 'list_objects_v2', 'Contents',
+                                        Bucket=backup_bucket_name, Prefix=f"{bucket_name}/"),
+                          restore, self.get_concurrency('s3'))
+        self.logger.info("Finished async restore of bucket %s", bucket_name)
+
+    async def empty_bucket(self, bucket_name):
+        """
+        Delete all object versions and delete markers, one DeleteObjects request per listed page.
+        """
+        self.logger.info("Start async deletion of all objects in bucket %s", bucket_name)
+        client = await self._client('s3')
+
+        async def pages():
+            async for page in client.get_paginator('list_object_versions').paginate(Bucket=bucket_name):
+                objects = [{'Key': version['Key'], 'VersionId': version['VersionId']}
+                           for version in page.get('Versions', []) + page.get('DeleteMarkers', [])]
+                if len(objects) > 0:
+                    yield objects
+
+        async def delete(objects):
+            response = await self.call('s3', 'delete_objects', Bucket=bucket_name,
+                                       Delete={'Objects': objects, 'Quiet': True})
+            for error in response.get('Errors', []):
+                self.logger.error("Deleting %s from %s failed: %s", error['Key'], bucket_name, error['Message'])
+
+        await self.stream(pages(), delete, max(self.get_concurrency('s3') // 16, 1))
+        self.logger.info("Finished async deletion of all objects in bucket %s", bucket_name)
+
+    async def gather(self, coroutines):
+        return await asyncio.gather(*coroutines)
+
+    @staticmethod
+    async def run_for_bucket(coroutine, bucket_name):
+        """
+        Await coroutine with the bucket in the log context, return the number of seconds it took.
+        """
+        start_time = time.time()
+        with log_context(bucket=bucket_name):
+            await coroutine
+        return time.time() - start_time
+
+    def run_for_buckets(self, coroutines):
+        """
+        Run the coroutines (a dict with the bucket name as key) at the same time, return a dict with the number
+        of seconds per bucket.
+        """
+        durations = self.run(self.gather, [self.run_for_bucket(coroutine, bucket_name)
+                                           for bucket_name, coroutine in coroutines.items()])
+        return dict(zip(coroutines, durations))
+
+    def backup_buckets(self, bucket_names, backup_bucket_name):
+        return self.run_for_buckets({bucket_name: self.backup_bucket(bucket_name, backup_bucket_name)
+                                     for bucket_name in bucket_names})
+
+    def restore_buckets(self, bucket_acls, backup_bucket_name):
+        return self.run_for_buckets({bucket_name: self.restore_bucket(bucket_name, backup_bucket_name, acl)
+                                     for bucket_name, acl in bucket_acls.items()})
+
+    def empty_buckets(self, bucket_names):
+        return self.run_for_buckets({bucket_name: self.empty_bucket(bucket_name) for bucket_name in bucket_names})
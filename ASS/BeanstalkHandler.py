@@ -0,0 +1,100 @@
+import json
+from botocore.exceptions import ClientError
+from .ResourceHandler import Resource, ResourceHandler
+
+
+class BeanstalkHandler(ResourceHandler):
+    """
+    Terminates (stop) the Elastic Beanstalk environments tagged with environment_deletion_order, after saving
+    the environment in the state bucket, and rebuilds (start) the terminated environments that were saved, in
+    reverse order.
+    """
+
+    kind = 'beanstalk-environment'
+
+    def __init__(self, cfg, aws, operation):
+        super().__init__(cfg, aws, operation)
+        self.reverse_order = operation == 'start'
+        self.client = aws.get_boto3_client('elasticbeanstalk')
+        self.state_bucket_name = cfg.get_state_bucket_name(aws.get_region(), aws.get_account_id())
+
+    def discover(self):
+        if self.operation == 'start':
+            self.logger.info("Getting all terminated BeanStalk environments ...")
+            return [Resource(environment['EnvironmentName'])
+                    for environment in self.aws.get_inventory().get('elasticbeanstalk_terminated')]
+
+        self.logger.info("Getting all BeanStalk environments ...")
+        resources = []
+        selector = self.cfg.get_selector()
+        for environment in self.aws.get_inventory().get('elasticbeanstalk'):
+            try:
+                tags = self.client.list_tags_for_resource(ResourceArn=environment['EnvironmentArn'])['ResourceTags']
+            except ClientError:
+                self.logger.error("Resource %s not found, continuing.", environment['EnvironmentArn'])
+                continue
+            for tag in tags:
+                if (tag['Key'] == 'environment_deletion_order' and int(tag['Value']) > 0 and
+                        selector.matches_order(int(tag['Value'])) and selector.matches_tags(tags)):
+                    resources.append(Resource(environment['EnvironmentName'], int(tag['Value']), {
+                        "environment_name": environment['EnvironmentName'],
+                        "environment_id": environment['EnvironmentId'],
+                        "environment_arn": environment['EnvironmentArn'],
+                        "environment_deletion_order": int(tag['Value'])
+                    }))
+        return resources
+
+    def restore_state(self, resource):
+        """
+        Load the environment saved by the stop. Environments without a saved state were terminated outside the
+        stop/start setup and are skipped, as are the environments that do not match the selection.
+        """
+        if self.operation != 'start':
+            return True
+        try:
+            self.logger.info("Get saved state data for %s from S3 bucket %s", resource.name, self.state_bucket_name)
+            resource.data = json.loads(self.aws.get_boto3_client('s3').get_object(
+                Bucket=self.state_bucket_name, Key=resource.name)['Body'].read().decode('utf-8'))
+            self.logger.info("Saved data is: %s ", resource.data)
+        except Exception:
+            self.logger.warning("An error occurred retrieving stack information from the S3 state bucket")
+            self.logger.warning("Skipping this beanstalk environment, because it's an environment")
+            self.logger.warning("that was deleted outside the stop/start setup.")
+            return False
+        resource.order = resource.data['environment_deletion_order']
+        return self._is_selected(resource)
+
+    def _is_selected(self, resource):
+        # Environments whose tags cannot be read are left out of a selection on tags
+        selector = self.cfg.get_selector()
+        if not selector.matches_order(resource.order):
+            return False
+        if not selector.has_tags():
+            return True
+        try:
+            tags = self.client.list_tags_for_resource(ResourceArn=resource.data['environment_arn'])['ResourceTags']
+        except ClientError:
+            self.logger.warning("Tags of environment %s cannot be read, it is not selected", resource.name)
+            return False
+        return selector.matches_tags(tags)
+
+    def save_state(self, resource):
+        if self.operation != 'stop':
+            return
+        self.logger.info("Tag environment_deletion_order=%s found, saving it to bucket %s",
+                         resource.order, self.state_bucket_name)
+        self.aws.get_boto3_client('s3').put_object(Bucket=self.state_bucket_name, Key=resource.name,
+                                                   Body=json.dumps(resource.data))
+        self.logger.info("Tag environment_deletion_order successfully written to s3://%s/%s",
+                         self.state_bucket_name, resource.name)
+
+    def act(self, resource):
+        if self.operation == 'stop':
+            self.logger.info("Start deletion of environment %s (deletion order is %i)", resource.name, resource.order)
+            self.client.terminate_environment(EnvironmentName=resource.name)
+            self.aws.get_inventory().invalidate('elasticbeanstalk')
+        else:
+            self.client.rebuild_environment(EnvironmentId=resource.data['environment_id'])
+            self.logger.info("Async re-creation of terminated BeanStalk environment %s ended successfully",
+                             resource.name)
+            self.logger.info("Please allow a few minutes for the environment to start.")
@@ -0,0 +1,61 @@
+import threading
+from .LogPipeline import log_context
+from .ResourceHandler import Resource, ResourceHandler
+
+
+class BucketHandler(ResourceHandler):
+    """
+    Empties (operation empty, on stop) the buckets tagged with ass:s3:clean-bucket-on-stop=yes or
+    ass:s3:backup-and-empty-bucket-on-stop=yes. The script passes the function that returns the empty strategy of a
+    bucket: 'lifecycle' replaces the lifecycle configuration with expiration rules, 'delete' deletes the objects,
+    through the AsyncEngine when ASS_ENGINE selects one, in which case the buckets of the level are emptied together
+    once all of them were started. Buckets that were emptied by their snapshot are left alone.
+    """
+
+    kind = 'bucket'
+
+    def __init__(self, cfg, aws, operation, get_strategy):
+        super().__init__(cfg, aws, operation)
+        self.get_strategy = get_strategy
+        self.state_bucket_name = cfg.get_state_bucket_name(aws.get_region(), aws.get_account_id())
+        self.engine = cfg.get_async_engine(aws.get_region(), aws.get_boto3_client('s3'))
+        self.snapshot = cfg.get_s3_backup_mode() == 'snapshot'
+        self.async_bucket_names = []
+        self.lock = threading.Lock()
+
+    def discover(self):
+        self.logger.info("Start getting bucket names")
+        resources = []
+        for bucket in self.aws.get_inventory().get_buckets():
+            bucket_name = bucket['Name']
+            self.logger.debug("Checking bucket %s (arn:aws:s3:::%s)", bucket_name, bucket_name)
+            backup = self.aws.s3_has_tag(bucket_name,
+                                         self.cfg.full_ass_tag('ass:s3:backup-and-empty-bucket-on-stop'), 'yes')
+            if self.snapshot and backup:
+                self.logger.info("Bucket %s was emptied by its snapshot", bucket_name)
+            elif backup or self.aws.s3_has_tag(bucket_name, self.cfg.full_ass_tag('ass:s3:clean-bucket-on-stop'),
+                                               'yes'):
+                self.logger.info("Bucket %s will be cleaned", bucket_name)
+                resources.append(Resource(bucket_name, data={'bucket': bucket}))
+        return resources
+
+    def restore_state(self, resource):
+        return not self.cfg.get_time_budget().is_unit_finished('bucket-empty', resource.name)
+
+    def act(self, resource):
+        if self.get_strategy(resource.name) == 'lifecycle':
+            if self.aws.get_inventory().claim_bucket_emptying(resource.name):
+                self.aws.expire_bucket_with_lifecycle(resource.name, self.state_bucket_name)
+        elif self.engine is not None:
+            if self.aws.get_inventory().claim_bucket_emptying(resource.name):
+                with self.lock:
+                    self.async_bucket_names.append(resource.name)
+        else:
+            with log_context(bucket=resource.name), self.cfg.get_time_budget().unit('bucket-empty', resource.name):
+                self.aws.empty_bucket(resource.data['bucket'])
+
+    def level_started(self, resources):
+        with self.lock:
+            bucket_names, self.async_bucket_names = self.async_bucket_names, []
+        if len(bucket_names) > 0:
+            self.engine.empty_buckets(bucket_names)
@@ -0,0 +1,118 @@
+import argparse
+import importlib.util
+import os
+import re
+import subprocess
+import sys
+
+OPERATIONS = ['stop', 'start']
+# Long-running processes, their scripts take no arguments
+SERVICES = ['daemon', 'worker']
+# Modules that are only imported when they are used, importing them at start is a regression
+LAZY_MODULES = ['jira', 'httplib2', 'aiobotocore']
+
+
+def get_script_dirs():
+    """
+    Return the directories searched for the aws-ass-*.py scripts: ASS_SCRIPT_DIR, the directory that
+    contains the ASS package (a checkout or a container image) and share/aws-ass of an installed package.
+    """
+    dirs = [os.getenv('ASS_SCRIPT_DIR', ''),
+            os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            os.path.join(sys.prefix, 'share', 'aws-ass')]
+    return [path for path in dirs if path != '']
+
+
+def load_script(name):
+    """
+    Load a script (e.g. aws-ass-stop.py) without running it.
+    """
+    for script_dir in get_script_dirs():
+        path = os.path.join(script_dir, f"{name}.py")
+        if os.path.exists(path):
+            spec = importlib.util.spec_from_file_location(name.replace('-', '_'), path)
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+            return module
+    raise Exception(f"{name}.py not found in {', '.join(get_script_dirs())}, set ASS_SCRIPT_DIR")
+
+
+def check_imports(operations, budget):
+    """
+    Load the scripts of operations in a new interpreter with -X importtime, print the slowest imports and return
+    False when a module of LAZY_MODULES was imported or the imports took more than budget milliseconds.
+    """
+    code = ("import ASS.Cli\n" +
+            ''.join(f"ASS.Cli.load_script('aws-ass-{operation}')\n" for operation in operations))
+    # The new interpreter imports this ASS package
+    path = os.pathsep.join([os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                            os.getenv('PYTHONPATH', '')])
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], capture_output=True, text=True,
+                            env=dict(os.environ, PYTHONPATH=path))
+    if result.returncode != 0:
+        print(result.stderr)
+        return False
+
+    top_level = []
+    imported = set()
+    for line in result.stderr.splitlines():
+        match = re.match(r'import time:\s+\d+ \|\s+(\d+) \|( *)(\S+)', line)
+        if match is None:
+            continue
+        imported.add(match.group(3).split('.')[0])
+        if len(match.group(2)) == 1:
+            top_level.append((int(match.group(1)) / 1000, match.group(3)))
+    total = sum(duration for duration, _ in top_level)
+
+    for duration, module in sorted(top_level, reverse=True)[:10]:
+        print(f"{duration:8.1f} ms  {module}")
+    print(f"{total:8.1f} ms  in total, the budget is {budget} ms")
+    eager = [module for module in LAZY_MODULES if module in imported]
+    if len(eager) > 0:
+        print(f"Imported at start, but should be imported on first use: {', '.join(eager)}")
+    return len(eager) == 0 and total <= budget
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(prog='ass', description='Stop and start the tagged resources of an AWS account')
+    commands = parser.add_subparsers(dest='command', required=True, metavar='command')
+    # The options of stop, start and plan are those of the scripts, --help included
+    commands.add_parser('stop', add_help=False, help='Stop the tagged resources, see ass stop --help')
+    commands.add_parser('start', add_help=False, help='Start the tagged resources, see ass start --help')
+    plan = commands.add_parser('plan', add_help=False,
+                               help='Show what ass stop or ass start would do without changing anything')
+    plan.add_argument('operation', choices=OPERATIONS)
+    commands.add_parser('daemon', help='Run the scheduled stops and starts and their HTTP endpoint (aws-ass-daemon.py)')
+    commands.add_parser('worker', help='Do the units of the open work queues (aws-ass-worker.py)')
+    check = commands.add_parser('check-imports', help='Check that the import time of the scripts is within budget')
+    check.add_argument('operations', nargs='*', metavar='{stop,start}', help='Default: stop and start')
+    check.add_argument('--budget', type=float, default=float(os.getenv('ASS_IMPORT_BUDGET', '1000')),
+                       help='Milliseconds the imports may take (ASS_IMPORT_BUDGET, default 1000)')
+    return parser.parse_known_args(argv)
+
+
+def main(argv=None):
+    arguments, script_arguments = parse_arguments(argv)
+    if arguments.command == 'check-imports':
+        unknown = script_arguments + [operation for operation in arguments.operations if operation not in OPERATIONS]
+        if len(unknown) > 0:
+            print(f"Unknown arguments {' '.join(unknown)}")
+            return 2
+        return 0 if check_imports(arguments.operations or OPERATIONS, arguments.budget) else 1
+
+    if arguments.command in SERVICES:
+        if len(script_arguments) > 0:
+            print(f"Unknown arguments {' '.join(script_arguments)}")
+            return 2
+        load_script(f"aws-ass-{arguments.command}").main()
+        return 0
+
+    if arguments.command == 'plan':
+        operation, script_arguments = arguments.operation, script_arguments + ['--plan']
+    else:
+        operation = arguments.command
+    return 1 if load_script(f"aws-ass-{operation}").main(script_arguments) is False else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,16 +1,36 @@
+import atexit
+import boto3
 import logging
 import os
-import sys
-import random
-import string
+import time
+from .AsyncEngine import AsyncEngine
+from .Daemon import Daemon, parse_schedule
+from .HandlerEngine import HandlerEngine
+from .LogPipeline import configure_logger, LogSampler
+from .Profiler import Profiler
+from .S3Archive import S3Archive
+from .RunHistory import RunHistory
+from .RunMarker import RunMarker
+from .Scheduler import Scheduler
+from .Selector import Selector
+from .TimeBudget import TimeBudget
+from .TrafficTrace import TrafficRecorder, TrafficReplayer, parse_faults
+from .StackPoller import StackPoller
 
 
 class Config:
+    # The traffic trace is set up once per process, a daemon creates a Config for every run
+    process_traffic_trace = None
+
     def __init__(self, project_name=''):
         self._set_ass_tag_prefix()
         self._init_logger(project_name)
         self.aws_authenticated = False
-        self.template_bucket_name = None
+        self.start_time = time.time()
+        self.run_history = None
+        self.time_budget = None
+        self.selector = Selector()
+        self.traffic_trace = self._init_traffic_trace()
         self.get_sleep_seconds_after_rds_start()
 
     def get_logger(self):
@@ -27,12 +47,6 @@ class Config:
     def get_backup_bucket_name(region, account_id):
         return f"{region}-{account_id}-bucket-backup"
 
-    def get_template_bucket_name(self):
-        if self.template_bucket_name is None:
-            random_string = ''.join(random.choices(string.ascii_lowercase + string.digits, k=20))
-            self.template_bucket_name = f"stack-recreation-bucket-{random_string}"
-        return self.template_bucket_name
-
     def aws_authenticated(self):
         return self.aws_authenticated
 
@@ -42,23 +56,276 @@ class Config:
     def get_sleep_seconds_after_rds_start(self):
         self.sleep_seconds_after_rds_start = os.getenv('SLEEP_SECONDS_AFTER_RDS_START', '0')
 
+    @staticmethod
+    def get_inline_template_size():
+        # CloudFormation accepts a TemplateBody of at most 51200 bytes
+        return min(int(os.getenv('ASS_INLINE_TEMPLATE_SIZE', '51200')), 51200)
+
+    @staticmethod
+    def get_s3_backup_mode():
+        return os.getenv('ASS_S3_BACKUP_MODE', 'copy').lower()
+
+    @staticmethod
+    def get_s3_workers():
+        return int(os.getenv('ASS_S3_WORKERS', '16'))
+
+    @staticmethod
+    def get_s3_lifecycle_threshold():
+        return int(os.getenv('ASS_S3_LIFECYCLE_THRESHOLD', '0'))
+
+    @staticmethod
+    def get_s3_count_sample_pages():
+        return int(os.getenv('ASS_S3_COUNT_SAMPLE_PAGES', '10'))
+
+    @staticmethod
+    def get_log_sample_rate():
+        return int(os.getenv('ASS_LOG_SAMPLE_RATE', '1000'))
+
+    def get_log_sampler(self):
+        return LogSampler(self.get_logger(), self.get_log_sample_rate())
+
+    def get_s3_archive(self, s3_client):
+        return S3Archive(
+            self.get_logger(),
+            s3_client,
+            max_object_size=int(os.getenv('ASS_S3_ARCHIVE_MAX_OBJECT_SIZE', str(1024 * 1024))),
+            part_size=int(os.getenv('ASS_S3_ARCHIVE_PART_SIZE', str(16 * 1024 * 1024))),
+            archive_size=int(os.getenv('ASS_S3_ARCHIVE_SIZE', str(1024 * 1024 * 1024))),
+            workers=self.get_s3_workers(),
+            log_sample_rate=self.get_log_sample_rate()
+        )
+
+    @staticmethod
+    def get_work_queue_enabled():
+        return os.getenv('ASS_WORK_QUEUE', '0') == '1'
+
+    @staticmethod
+    def get_engine():
+        return os.getenv('ASS_ENGINE', 'threads').lower()
+
+    def get_async_engine(self, region, s3_client):
+        """
+        Return an AsyncEngine when ASS_ENGINE is asyncio, None otherwise.
+        """
+        if self.get_engine() != 'asyncio':
+            return None
+        return AsyncEngine(
+            self.get_logger(),
+            region,
+            s3_client,
+            concurrency={'s3': int(os.getenv('ASS_ASYNC_S3_CONCURRENCY', '256'))},
+            default_concurrency=int(os.getenv('ASS_ASYNC_CONCURRENCY', '32')),
+            log_sample_rate=self.get_log_sample_rate()
+        )
+
+    def get_profiler(self):
+        """
+        Return a Profiler when ASS_PROFILE is set, None otherwise.
+        """
+        if os.getenv('ASS_PROFILE', '') == '':
+            return None
+        return Profiler(
+            self.get_logger(),
+            os.environ['ASS_PROFILE'].lower(),
+            output_dir=os.getenv('ASS_PROFILE_DIR', 'ass-profile'),
+            top=int(os.getenv('ASS_PROFILE_TOP', '20')),
+            interval=float(os.getenv('ASS_PROFILE_INTERVAL', '0.01'))
+        )
+
+    def init_selector(self, expressions=None):
+        """
+        Narrow the run to the resources selected by expressions (the --select options), ASS_SELECT (expressions
+        separated by spaces) when None.
+        """
+        if expressions is None:
+            expressions = os.getenv('ASS_SELECT', '').split()
+        self.selector = Selector(expressions)
+        if not self.selector.is_empty():
+            self.get_logger().info("Run is narrowed to the selection %s", self.selector)
+        return self.selector
+
+    def get_selector(self):
+        return self.selector
+
+    def is_selected(self, resource_type):
+        """
+        Return False when no resource of resource_type can match the selection, its phases are skipped.
+        """
+        if self.selector.allows_type(resource_type):
+            return True
+        self.get_logger().info("Skipping the %s tasks, they do not match the selection %s",
+                               resource_type, self.selector)
+        return False
+
+    def init_run_state(self, s3_client, state_bucket_name, script_name, budget=None):
+        """
+        Create the RunHistory and the TimeBudget of this run and load the history and the progress of the previous
+        runs. budget is the number of seconds the run may take, ASS_TIME_BUDGET when None. Targeted runs keep their
+        own run state, they would spoil the history of full runs.
+        """
+        if not self.selector.is_empty():
+            script_name = f"{script_name}-select-{self.selector.get_id()}"
+        self.run_history = RunHistory(self.get_logger(), s3_client, state_bucket_name, script_name)
+        self.run_history.load()
+
+        if budget is None and os.getenv('ASS_TIME_BUDGET', '') != '':
+            budget = int(os.environ['ASS_TIME_BUDGET'])
+        self.time_budget = TimeBudget(
+            self.get_logger(),
+            s3_client,
+            state_bucket_name,
+            script_name,
+            self.run_history,
+            budget=budget,
+            start_time=self.start_time,
+            resume_window=int(os.getenv('ASS_RESUME_WINDOW', '3600')),
+            exit_code=int(os.getenv('ASS_CONTINUE_EXIT_CODE', '75'))
+        )
+        self.time_budget.load()
+
+    def save_run_state(self, completed=False):
+        """
+        Save the run history and the progress of this run.
+        """
+        self.run_history.save(time.time() - self.start_time, completed)
+        self.time_budget.save(completed)
+
+    def get_run_history(self):
+        return self.run_history
+
+    def get_time_budget(self):
+        return self.time_budget
+
+    @staticmethod
+    def get_run_window():
+        """
+        Return the number of seconds a run is expected to take at most (ASS_RUN_WINDOW), None when not set.
+        """
+        if os.getenv('ASS_RUN_WINDOW', '') == '':
+            return None
+        return int(os.environ['ASS_RUN_WINDOW'])
+
+    def get_scheduler(self):
+        return Scheduler(self.get_logger(), workers=int(os.getenv('ASS_PHASE_WORKERS', '4')),
+                         profiler=self.get_profiler(), time_budget=self.get_time_budget(),
+                         run_history=self.get_run_history())
+
+    def get_handler_engine(self, notify=None):
+        return HandlerEngine(
+            self.get_logger(),
+            workers=int(os.getenv('ASS_HANDLER_WORKERS', '8')),
+            retries=int(os.getenv('ASS_HANDLER_RETRIES', '3')),
+            min_interval=float(os.getenv('ASS_POLL_MIN_INTERVAL', '5')),
+            max_interval=float(os.getenv('ASS_POLL_MAX_INTERVAL', '30')),
+            timeout=int(os.getenv('ASS_POLL_TIMEOUT', '3600')),
+            run_history=self.get_run_history(),
+            time_budget=self.get_time_budget(),
+            deadlines=self.get_deadlines(),
+            notify=notify
+        )
+
+    @staticmethod
+    def get_deadlines():
+        """
+        Return the deadlines of ASS_DEADLINES, <kind>:<operation>=<seconds> separated by spaces, as a dict with
+        (kind, operation) tuples as keys.
+        """
+        deadlines = dict()
+        for expression in os.getenv('ASS_DEADLINES', '').split():
+            target, separator, seconds = expression.partition('=')
+            kind, _, operation = target.partition(':')
+            if separator == '' or operation == '' or not seconds.isdigit():
+                raise ValueError(f"Invalid deadline {expression}, expected <kind>:<operation>=<seconds>")
+            deadlines[(kind, operation)] = int(seconds)
+        return deadlines
+
+    def get_deadline(self, kind, operation):
+        return self.get_deadlines().get((kind, operation), int(os.getenv('ASS_POLL_TIMEOUT', '3600')))
+
+    def get_daemon(self, runner, inventory=None):
+        return Daemon(
+            self.get_logger(),
+            runner,
+            parse_schedule(os.getenv('ASS_DAEMON_SCHEDULE', '')),
+            host=os.getenv('ASS_DAEMON_HOST', '127.0.0.1'),
+            port=int(os.getenv('ASS_DAEMON_PORT', '8080')),
+            timezone=os.getenv('ASS_DAEMON_TIMEZONE', 'UTC'),
+            inventory=inventory
+        )
+
+    @staticmethod
+    def get_daemon_inventory_max_age():
+        return int(os.getenv('ASS_DAEMON_INVENTORY_MAX_AGE', '300'))
+
+    @staticmethod
+    def get_prefetch_workers():
+        return int(os.getenv('ASS_PREFETCH_WORKERS', '4'))
+
+    @staticmethod
+    def get_cfn_disable_rollback():
+        return os.getenv('ASS_CFN_DISABLE_ROLLBACK', '1') == '1'
+
+    @staticmethod
+    def get_cfn_retry_delay():
+        return int(os.getenv('ASS_CFN_RETRY_DELAY', '30'))
+
+    def get_run_marker(self, aws, state_bucket_name):
+        return RunMarker(
+            self.get_logger(),
+            aws,
+            state_bucket_name,
+            max_age=int(os.getenv('ASS_RUN_MARKER_MAX_AGE', '86400'))
+        )
+
+    def get_stack_poller(self, client):
+        return StackPoller(
+            self.get_logger(),
+            client,
+            min_interval=float(os.getenv('ASS_POLL_MIN_INTERVAL', '5')),
+            max_interval=float(os.getenv('ASS_POLL_MAX_INTERVAL', '30')),
+            timeout=int(os.getenv('ASS_POLL_TIMEOUT', '3600')),
+            check_events=os.getenv('ASS_POLL_STACK_EVENTS', '1') == '1'
+        )
+
     def _set_ass_tag_prefix(self):
         if 'ASS_TAG_PREFIX' in os.environ:
             self.ass_tag_prefix = f"{os.environ['ASS_TAG_PREFIX']}:"
         else:
             self.ass_tag_prefix = ""
 
-    def _init_logger(self, project_name):
-        self.logger = logging.getLogger(project_name)
-        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-        ch = logging.StreamHandler(sys.stdout)
+    def _init_traffic_trace(self):
+        """
+        Record the AWS traffic of the default boto3 session to ASS_TRACE_RECORD, or replay it from ASS_TRACE_REPLAY.
+        This must be done before the first client is created.
+        """
+        if Config.process_traffic_trace is not None:
+            return Config.process_traffic_trace
+        if os.getenv('ASS_TRACE_REPLAY', '') != '':
+            trace = TrafficReplayer(
+                self.get_logger(),
+                os.environ['ASS_TRACE_REPLAY'],
+                latency_scale=float(os.getenv('ASS_REPLAY_LATENCY_SCALE', '1')),
+                faults=parse_faults(os.getenv('ASS_REPLAY_FAULTS', '')),
+                seed=os.getenv('ASS_REPLAY_SEED')
+            )
+            if trace.region is not None:
+                os.environ.setdefault('AWS_DEFAULT_REGION', trace.region)
+            # Requests are still signed, but never sent
+            boto3.setup_default_session(aws_access_key_id='replay', aws_secret_access_key='replay')
+        elif os.getenv('ASS_TRACE_RECORD', '') != '':
+            boto3.setup_default_session()
+            trace = TrafficRecorder(self.get_logger(), os.environ['ASS_TRACE_RECORD'],
+                                    region=boto3.DEFAULT_SESSION.region_name)
+        else:
+            return None
+        trace.register(boto3.DEFAULT_SESSION.events)
+        atexit.register(trace.close)
+        Config.process_traffic_trace = trace
+        return trace
 
+    def _init_logger(self, project_name):
         if 'DEBUG' in os.environ and os.environ['DEBUG'] == '1':
-            self.logger.setLevel(logging.DEBUG)
-            ch.setLevel(logging.DEBUG)
+            level = logging.DEBUG
         else:
-            self.logger.setLevel(logging.INFO)
-            ch.setLevel(logging.INFO)
-
-        ch.setFormatter(formatter)
-        self.logger.addHandler(ch)
+            level = logging.INFO
+        self.logger = configure_logger(project_name, level, os.getenv('ASS_LOG_FORMAT', 'text').lower())
@@ -0,0 +1,245 @@
+import collections
+import datetime
+import json
+import threading
+import time
+import urllib.parse
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from zoneinfo import ZoneInfo
+
+
+class DaemonJob:
+    """
+    A scheduled run: <operation>=[<days>/]<HH:MM>, e.g. stop=mon-fri/19:00 or start=07:00. Days are a comma
+    separated list of days (mon, tue, ...) and day ranges (mon-fri), every day when left out.
+    """
+
+    DAYS = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+
+    def __init__(self, expression):
+        self.expression = expression
+        operation, separator, when = expression.partition('=')
+        if separator == '' or operation not in Daemon.OPERATIONS:
+            raise ValueError(f"Invalid schedule {expression}, expected <stop|start>=[<days>/]<HH:MM>")
+        self.operation = operation
+        days, _, clock = when.rpartition('/')
+        try:
+            hour, minute = (int(value) for value in clock.split(':'))
+            self.time = datetime.time(hour, minute)
+            self.days = self._parse_days(days) if days != '' else set(range(7))
+        except ValueError:
+            raise ValueError(f"Invalid schedule {expression}, expected <stop|start>=[<days>/]<HH:MM>")
+
+    def _parse_days(self, days):
+        result = set()
+        for part in days.lower().split(','):
+            first, _, last = part.partition('-')
+            start = self.DAYS.index(first)
+            end = self.DAYS.index(last) if last != '' else start
+            result.update(day % 7 for day in range(start, end + 1 if end >= start else end + 8))
+        return result
+
+    def next_time(self, after):
+        """
+        Return the first time after the timezone aware datetime after at which the job runs.
+        """
+        candidate = after.replace(hour=self.time.hour, minute=self.time.minute, second=0, microsecond=0)
+        if candidate <= after:
+            candidate += datetime.timedelta(days=1)
+        while candidate.weekday() not in self.days:
+            candidate += datetime.timedelta(days=1)
+        return candidate
+
+
+def parse_schedule(schedule):
+    return [DaemonJob(expression) for expression in schedule.split()]
+
+
+class Daemon:
+    """
+    Runs the stop and start scripts from one long-running process, so the boto3 clients, the account and
+    notification settings and the inventory stay warm between runs. Runs are started by the schedule or by a
+    request to the local HTTP endpoint, one run at a time:
+
+    * POST /run/stop and POST /run/start start a run, with the optional query parameters select (repeatable),
+      time-budget and force. The answer is 202 with the run, or 409 when a run is in progress.
+    * GET /status returns the current run, the last runs and the next scheduled runs as JSON.
+    * GET /metrics returns the run counters, durations and inventory ages in the Prometheus text format.
+
+    runner(operation, arguments) does the run with the command line arguments of the script, it returns False or
+    raises when the run failed.
+    """
+
+    OPERATIONS = ['stop', 'start']
+
+    def __init__(self, logger, runner, jobs, host='127.0.0.1', port=8080, timezone='UTC', inventory=None,
+                 history_size=20):
+        self.logger = logger
+        self.runner = runner
+        self.jobs = jobs
+        self.host = host
+        self.port = port
+        self.timezone = ZoneInfo(timezone)
+        self.inventory = inventory
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.start_time = time.time()
+        self.current = None
+        self.thread = None
+        self.history = collections.deque(maxlen=history_size)
+        self.counts = collections.Counter()
+        self.last_durations = dict()
+        self.next_times = dict()
+        self.server = None
+
+    def trigger(self, operation, arguments=None, trigger='api'):
+        """
+        Start a run in the background and return it, None when a run is in progress.
+        """
+        if operation not in self.OPERATIONS:
+            raise ValueError(f"Unknown operation {operation}")
+        with self.lock:
+            if self.current is not None:
+                self.logger.warning("A %s run is in progress, the %s %s run is not started",
+                                    self.current['operation'], trigger, operation)
+                return None
+            self.current = {'id': uuid.uuid4().hex[:12], 'operation': operation, 'trigger': trigger,
+                            'arguments': arguments or [], 'started': time.time()}
+            self.thread = threading.Thread(target=self._run, args=(self.current,), name=f"ass-{operation}")
+            self.thread.start()
+            return dict(self.current)
+
+    def _run(self, run):
+        self.logger.info("Starting %s run %s (%s)", run['operation'], run['id'], run['trigger'])
+        try:
+            run['result'] = 'failed' if self.runner(run['operation'], run['arguments']) is False else 'completed'
+        except SystemExit as e:
+            run['exit_code'] = e.code
+            run['result'] = 'completed' if e.code in [None, 0] else 'exited'
+        except Exception as e:
+            self.logger.exception("The %s run %s failed", run['operation'], run['id'])
+            run['result'] = 'failed'
+            run['error'] = str(e)
+        run['ended'] = time.time()
+        run['duration'] = run['ended'] - run['started']
+        self.logger.info("Finished %s run %s in %.1f seconds: %s", run['operation'], run['id'], run['duration'],
+                         run['result'])
+        with self.lock:
+            self.history.appendleft(run)
+            self.counts[(run['operation'], run['result'])] += 1
+            self.last_durations[run['operation']] = run['duration']
+            self.current = None
+
+    def get_status(self):
+        with self.lock:
+            return {
+                'running': dict(self.current) if self.current is not None else None,
+                'runs': [dict(run) for run in self.history],
+                'schedule': [{'job': job.expression, 'next': when.isoformat()}
+                             for job, when in self.next_times.items()],
+                'uptime': time.time() - self.start_time
+            }
+
+    def get_metrics(self):
+        with self.lock:
+            lines = ['# TYPE ass_daemon_runs_total counter']
+            lines.extend(f'ass_daemon_runs_total{{operation="{operation}",result="{result}"}} {count}'
+                         for (operation, result), count in sorted(self.counts.items()))
+            lines.append('# TYPE ass_daemon_last_run_duration_seconds gauge')
+            lines.extend(f'ass_daemon_last_run_duration_seconds{{operation="{operation}"}} {duration:.3f}'
+                         for operation, duration in sorted(self.last_durations.items()))
+            lines.append('# TYPE ass_daemon_running gauge')
+            lines.append(f'ass_daemon_running {0 if self.current is None else 1}')
+            lines.append('# TYPE ass_daemon_next_run_timestamp_seconds gauge')
+            lines.extend(f'ass_daemon_next_run_timestamp_seconds{{job="{job.expression}"}} {when.timestamp():.0f}'
+                         for job, when in self.next_times.items())
+        if self.inventory is not None:
+            lines.append('# TYPE ass_daemon_inventory_age_seconds gauge')
+            lines.extend(f'ass_daemon_inventory_age_seconds{{section="{section}"}} {age:.0f}'
+                         for section, age in sorted(self.inventory.get_ages().items()))
+        lines.append('# TYPE ass_daemon_uptime_seconds gauge')
+        lines.append(f'ass_daemon_uptime_seconds {time.time() - self.start_time:.0f}')
+        return '\n'.join(lines) + '\n'
+
+    def _get_handler(self):
+        daemon = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _send(self, status, body, content_type='application/json'):
+                data = (json.dumps(body, default=str) if content_type == 'application/json' else body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                path = urllib.parse.urlsplit(self.path).path
+                if path == '/status':
+                    self._send(200, daemon.get_status())
+                elif path == '/metrics':
+                    self._send(200, daemon.get_metrics(), 'text/plain; version=0.0.4')
+                else:
+                    self._send(404, {'error': f"Unknown path {path}"})
+
+            def do_POST(self):
+                url = urllib.parse.urlsplit(self.path)
+                operation = url.path[len('/run/'):] if url.path.startswith('/run/') else None
+                if operation not in Daemon.OPERATIONS:
+                    self._send(404, {'error': f"Unknown path {url.path}"})
+                    return
+                query = urllib.parse.parse_qs(url.query)
+                arguments = [argument for expression in query.get('select', [])
+                             for argument in ['--select', expression]]
+                if 'time-budget' in query:
+                    arguments.extend(['--time-budget', query['time-budget'][0]])
+                if query.get('force', ['0'])[0] in ['1', 'true', 'yes']:
+                    arguments.append('--force')
+                run = daemon.trigger(operation, arguments)
+                if run is None:
+                    self._send(409, {'error': 'A run is in progress', 'running': daemon.get_status()['running']})
+                else:
+                    self._send(202, run)
+
+            def log_message(self, format, *args):
+                daemon.logger.debug("%s - %s", self.address_string(), format % args)
+
+        return Handler
+
+    def serve_forever(self):
+        """
+        Serve the HTTP endpoint and start the scheduled runs until shutdown() is called, then wait for the run in
+        progress.
+        """
+        self.server = ThreadingHTTPServer((self.host, self.port), self._get_handler())
+        threading.Thread(target=self.server.serve_forever, name='ass-http', daemon=True).start()
+        self.logger.info("Listening on http://%s:%s", self.host, self.port)
+
+        now = datetime.datetime.now(self.timezone)
+        with self.lock:
+            self.next_times = {job: job.next_time(now) for job in self.jobs}
+        for job, when in self.next_times.items():
+            self.logger.info("Next %s run at %s", job.operation, when.isoformat())
+
+        while not self.stopping.is_set():
+            now = datetime.datetime.now(self.timezone)
+            for job, when in list(self.next_times.items()):
+                if when <= now:
+                    self.trigger(job.operation, trigger='schedule')
+                    with self.lock:
+                        self.next_times[job] = job.next_time(now)
+                    self.logger.info("Next %s run at %s", job.operation, self.next_times[job].isoformat())
+            wait = min([(when - now).total_seconds() for when in self.next_times.values()] + [60])
+            self.stopping.wait(max(wait, 0.1))
+
+        self.server.shutdown()
+        self.server.server_close()
+        thread = self.thread
+        if thread is not None and thread.is_alive():
+            self.logger.info("Waiting for the run in progress to finish")
+            thread.join()
+
+    def shutdown(self):
+        self.logger.info("Shutting down")
+        self.stopping.set()
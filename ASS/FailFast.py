@@ -0,0 +1,38 @@
+import threading
+
+
+class LevelFailed(Exception):
+    """
+    Raised when the work of a level failed after the failure was notified, callers do not notify again.
+    """
+
+
+class FailFast:
+    """
+    Shared by the work of one level: the first unrecoverable failure is notified right away, once, and the work of
+    the level that has not started yet is not started anymore. Work in flight is left to finish.
+    """
+
+    def __init__(self, logger, notify=None):
+        self.logger = logger
+        self.notify = notify
+        self.failures = []
+        self.lock = threading.Lock()
+
+    def fail(self, name, reason):
+        with self.lock:
+            self.failures.append((name, reason))
+            first = len(self.failures) == 1
+        if first:
+            self.logger.error("%s failed, the work of this level that did not start yet is cancelled: %s", name,
+                              reason)
+            if self.notify is not None:
+                self.notify(f"{name} failed: {reason}")
+
+    def is_failed(self):
+        with self.lock:
+            return len(self.failures) > 0
+
+    def get_summary(self):
+        with self.lock:
+            return '; '.join(f"{name}: {reason}" for name, reason in self.failures)
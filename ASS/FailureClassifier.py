@@ -0,0 +1,71 @@
+import re
+
+
+class FailureClassifier:
+    """
+    Classifies the failure reasons of a stack operation (the *_FAILED stack events reported by the StackPoller) as
+    permanent or retryable. A retry cannot fix a permanent failure (an invalid template or parameter, missing
+    permissions, a name that is taken), retryable failures are transient (throttling, a dependency that is not
+    ready yet, a timeout). Unknown reasons are retryable, as all failures were before.
+
+    Events of resources that were only cancelled because another resource failed are ignored.
+    """
+
+    IGNORED_PATTERNS = [
+        r'Resource creation cancelled',
+        r'Resource update cancelled',
+        r'The following resource\(s\) failed to',
+    ]
+    PERMANENT_PATTERNS = [
+        r'Template format error',
+        r'Template error',
+        r'Parameter validation failed',
+        r'Parameters: \[.*\] must have values',
+        r'ValidationError',
+        r'Invalid request provided',
+        r'InvalidParameter',
+        r'Malformed',
+        r'already exists',
+        r'AccessDenied',
+        r'not authorized to perform',
+        r'UnauthorizedOperation',
+        r'LimitExceeded',
+        r'exceeded the maximum number',
+        r'Requires capabilities',
+        r'No updates are to be performed',
+    ]
+    RETRYABLE_PATTERNS = [
+        r'Throttling',
+        r'Rate exceeded',
+        r'timed? ?out',
+        r'did not stabilize',
+        r'not (yet )?(ready|available|in available state)',
+        r'is currently (being )?(modified|in use|updating)',
+        r'Conflict',
+        r'InternalFailure',
+        r'Internal ?Error',
+        r'ServiceUnavailable',
+        r'try again',
+    ]
+
+    def __init__(self):
+        self.ignored = re.compile('|'.join(self.IGNORED_PATTERNS), re.IGNORECASE)
+        self.permanent = re.compile('|'.join(self.PERMANENT_PATTERNS), re.IGNORECASE)
+        self.retryable = re.compile('|'.join(self.RETRYABLE_PATTERNS), re.IGNORECASE)
+
+    def get_causes(self, reasons):
+        """
+        Return the reasons that caused the failure, without the cancelled resources. All reasons are returned when
+        every reason is a cancellation.
+        """
+        causes = [reason for reason in reasons if not self.ignored.search(reason)]
+        return causes if len(causes) > 0 else list(reasons)
+
+    def is_permanent_cause(self, cause):
+        return self.permanent.search(cause) is not None and self.retryable.search(cause) is None
+
+    def is_permanent(self, reasons):
+        """
+        Return True when one of the causes of the failure is permanent.
+        """
+        return any(self.is_permanent_cause(cause) for cause in self.get_causes(reasons))
@@ -0,0 +1,204 @@
+import contextlib
+import itertools
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from botocore.exceptions import ClientError
+from .FailFast import FailFast, LevelFailed
+from .LogPipeline import log_context
+from .TimeBudget import TimeBudgetExhausted
+
+
+class HandlerEngine:
+    """
+    Runs a ResourceHandler the same way for every resource type:
+
+    * ordering: the resources are handled per order level, within a level the resources with the lowest priority
+      and then the resources that took longest in the previous runs (RunHistory) are started first
+    * concurrency: up to workers resources of a level are acted on at the same time, after which the level is
+      polled until every resource is done
+    * retries: calls that fail with a throttling or a transient server error are retried with exponential backoff,
+      resources whose operation failed with an error the handler can retry are retried together after a back-off
+    * checkpointing: every level is a unit of the TimeBudget
+    * metrics: the duration of every resource is recorded in the RunHistory and a summary is logged
+    * deadlines: a level is polled for at most the deadline of the resource kind and operation, timeout otherwise
+
+    A handler may run a resource as a TimeBudget unit in act: when the budget is exhausted, the resources that were
+    started are polled until they are done and TimeBudgetExhausted is raised, without a notification.
+
+    When a resource fails, notify is called right away, the resources of its level that were not started yet are
+    not started anymore, the resources that were started are polled until they are done and LevelFailed is raised.
+    """
+
+    RETRYABLE_CODES = ['Throttling', 'ThrottlingException', 'RequestLimitExceeded', 'TooManyRequestsException',
+                       'SlowDown', 'InternalFailure', 'InternalError', 'ServiceUnavailable']
+
+    def __init__(self, logger, workers=8, retries=3, retry_delay=2, min_interval=5, max_interval=30, backoff=1.5,
+                 timeout=3600, run_history=None, time_budget=None, deadlines=None, notify=None):
+        self.logger = logger
+        self.workers = max(workers, 1)
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.min_interval = min_interval
+        self.max_interval = max(max_interval, min_interval)
+        self.backoff = backoff
+        self.timeout = timeout
+        self.run_history = run_history
+        self.time_budget = time_budget
+        self.deadlines = deadlines or dict()
+        self.notify = notify
+
+    def call(self, function, *args):
+        """
+        Call function, retrying throttling and transient server errors.
+        """
+        for attempt in itertools.count():
+            try:
+                return function(*args)
+            except ClientError as e:
+                if e.response['Error']['Code'] not in self.RETRYABLE_CODES or attempt >= self.retries:
+                    raise
+                delay = self.retry_delay * 2 ** attempt
+                self.logger.warning("%s, retrying in %s seconds", e.response['Error']['Code'], delay)
+                time.sleep(delay)
+
+    def _get_estimate(self, handler, resource):
+        if self.run_history is None:
+            return 0
+        return self.run_history.get_estimate(handler.get_history_kind(), resource.name)
+
+    def get_deadline(self, handler):
+        return self.deadlines.get((handler.kind, handler.operation), self.timeout)
+
+    def _level(self, handler, order):
+        if self.time_budget is None:
+            return contextlib.nullcontext()
+        return self.time_budget.unit(f"{handler.get_history_kind()}-level", order)
+
+    def _is_level_finished(self, handler, order):
+        return self.time_budget is not None and \
+            self.time_budget.is_unit_finished(f"{handler.get_history_kind()}-level", order)
+
+    def run(self, handler):
+        """
+        Discover and handle all resources of handler, return a dict with the duration of every resource.
+        """
+        start_time = time.time()
+        resources = [resource for resource in self.call(handler.discover)
+                     if self.call(handler.restore_state, resource)]
+        self.logger.info("Found %s %s resources to %s", len(resources), handler.kind, handler.operation)
+
+        ordered = sorted(resources, key=lambda r: r.order, reverse=handler.reverse_order)
+        for order, level in itertools.groupby(ordered, key=lambda r: r.order):
+            level = list(level)
+            if self._is_level_finished(handler, order):
+                self.call(handler.level_started, level)
+                continue
+            with self._level(handler, order):
+                self._run_level(handler, level, FailFast(self.logger, self.notify))
+
+        durations = {resource.name: resource.duration() for resource in resources if resource.end_time is not None}
+        if self.run_history is not None:
+            self.run_history.record_all(handler.get_history_kind(), durations)
+        self.logger.info("Finished the %s of %s %s resources in %.1f seconds", handler.operation, len(resources),
+                         handler.kind, time.time() - start_time)
+        return durations
+
+    def _act(self, handler, resource, fail_fast):
+        if fail_fast.is_failed():
+            self.logger.info("Not starting the %s of %s %s, another resource of its level failed", handler.operation,
+                             handler.kind, resource.name)
+            return False
+        try:
+            with log_context(resource=resource.name):
+                self.call(handler.save_state, resource)
+                resource.start_time = time.time()
+                self.call(handler.act, resource)
+        except TimeBudgetExhausted:
+            # Not a failure, the resources that were not started are handled by the next invocation
+            raise
+        except Exception as e:
+            # Failed in the worker, so the next resource it picks up is not started anymore
+            fail_fast.fail(f"The {handler.operation} of {handler.kind} {resource.name}", e)
+            raise
+        return True
+
+    def _run_level(self, handler, resources, fail_fast):
+        resources = sorted(resources, key=lambda r: (handler.get_priority(r), -self._get_estimate(handler, r)))
+        error = None
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(self._act, handler, resource, fail_fast): resource for resource in resources}
+            started = []
+            for future in as_completed(futures):
+                if future.cancelled():
+                    continue
+                try:
+                    if future.result():
+                        started.append(futures[future])
+                except Exception as e:
+                    error = error or e
+                    for other in futures:
+                        other.cancel()
+
+        try:
+            self.call(handler.level_started, resources)
+            failed = self._wait(handler, started, fail_fast)
+            while len(failed) > 0 and not fail_fast.is_failed():
+                failed = self._retry(handler, [resource for resource, _ in failed], fail_fast)
+            for resource, e in failed:
+                fail_fast.fail(f"The {handler.operation} of {handler.kind} {resource.name}", e)
+        except Exception as e:
+            fail_fast.fail(f"The {handler.operation} of {handler.kind}", e)
+            error = error or e
+        if fail_fast.is_failed():
+            raise LevelFailed(fail_fast.get_summary()) from error
+        if isinstance(error, TimeBudgetExhausted):
+            raise error
+
+    def _retry(self, handler, resources, fail_fast):
+        delay = handler.retry_delay * 2 ** (resources[0].attempt - 1)
+        self.logger.warning("The %s of %s %s failed with a retryable error, retrying in %s seconds", handler.operation,
+                            handler.kind, ', '.join(resource.name for resource in resources), delay)
+        time.sleep(delay)
+        for resource in resources:
+            resource.attempt += 1
+        self.call(handler.retry, resources)
+        return self._wait(handler, resources, fail_fast)
+
+    def _wait(self, handler, resources, fail_fast):
+        """
+        Poll resources until they are done, return the (resource, error) tuples of the resources that failed with
+        an error the handler can retry.
+        """
+        pending = list(resources)
+        failed = []
+        interval = self.min_interval
+        start_time = time.time()
+        deadline = self.get_deadline(handler)
+        while True:
+            if len(pending) > 0:
+                self.call(handler.refresh, pending)
+            for resource in list(pending):
+                try:
+                    done = handler.is_done(resource)
+                except Exception as e:
+                    # The other resources of the level are still polled until they are done
+                    pending.remove(resource)
+                    if resource.attempt < handler.attempts and handler.is_retryable(resource, e):
+                        failed.append((resource, e))
+                    else:
+                        fail_fast.fail(f"The {handler.operation} of {handler.kind} {resource.name}", e)
+                    continue
+                if done:
+                    resource.end_time = time.time()
+                    pending.remove(resource)
+            if len(pending) == 0:
+                return failed
+            if time.time() - start_time > deadline:
+                for resource in pending:
+                    fail_fast.fail(f"The {handler.operation} of {handler.kind} {resource.name}",
+                                   f"not finished within the deadline of {deadline} seconds")
+                return failed
+            self.logger.debug("Waiting %s seconds for the %s of %s", interval, handler.operation,
+                              ', '.join(resource.name for resource in pending))
+            time.sleep(interval)
+            interval = min(interval * self.backoff, self.max_interval)
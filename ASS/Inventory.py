@@ -0,0 +1,394 @@
+import datetime
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+
+
+class Inventory:
+    """
+    In-memory snapshot of the account resources used by the stop and start scripts.
+
+    discover() fetches the requested sections concurrently, later reads are served from the snapshot.
+    Code that creates, deletes, starts or stops resources calls the matching invalidate_* method, so the
+    next read of that entry goes to AWS again. Sections that were not discovered are fetched on first use.
+
+    With a Selector, the selection is pushed down into the discovery calls: stacks are described by name and tagged
+    resources are looked up with the Resource Groups Tagging API instead of listing everything. The snapshot file
+    is not used for a selection.
+
+    The snapshot file holds one snapshot per operation, so a start never reuses the snapshot taken before a stop.
+    It is saved again after every invalidation without the invalidated sections. A stack can own resources of
+    every section, so invalidating a stack keeps the sections of STACK_SECTIONS and the bucket tags out of the file.
+
+    A section that is not in the snapshot is fetched outside the lock by the first thread that needs it, other threads
+    wait for that fetch. A fetch that was in flight when its section was invalidated is not kept.
+
+    A long-running process calls begin_run() before every run: the sections and bucket tags older than max_age
+    are dropped, so discover() only fetches what is stale and the tags of the buckets that are new.
+    """
+
+    SECTIONS = ['s3', 'elbv2', 'cloudfront', 'cloudformation', 'elasticbeanstalk', 'elasticbeanstalk_terminated',
+                'rds_instances', 'rds_clusters']
+    STACK_SECTIONS = ['s3', 'elbv2', 'cloudfront', 'cloudformation', 'elasticbeanstalk', 'rds_instances',
+                      'rds_clusters']
+
+    def __init__(self, logger, aws, path=None, max_age=0):
+        self.logger = logger
+        self.aws = aws
+        self.path = path
+        self.max_age = max_age
+        self.lock = threading.RLock()
+        self.snapshot = dict()
+        self.fetched_at = dict()
+        self.bucket_tags = dict()
+        self.bucket_tags_fetched_at = dict()
+        self.emptied_buckets = set()
+        self.stale_stacks = set()
+        self.invalidated = set()
+        # Section -> Event of the fetch in flight, set when the fetch finished
+        self.fetching = dict()
+        self.selector = None
+        self.operation = None
+
+    def set_selector(self, selector):
+        self.selector = selector if selector is not None and not selector.is_empty() else None
+
+    def begin_run(self, max_age):
+        """
+        Forget the state of the previous run, the sections it invalidated and the sections and bucket tags fetched
+        more than max_age seconds ago. A snapshot of a selection is forgotten entirely.
+        """
+        with self.lock:
+            now = time.time()
+            if self.selector is not None:
+                self.fetched_at.clear()
+                self.bucket_tags_fetched_at.clear()
+            for section in self.invalidated:
+                self.fetched_at.pop(section, None)
+            if 's3' in self.invalidated:
+                self.bucket_tags_fetched_at.clear()
+            for section in [section for section in self.snapshot if now - self.fetched_at.get(section, 0) > max_age]:
+                self.snapshot.pop(section)
+                self.fetched_at.pop(section, None)
+            for bucket_name in [bucket_name for bucket_name in self.bucket_tags
+                                if now - self.bucket_tags_fetched_at.get(bucket_name, 0) > max_age]:
+                self.bucket_tags.pop(bucket_name)
+                self.bucket_tags_fetched_at.pop(bucket_name, None)
+            self.emptied_buckets.clear()
+            self.stale_stacks.clear()
+            self.invalidated.clear()
+            self.selector = None
+
+    def get_ages(self):
+        """
+        Return the age in seconds of every section in the snapshot.
+        """
+        with self.lock:
+            now = time.time()
+            return {section: now - self.fetched_at.get(section, now) for section in self.snapshot}
+
+    def discover(self, sections=None, workers=8, operation=None):
+        """
+        Fetch sections (default: all) concurrently. operation (stop or start) selects the snapshot in the file.
+        """
+        sections = sections if sections is not None else self.SECTIONS
+        self.operation = operation
+        if self._load():
+            sections = [section for section in sections if section not in self.snapshot]
+        if len(sections) == 0:
+            return
+
+        self.logger.info("Start discovery of %s", ', '.join(sections))
+        start_time = time.time()
+        # boto3 client creation is not thread safe, create the clients before starting the workers
+        for section in sections:
+            self._client(section)
+        if self.selector is not None:
+            self.aws.get_boto3_client('resourcegroupstaggingapi')
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {section: executor.submit(self._fetch, section) for section in sections}
+            results = {section: future.result() for section, future in futures.items()}
+            with self.lock:
+                self.snapshot.update(results)
+                self.fetched_at.update({section: time.time() for section in results})
+            if 's3' in results:
+                bucket_names = [bucket['Name'] for bucket in results['s3'] if bucket['Name'] not in self.bucket_tags]
+                for bucket_name, tags in zip(bucket_names, executor.map(self._fetch_bucket_tags, bucket_names)):
+                    self.bucket_tags[bucket_name] = tags
+                    self.bucket_tags_fetched_at[bucket_name] = time.time()
+
+        self.logger.info("Finished discovery in %.1f seconds", time.time() - start_time)
+        self._save()
+
+    def _client(self, section):
+        service = {
+            'elasticbeanstalk_terminated': 'elasticbeanstalk',
+            'rds_instances': 'rds',
+            'rds_clusters': 'rds'
+        }.get(section, section)
+        return self.aws.get_boto3_client(service)
+
+    def _paginate(self, section, operation, result_key, **kwargs):
+        result = []
+        for page in self._client(section).get_paginator(operation).paginate(**kwargs):
+            result.extend(page.get(result_key, []))
+        return result
+
+    def _get_tagged_arns(self, resource_type):
+        """
+        Return the ARNs of the resources of resource_type (e.g. rds:db) with the selected tags.
+        """
+        arns = []
+        paginator = self.aws.get_boto3_client('resourcegroupstaggingapi').get_paginator('get_resources')
+        for page in paginator.paginate(TagFilters=self.selector.get_tag_filters(), ResourceTypeFilters=[resource_type]):
+            arns.extend(resource['ResourceARN'] for resource in page['ResourceTagMappingList'])
+        return arns
+
+    def _describe_by_filter(self, section, operation, result_key, filter_name, arns):
+        result = []
+        # Filters accept up to 100 values
+        for start in range(0, len(arns), 100):
+            result.extend(self._paginate(section, operation, result_key,
+                                         Filters=[{'Name': filter_name, 'Values': arns[start:start + 100]}]))
+        return result
+
+    def _fetch_selected_stacks(self):
+        if self.selector.has_tags():
+            # arn:aws:cloudformation:<region>:<account>:stack/<name>/<id>
+            stack_names = [arn.split(':', 5)[5].split('/')[1] for arn in self._get_tagged_arns('cloudformation:stack')]
+        else:
+            stack_names = [summary['StackName'] for summary in self._paginate(
+                'cloudformation', 'list_stacks', 'StackSummaries')
+                if summary['StackStatus'] != 'DELETE_COMPLETE']
+        stacks = []
+        for stack_name in stack_names:
+            if not self.selector.matches_stack_name(stack_name):
+                continue
+            try:
+                stack = self._client('cloudformation').describe_stacks(StackName=stack_name)['Stacks'][0]
+            except ClientError:
+                continue
+            if self.selector.matches_tags(stack.get('Tags', [])):
+                stacks.append(stack)
+        return stacks
+
+    def _fetch_selected(self, section):
+        """
+        Return the selected resources of section, or None when the section cannot be narrowed by the selector.
+        """
+        if section == 'cloudformation':
+            return self._fetch_selected_stacks()
+        if not self.selector.has_tags():
+            return None
+        if section == 's3':
+            return [{'Name': arn.split(':::', 1)[1]} for arn in self._get_tagged_arns('s3')]
+        elif section == 'rds_instances':
+            return self._describe_by_filter(section, 'describe_db_instances', 'DBInstances', 'db-instance-id',
+                                            self._get_tagged_arns('rds:db'))
+        elif section == 'rds_clusters':
+            return self._describe_by_filter(section, 'describe_db_clusters', 'DBClusters', 'db-cluster-id',
+                                            self._get_tagged_arns('rds:cluster'))
+        elif section == 'elasticbeanstalk':
+            # arn:aws:elasticbeanstalk:<region>:<account>:environment/<application>/<name>
+            environment_names = [arn.rsplit('/', 1)[1] for arn in self._get_tagged_arns('elasticbeanstalk:environment')]
+            if len(environment_names) == 0:
+                return []
+            return self._client(section).describe_environments(EnvironmentNames=environment_names)['Environments']
+        return None
+
+    def _fetch(self, section):
+        self.logger.debug("Fetching inventory section %s", section)
+        if self.selector is not None:
+            selected = self._fetch_selected(section)
+            if selected is not None:
+                self.logger.info("Selected %s resources in inventory section %s", len(selected), section)
+                return selected
+        if section == 's3':
+            return self._client(section).list_buckets()['Buckets']
+        elif section == 'elbv2':
+            return self._paginate(section, 'describe_load_balancers', 'LoadBalancers')
+        elif section == 'cloudfront':
+            result = []
+            for page in self._client(section).get_paginator('list_distributions').paginate():
+                result.extend(page['DistributionList'].get('Items', []))
+            return result
+        elif section == 'cloudformation':
+            return self._paginate(section, 'describe_stacks', 'Stacks')
+        elif section == 'elasticbeanstalk':
+            return self._client(section).describe_environments()['Environments']
+        elif section == 'elasticbeanstalk_terminated':
+            return [environment for environment in self._client(section).describe_environments(
+                IncludeDeleted=True, IncludedDeletedBackTo=datetime.datetime(2015, 1, 1)
+            )['Environments'] if environment['Status'] == 'Terminated']
+        elif section == 'rds_instances':
+            return self._paginate(section, 'describe_db_instances', 'DBInstances')
+        elif section == 'rds_clusters':
+            return self._paginate(section, 'describe_db_clusters', 'DBClusters')
+        else:
+            raise ValueError(f"Unknown inventory section {section}")
+
+    def _fetch_bucket_tags(self, bucket_name):
+        try:
+            return self._client('s3').get_bucket_tagging(Bucket=bucket_name)['TagSet']
+        except ClientError:
+            return []
+
+    def get(self, section):
+        while True:
+            with self.lock:
+                if section in self.snapshot:
+                    return self.snapshot[section]
+                fetching = self.fetching.get(section)
+                if fetching is None:
+                    fetching = self.fetching[section] = threading.Event()
+                    break
+            # When the other fetch failed or was invalidated, the section is fetched again
+            fetching.wait()
+
+        try:
+            result = self._fetch(section)
+            with self.lock:
+                if self.fetching.get(section) is fetching:
+                    self.snapshot[section] = result
+                    self.fetched_at[section] = time.time()
+            return result
+        finally:
+            with self.lock:
+                if self.fetching.get(section) is fetching:
+                    self.fetching.pop(section)
+            fetching.set()
+
+    def invalidate(self, section):
+        with self.lock:
+            self.fetching.pop(section, None)
+            self.snapshot.pop(section, None)
+            self.fetched_at.pop(section, None)
+            self.invalidated.add(section)
+            self._save()
+
+    def get_buckets(self):
+        return self.get('s3')
+
+    def bucket_exists(self, bucket_name):
+        if any(bucket['Name'] == bucket_name for bucket in self.get_buckets()):
+            return True
+        if self.selector is None:
+            return False
+        # A selection only holds the selected buckets
+        try:
+            self._client('s3').head_bucket(Bucket=bucket_name)
+        except ClientError:
+            return False
+        return True
+
+    def add_bucket(self, bucket_name):
+        exists = self.bucket_exists(bucket_name)
+        with self.lock:
+            # Not in the snapshot when it was invalidated meanwhile, the next fetch finds the bucket
+            if not exists and 's3' in self.snapshot:
+                self.snapshot['s3'].append({'Name': bucket_name})
+            self.bucket_tags[bucket_name] = []
+
+    def remove_bucket(self, bucket_name):
+        with self.lock:
+            self.fetching.pop('s3', None)
+            if 's3' in self.snapshot:
+                self.snapshot['s3'] = [bucket for bucket in self.snapshot['s3'] if bucket['Name'] != bucket_name]
+            self.bucket_tags.pop(bucket_name, None)
+
+    def get_bucket_tags(self, bucket_name):
+        with self.lock:
+            if bucket_name in self.bucket_tags:
+                return self.bucket_tags[bucket_name]
+        tags = self._fetch_bucket_tags(bucket_name)
+        with self.lock:
+            if bucket_name not in self.bucket_tags:
+                self.bucket_tags[bucket_name] = tags
+                self.bucket_tags_fetched_at[bucket_name] = time.time()
+            return self.bucket_tags[bucket_name]
+
+    def claim_bucket_emptying(self, bucket_name):
+        """
+        Return True the first time a bucket is claimed for emptying in this run, False afterwards, so a bucket
+        that is both a log bucket and tagged for cleaning is emptied only once.
+        """
+        with self.lock:
+            if bucket_name in self.emptied_buckets:
+                self.logger.info("Bucket %s was already emptied in this run, skipping", bucket_name)
+                return False
+            self.emptied_buckets.add(bucket_name)
+            return True
+
+    def get_stack(self, stack_name):
+        """
+        Return the live stack with name stack_name, or None. Invalidated stacks are described individually.
+        """
+        stacks = self.get('cloudformation')
+        with self.lock:
+            for stack in stacks:
+                if stack['StackName'] == stack_name:
+                    return stack
+            if stack_name not in self.stale_stacks:
+                return None
+        try:
+            stack = self._client('cloudformation').describe_stacks(StackName=stack_name)['Stacks'][0]
+        except ClientError:
+            return None
+        with self.lock:
+            self.stale_stacks.discard(stack_name)
+            if 'cloudformation' in self.snapshot:
+                self.snapshot['cloudformation'].append(stack)
+        return stack
+
+    def invalidate_stack(self, stack_name):
+        with self.lock:
+            # A listing in flight may hold the stack as it was before
+            self.fetching.pop('cloudformation', None)
+            if 'cloudformation' in self.snapshot:
+                self.snapshot['cloudformation'] = [stack for stack in self.snapshot['cloudformation']
+                                                   if stack['StackName'] != stack_name]
+            self.stale_stacks.add(stack_name)
+            self.invalidated.update(self.STACK_SECTIONS)
+            self._save()
+
+    def _read(self):
+        if not os.path.exists(self.path):
+            return dict()
+        with open(self.path) as snapshot_file:
+            return json.load(snapshot_file)
+
+    def _load(self):
+        if self.selector is not None or not self.path or self.max_age <= 0:
+            return False
+        saved = self._read().get(self.operation or '')
+        if saved is None or time.time() - saved['saved_at'] > self.max_age:
+            return False
+        with self.lock:
+            self.snapshot.update(saved['snapshot'])
+            self.bucket_tags.update(saved['bucket_tags'])
+            self.fetched_at.update({section: saved['saved_at'] for section in saved['snapshot']})
+            self.bucket_tags_fetched_at.update({bucket_name: saved['saved_at'] for bucket_name in saved['bucket_tags']})
+        self.logger.info("Inventory snapshot of %s loaded from %s", self.operation, self.path)
+        return True
+
+    def _save(self):
+        """
+        Save the snapshot of this operation without the sections invalidated in this run.
+        """
+        if self.selector is not None or not self.path:
+            return
+        with self.lock:
+            saved = self._read()
+            saved[self.operation or ''] = {
+                'saved_at': time.time(),
+                'snapshot': {section: items for section, items in self.snapshot.items()
+                             if section not in self.invalidated},
+                'bucket_tags': self.bucket_tags if 's3' not in self.invalidated else dict()
+            }
+            with open(self.path, 'w') as snapshot_file:
+                json.dump(saved, snapshot_file, default=str)
+        self.logger.debug("Inventory snapshot of %s saved to %s", self.operation, self.path)
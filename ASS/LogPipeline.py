@@ -0,0 +1,127 @@
+import atexit
+import contextlib
+import contextvars
+import copy
+import datetime
+import json
+import logging
+import queue
+import sys
+import threading
+from logging.handlers import QueueHandler, QueueListener
+
+_context = contextvars.ContextVar('ass_log_context', default=dict())
+_listeners = dict()
+_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def log_context(**fields):
+    """
+    Add fields (e.g. stack=..., bucket=...) to every record logged by the current thread or task within the block.
+    The fields are part of the JSON output, the text output is unchanged.
+    """
+    token = _context.set({**_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+class ContextFilter(logging.Filter):
+    """
+    Copies the fields of the active log_context to the record. It runs in the thread that logs, before the record
+    is put on the queue.
+    """
+
+    def filter(self, record):
+        record.context = _context.get()
+        return True
+
+
+class RecordQueueHandler(QueueHandler):
+    """
+    Puts a copy of the record on the queue without formatting it: QueueHandler.prepare formats the record and drops
+    exc_info, so the listener would get the traceback as part of the message. Only the message arguments are merged
+    here, the formatter of the listener formats the rest, the exception included.
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        document = {
+            'time': datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(),
+            'logger': record.name,
+            'level': record.levelname,
+            'message': record.getMessage(),
+        }
+        document.update(getattr(record, 'context', dict()))
+        if record.exc_info:
+            document['exception'] = self.formatException(record.exc_info)
+        return json.dumps(document, default=str)
+
+
+class LogSampler:
+    """
+    Logs the first and then every rate-th message, for messages that would otherwise be logged once per object.
+    The number of messages seen so far is appended to every message that is logged.
+    """
+
+    def __init__(self, logger, rate=1000):
+        self.logger = logger
+        self.rate = max(rate, 1)
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def log(self, level, msg, *args):
+        with self.lock:
+            self.count += 1
+            count = self.count
+        if (count - 1) % self.rate == 0 and self.logger.isEnabledFor(level):
+            self.logger.log(level, msg + " (%s so far)", *args, count)
+
+    def debug(self, msg, *args):
+        self.log(logging.DEBUG, msg, *args)
+
+    def info(self, msg, *args):
+        self.log(logging.INFO, msg, *args)
+
+
+def configure_logger(name, level, log_format='text'):
+    """
+    Send the records of logger name through a queue to a listener thread that formats and writes them to stdout,
+    so logging never blocks the worker threads on I/O. Calling it again for the same logger only changes the level.
+    """
+    logger = logging.getLogger(name)
+    logger.setLevel(level)
+    with _lock:
+        if name in _listeners:
+            _listeners[name].handlers[0].setLevel(level)
+            return logger
+
+        if log_format == 'json':
+            formatter = JsonFormatter()
+        else:
+            formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+        stream_handler = logging.StreamHandler(sys.stdout)
+        stream_handler.setLevel(level)
+        stream_handler.setFormatter(formatter)
+
+        log_queue = queue.SimpleQueue()
+        queue_handler = RecordQueueHandler(log_queue)
+        queue_handler.addFilter(ContextFilter())
+        logger.addHandler(queue_handler)
+
+        listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+        listener.start()
+        # Registered after logging itself, so it runs before logging.shutdown at exit and drains the queue
+        atexit.register(listener.stop)
+        _listeners[name] = listener
+    return logger
+
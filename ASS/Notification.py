@@ -1,6 +1,4 @@
 import os
-from httplib2 import Http
-from jira import JIRA
 from json import dumps
 
 
@@ -8,6 +6,9 @@ class Notification:
 
     @staticmethod
     def post_message_to_google_chat(summary: str, description: str):
+        # httplib2 and jira are only imported when a notification is sent, they slow down every start otherwise
+        from httplib2 import Http
+
         message_headers = {'Content-Type': 'application/json; charset=UTF-8'}
         chat_url = os.getenv('CHATURL')
 
@@ -24,6 +25,7 @@ class Notification:
 
     @staticmethod
     def create_jira_ticket(summary: str, description: str):
+        from jira import JIRA
 
         jira_url = os.getenv('JIRA_URL')
         jira_user = os.getenv('JIRA_USER')
@@ -0,0 +1,142 @@
+import cProfile
+import collections
+import io
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+import tracemalloc
+
+
+class Profiler:
+    """
+    Profiles the top-level phases of a script, selected with ASS_PROFILE:
+
+    * cpu: cProfile of the thread that runs the phase and the threads it starts, merged into <phase>.pstats
+    * mem: tracemalloc allocations made during the phase, written as <phase>.tracemalloc
+    * wall: stacks of all threads sampled every interval seconds, written as <phase>.collapsed (the collapsed stack
+      format of flamegraph.pl and speedscope)
+
+    A summary of the top entries of every phase is logged when the phase ends. mem and wall see the whole process,
+    the Scheduler runs the phases one at a time when they are profiled.
+    """
+
+    MODES = ['cpu', 'mem', 'wall']
+
+    def __init__(self, logger, mode, output_dir='.', top=20, interval=0.01):
+        if mode not in self.MODES:
+            raise ValueError(f"ASS_PROFILE must be one of {', '.join(self.MODES)}, not {mode}")
+        self.logger = logger
+        self.mode = mode
+        self.output_dir = output_dir
+        self.top = top
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.tracing_phases = 0
+
+    def get_path(self, phase_name, extension):
+        os.makedirs(self.output_dir, exist_ok=True)
+        return os.path.join(self.output_dir, f"{re.sub(r'[^A-Za-z0-9_.-]', '_', phase_name)}.{extension}")
+
+    def run(self, phase_name, function):
+        return getattr(self, f"_run_{self.mode}")(phase_name, function)
+
+    def _run_cpu(self, phase_name, function):
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Python 3.12 and later allow only one active profiler per process
+            self.logger.warning("Phase %s is not profiled, another profiler is active", phase_name)
+            return function()
+        profiles = [profile]
+
+        def profile_thread(frame, event, arg):
+            # Called once in every thread started during the phase, the thread profile replaces this hook
+            thread_profile = cProfile.Profile()
+            with self.lock:
+                profiles.append(thread_profile)
+            thread_profile.enable()
+
+        # From Python 3.12 on, cProfile already profiles all threads
+        if sys.version_info < (3, 12):
+            threading.setprofile(profile_thread)
+        try:
+            return function()
+        finally:
+            profile.disable()
+            if sys.version_info < (3, 12):
+                threading.setprofile(None)
+            path = self.get_path(phase_name, 'pstats')
+            with self.lock:
+                stats = pstats.Stats(*profiles, stream=io.StringIO())
+            stats.dump_stats(path)
+            summary = io.StringIO()
+            stats.stream = summary
+            stats.sort_stats('cumulative').print_stats(self.top)
+            self.logger.info("CPU profile of phase %s (%s threads) written to %s\n%s", phase_name, len(profiles), path,
+                             summary.getvalue())
+
+    def _run_mem(self, phase_name, function):
+        # tracemalloc is process wide, it is stopped when the last profiled phase ends
+        with self.lock:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(25)
+            self.tracing_phases += 1
+            start_snapshot = tracemalloc.take_snapshot()
+        try:
+            return function()
+        finally:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            with self.lock:
+                self.tracing_phases -= 1
+                if self.tracing_phases == 0:
+                    tracemalloc.stop()
+            path = self.get_path(phase_name, 'tracemalloc')
+            snapshot.dump(path)
+            top = snapshot.compare_to(start_snapshot, 'lineno')[:self.top]
+            self.logger.info("Memory profile of phase %s written to %s (current %.1f MiB, peak %.1f MiB)\n%s",
+                             phase_name, path, current / 1024 / 1024, peak / 1024 / 1024,
+                             "\n".join(str(statistic) for statistic in top))
+
+    def _run_wall(self, phase_name, function):
+        stacks = collections.Counter()
+        stop = threading.Event()
+        sampler_thread_id = []
+
+        def sample():
+            sampler_thread_id.append(threading.get_ident())
+            while not stop.wait(self.interval):
+                for thread_id, frame in sys._current_frames().items():
+                    if thread_id == sampler_thread_id[0]:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        stack.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:"
+                                     f"{frame.f_code.co_firstlineno})")
+                        frame = frame.f_back
+                    stacks[";".join(reversed(stack))] += 1
+
+        sampler = threading.Thread(target=sample, name=f"profile-{phase_name}", daemon=True)
+        start_time = time.time()
+        sampler.start()
+        try:
+            return function()
+        finally:
+            stop.set()
+            sampler.join()
+            path = self.get_path(phase_name, 'collapsed')
+            with open(path, 'w') as collapsed:
+                for stack, count in stacks.items():
+                    collapsed.write(f"{stack} {count}\n")
+            leaves = collections.Counter()
+            for stack, count in stacks.items():
+                leaves[stack.rsplit(";", 1)[-1]] += count
+            total = sum(leaves.values()) or 1
+            self.logger.info("Wall clock profile of phase %s (%.1f seconds, %s samples) written to %s\n%s",
+                             phase_name, time.time() - start_time, total, path,
+                             "\n".join(f"{count * 100 / total:5.1f}% {leaf}"
+                                       for leaf, count in leaves.most_common(self.top)))
@@ -0,0 +1,102 @@
+import threading
+import time
+
+
+class RdsGate:
+    """
+    Readiness gate for RDS instances and clusters started by the start script. Stacks that depend on a database
+    call wait_for with the identifiers of those databases, one describe call per RDS type checks all databases
+    that are still being waited for.
+    """
+
+    # A database in one of these states does not become available by waiting
+    FAILED_STATUSES = ['failed', 'inaccessible-encryption-credentials']
+    FAILED_STATUS_PREFIXES = ['incompatible-']
+
+    def __init__(self, logger, client, min_interval=10, max_interval=30, backoff=1.5, timeout=3600):
+        self.logger = logger
+        self.client = client
+        self.min_interval = min_interval
+        self.max_interval = max(max_interval, min_interval)
+        self.backoff = backoff
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.started = dict()
+        self.start_times = dict()
+        self.available = set()
+        self.durations = dict()
+
+    def register(self, identifier, rds_type):
+        with self.lock:
+            self.started[identifier] = rds_type
+            self.start_times[identifier] = time.time()
+
+    def get_durations(self):
+        """
+        Return the number of seconds between the start and the first check that found the database available, for
+        the databases that were waited for.
+        """
+        with self.lock:
+            return dict(self.durations)
+
+    def get_started(self):
+        with self.lock:
+            return list(self.started)
+
+    def _describe(self, identifiers):
+        statuses = dict()
+        for page in self.client.get_paginator('describe_db_instances').paginate(
+                Filters=[{'Name': 'db-instance-id', 'Values': identifiers}]):
+            for instance in page['DBInstances']:
+                statuses[instance['DBInstanceIdentifier']] = instance['DBInstanceStatus']
+        for page in self.client.get_paginator('describe_db_clusters').paginate(
+                Filters=[{'Name': 'db-cluster-id', 'Values': identifiers}]):
+            for cluster in page['DBClusters']:
+                statuses[cluster['DBClusterIdentifier']] = cluster['Status']
+        return statuses
+
+    def _is_failed(self, identifier, status):
+        if status in self.FAILED_STATUSES or any(status.startswith(prefix) for prefix in self.FAILED_STATUS_PREFIXES):
+            return True
+        # A database started by this run may still be reported as stopped right after the start call
+        with self.lock:
+            return status == 'stopped' and identifier not in self.started
+
+    def wait_for(self, identifiers):
+        """
+        Block until every database in identifiers is available. Raises an exception when a database does not
+        exist, is in a failed state, is stopped without being started by this run or is not available within the
+        timeout.
+        """
+        start_time = time.time()
+        interval = self.min_interval
+        with self.lock:
+            pending = [identifier for identifier in identifiers if identifier not in self.available]
+
+        while len(pending) > 0:
+            statuses = self._describe(pending)
+            for identifier in list(pending):
+                status = statuses.get(identifier)
+                if status is None:
+                    raise Exception(f"RDS instance or cluster {identifier} does not exist")
+                if self._is_failed(identifier, status):
+                    raise Exception(f"RDS instance or cluster {identifier} is in state {status}, it does not become "
+                                    f"available")
+                if status == 'available':
+                    self.logger.info("RDS %s is available after %.0f seconds", identifier, time.time() - start_time)
+                    with self.lock:
+                        self.available.add(identifier)
+                        if identifier in self.start_times:
+                            self.durations[identifier] = time.time() - self.start_times[identifier]
+                    pending.remove(identifier)
+                else:
+                    self.logger.debug("RDS %s is in state %s", identifier, status)
+
+            if len(pending) == 0:
+                break
+            if time.time() - start_time > self.timeout:
+                raise Exception(f"RDS {', '.join(pending)} not available within {self.timeout} seconds")
+
+            self.logger.info("Waiting for RDS %s to become available", ', '.join(pending))
+            time.sleep(interval)
+            interval = min(interval * self.backoff, self.max_interval)
@@ -0,0 +1,103 @@
+from .ResourceHandler import Resource, ResourceHandler
+
+
+class RdsHandler(ResourceHandler):
+    """
+    Stops or starts the RDS instances and clusters tagged with ass:rds:include=yes (or the older
+    stop_or_start_with_cfn_stacks=yes). Instances that are part of a cluster are stopped and started with their
+    cluster. On start, the databases tagged with ass:rds:start-wait-until-available=yes (or the older
+    start_wait_until_available=yes) are waited for, instances and clusters alike.
+    """
+
+    kind = 'rds-db'
+    # rds type, inventory section, identifier key, ARN key, status key, describe filter
+    RDS_TYPES = [
+        ('instance', 'rds_instances', 'DBInstanceIdentifier', 'DBInstanceArn', 'DBInstanceStatus', 'db-instance-id'),
+        ('cluster', 'rds_clusters', 'DBClusterIdentifier', 'DBClusterArn', 'Status', 'db-cluster-id'),
+    ]
+    REQUIRED_STATUS = {'stop': 'available', 'start': 'stopped'}
+    FAILED_STATUSES = ['failed', 'incompatible-parameters', 'incompatible-restore',
+                       'inaccessible-encryption-credentials', 'storage-full', 'deleting', 'deleted']
+
+    def __init__(self, cfg, aws, operation):
+        super().__init__(cfg, aws, operation)
+        self.client = aws.get_boto3_client('rds')
+        self.statuses = dict()
+
+    def _get_tags(self, item, arn):
+        # describe_db_instances and describe_db_clusters return the tags, older snapshots may not have them
+        if 'TagList' in item:
+            return item['TagList']
+        return self.client.list_tags_for_resource(ResourceName=arn)['TagList']
+
+    def _has_tag(self, tags, *tag_names):
+        return any(tag['Key'] in tag_names and tag['Value'] == 'yes' for tag in tags)
+
+    def discover(self):
+        resources = []
+        include_tag = self.cfg.full_ass_tag('ass:rds:include')
+        for rds_type, section, identifier_key, arn_key, status_key, _ in self.RDS_TYPES:
+            self.logger.info("Get list of all RDS %ss", rds_type)
+            for item in self.aws.get_inventory().get(section):
+                identifier = item[identifier_key]
+                arn = item[arn_key]
+                status = item[status_key]
+                tags = self._get_tags(item, arn)
+                if not self._has_tag(tags, 'stop_or_start_with_cfn_stacks', include_tag):
+                    self.logger.info("RDS %s %s is not tagged with %s, or tag value is not yes",
+                                     rds_type, arn, include_tag)
+                elif status != self.REQUIRED_STATUS[self.operation]:
+                    self.logger.info("RDS %s %s is in state %s ( != %s ): Skipping %s",
+                                     rds_type, identifier, status, self.REQUIRED_STATUS[self.operation],
+                                     self.operation)
+                elif rds_type == 'instance' and 'DBClusterIdentifier' in item:
+                    self.logger.info("RDS %s %s is part of RDS Cluster %s: Skipping %s",
+                                     rds_type, identifier, item['DBClusterIdentifier'], self.operation)
+                else:
+                    self.logger.info("RDS %s %s is tagged with %s and tag value is yes", rds_type, arn, include_tag)
+                    wait = self.operation == 'start' and self._has_tag(
+                        tags, 'start_wait_until_available', self.cfg.full_ass_tag('ass:rds:start-wait-until-available'))
+                    resources.append(Resource(identifier, data={'rds_type': rds_type, 'arn': arn, 'wait': wait}))
+        return resources
+
+    def act(self, resource):
+        rds_type = resource.data['rds_type']
+        self.logger.info("%s RDS %s %s", 'Stopping' if self.operation == 'stop' else 'Starting', rds_type,
+                         resource.data['arn'])
+        if self.operation == 'stop':
+            if rds_type == 'instance':
+                self.client.stop_db_instance(DBInstanceIdentifier=resource.name)
+            else:
+                self.client.stop_db_cluster(DBClusterIdentifier=resource.name)
+        else:
+            if rds_type == 'instance':
+                self.client.start_db_instance(DBInstanceIdentifier=resource.name)
+            else:
+                self.client.start_db_cluster(DBClusterIdentifier=resource.name)
+            self.aws.get_rds_gate().register(resource.name, rds_type)
+        self.logger.info("%s RDS %s %s successfully triggered", self.operation.capitalize(), rds_type,
+                         resource.data['arn'])
+
+    def refresh(self, resources):
+        waiting = [resource for resource in resources if resource.data['wait']]
+        for rds_type, _, identifier_key, _, status_key, describe_filter in self.RDS_TYPES:
+            identifiers = [resource.name for resource in waiting if resource.data['rds_type'] == rds_type]
+            if len(identifiers) == 0:
+                continue
+            operation = 'describe_db_instances' if rds_type == 'instance' else 'describe_db_clusters'
+            result_key = 'DBInstances' if rds_type == 'instance' else 'DBClusters'
+            for page in self.client.get_paginator(operation).paginate(
+                    Filters=[{'Name': describe_filter, 'Values': identifiers}]):
+                for item in page[result_key]:
+                    self.statuses[item[identifier_key]] = item[status_key]
+
+    def is_done(self, resource):
+        if not resource.data['wait']:
+            return True
+        status = self.statuses.get(resource.name)
+        if status in self.FAILED_STATUSES:
+            raise Exception(f"RDS {resource.data['rds_type']} {resource.name} is in state {status}")
+        if status == 'available':
+            self.logger.info("RDS %s %s is available now", resource.data['rds_type'], resource.name)
+            return True
+        return False
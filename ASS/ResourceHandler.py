@@ -0,0 +1,94 @@
+import abc
+
+
+class Resource:
+    """
+    A resource a ResourceHandler acts on. order is the order level of the resource (resources with the same order
+    are handled at the same time), data holds what the handler needs to act on it. attempt counts the attempts of
+    the operation, starting at 1.
+    """
+
+    __slots__ = ['name', 'order', 'data', 'start_time', 'end_time', 'attempt']
+
+    def __init__(self, name, order=0, data=None):
+        self.name = name
+        self.order = order
+        self.data = data if data is not None else dict()
+        self.start_time = None
+        self.end_time = None
+        self.attempt = 1
+
+    def duration(self):
+        return self.end_time - self.start_time
+
+    def __repr__(self):
+        return f"Resource({self.name!r}, order={self.order!r})"
+
+
+class ResourceHandler(abc.ABC):
+    """
+    Stops or starts (operation) the resources of one type, run by a HandlerEngine:
+
+    * discover: return the Resources of this type the operation applies to
+    * restore_state: called for every discovered resource, loads what the opposite operation saved (e.g. the order
+      of a terminated environment). Return False to leave the resource out.
+    * save_state: called before act, saves what the opposite operation needs
+    * act: start the operation on the resource
+    * refresh: called with all resources that are not done yet before they are checked, to describe them at once
+    * is_done: return True when the operation on the resource has finished, raise an exception when it failed
+    * is_retryable: return True when the operation can be retried after is_done raised error, at most attempts
+      attempts in total and retry_delay seconds (doubled every attempt) after the failure
+    * retry: start the operation again on the failed resources of a level
+    * level_started: called with the resources of a level once the operation was started on all of them (or when
+      the level finished in an earlier invocation), e.g. to prepare the next level while this one is waited for
+
+    Resources are handled per order level, in increasing order, or decreasing order when reverse_order is set.
+    Within a level, the resources with the lowest get_priority are started first.
+    """
+
+    kind = None
+    reverse_order = False
+    attempts = 1
+    retry_delay = 0
+
+    def __init__(self, cfg, aws, operation):
+        self.cfg = cfg
+        self.aws = aws
+        self.operation = operation
+        self.logger = cfg.get_logger()
+
+    def get_history_kind(self):
+        return f"{self.kind}-{self.operation}"
+
+    @abc.abstractmethod
+    def discover(self):
+        pass
+
+    def restore_state(self, resource):
+        return True
+
+    def save_state(self, resource):
+        pass
+
+    @abc.abstractmethod
+    def act(self, resource):
+        pass
+
+    def refresh(self, resources):
+        pass
+
+    def is_done(self, resource):
+        return True
+
+    def is_retryable(self, resource, error):
+        return False
+
+    def retry(self, resources):
+        for resource in resources:
+            self.act(resource)
+
+    def get_priority(self, resource):
+        return 0
+
+    def level_started(self, resources):
+        pass
@@ -0,0 +1,91 @@
+import contextlib
+import datetime
+import json
+import threading
+import time
+from botocore.exceptions import ClientError
+
+
+class RunHistory:
+    """
+    Durations of the phases, stack order levels and resources (stack deletion or creation, bucket backup, emptying
+    or restore, RDS start) of the last runs of a script, kept in run-history/<script>.json in the state bucket.
+
+    Keys are '<kind>:<name>', e.g. 'stack:my-stack' or 'phase:cloudformation'. Only the last max_samples durations
+    per key and the total duration of the last max_runs runs are kept.
+    """
+
+    def __init__(self, logger, s3_client, state_bucket_name, script_name, max_samples=5, max_runs=20):
+        self.logger = logger
+        self.s3_client = s3_client
+        self.state_bucket_name = state_bucket_name
+        self.key = f"run-history/{script_name}.json"
+        self.max_samples = max_samples
+        self.max_runs = max_runs
+        self.lock = threading.Lock()
+        self.durations = dict()
+        self.runs = []
+
+    def load(self):
+        try:
+            saved = json.loads(self.s3_client.get_object(
+                Bucket=self.state_bucket_name, Key=self.key)['Body'].read().decode('utf-8'))
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ['NoSuchKey', 'NoSuchBucket']:
+                raise
+            return
+        self.durations = saved.get('durations', dict())
+        self.runs = saved.get('runs', [])
+        self.logger.info("Loaded the durations of %s resources from the run history", len(self.durations))
+
+    def save(self, run_duration=None, succeeded=True):
+        with self.lock:
+            if run_duration is not None:
+                self.runs = (self.runs + [{
+                    'finished_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                    'duration': round(run_duration, 1),
+                    'succeeded': succeeded
+                }])[-self.max_runs:]
+            body = json.dumps({'durations': self.durations, 'runs': self.runs}, separators=(',', ':'))
+        self.s3_client.put_object(Bucket=self.state_bucket_name, Key=self.key, Body=body,
+                                  ServerSideEncryption='AES256')
+
+    def record(self, kind, name, duration):
+        key = f"{kind}:{name}"
+        with self.lock:
+            self.durations[key] = (self.durations.get(key, []) + [round(duration, 1)])[-self.max_samples:]
+
+    def record_all(self, kind, durations):
+        for name, duration in durations.items():
+            self.record(kind, name, duration)
+
+    @contextlib.contextmanager
+    def measure(self, kind, name):
+        """
+        Record the duration of the block when it finishes without an exception.
+        """
+        start_time = time.time()
+        yield
+        self.record(kind, name, time.time() - start_time)
+
+    def get_estimate(self, kind, name, default=0):
+        """
+        Return the mean of the recorded durations of the resource, default when nothing was recorded.
+        """
+        with self.lock:
+            samples = self.durations.get(f"{kind}:{name}", [])
+        if len(samples) == 0:
+            return default
+        return sum(samples) / len(samples)
+
+    def get_max(self, kind, name, default=0):
+        with self.lock:
+            samples = self.durations.get(f"{kind}:{name}", [])
+        return max(samples, default=default)
+
+    def longest_first(self, items, kind, name_key):
+        """
+        Return the items (dicts with the resource name in name_key) sorted on their estimated duration, longest
+        first. Items without history keep their order after the items with history.
+        """
+        return sorted(items, key=lambda item: -self.get_estimate(kind, item[name_key]))
@@ -0,0 +1,113 @@
+import datetime
+import hashlib
+import json
+import time
+from botocore.exceptions import ClientError
+
+
+class RunMarker:
+    """
+    The last operation of the account in run-state/last-run.json, so a stop after a completed stop, or a start
+    after a completed start, is recognized with a few API calls: reading the marker and one listing per resource
+    type. The marker holds the operation, its status and a fingerprint of the resources the scripts stop and start.
+    It is written as running when a run begins and as completed when a full run completes, so an interrupted,
+    failed or targeted run is never taken for a completed one.
+
+    A repeat run is only skipped when the resources did not change since the completed run (the fingerprint) and
+    the marker is at most max_age seconds old, AWS starts stopped RDS instances again after 7 days.
+    """
+
+    KEY = 'run-state/last-run.json'
+    # Statuses a resource passes through at the end of a run, counted as the status they end in
+    SETTLED_STATUSES = {'stopping': 'stopped', 'starting': 'available', 'Launching': 'Ready', 'Updating': 'Ready'}
+
+    def __init__(self, logger, aws, state_bucket_name, max_age=86400):
+        self.logger = logger
+        self.aws = aws
+        self.s3_client = aws.get_boto3_client('s3')
+        self.state_bucket_name = state_bucket_name
+        self.max_age = max_age
+
+    def load(self):
+        try:
+            return json.loads(self.s3_client.get_object(
+                Bucket=self.state_bucket_name, Key=self.KEY)['Body'].read().decode('utf-8'))
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ['NoSuchKey', 'NoSuchBucket']:
+                raise
+            return None
+
+    def _paginate(self, service, operation, result_key, **kwargs):
+        result = []
+        for page in self.aws.get_boto3_client(service).get_paginator(operation).paginate(**kwargs):
+            result.extend(page.get(result_key, []))
+        return result
+
+    def _settled(self, status):
+        return self.SETTLED_STATUSES.get(status, status)
+
+    def get_fingerprint(self):
+        """
+        Return a hash of the stack ids, the RDS instance and cluster statuses, the BeanStalk environment statuses and
+        the tags of the tagged buckets and environments of the account. Creating, deleting, starting or stopping one
+        of them, or changing their tags, changes it. Return None when a listing fails.
+        """
+        lines = []
+        try:
+            lines.extend(f"stack {stack['StackId']}"
+                         for stack in self._paginate('cloudformation', 'describe_stacks', 'Stacks'))
+            lines.extend(f"rds:db {instance['DBInstanceIdentifier']} {self._settled(instance['DBInstanceStatus'])}"
+                         for instance in self._paginate('rds', 'describe_db_instances', 'DBInstances'))
+            lines.extend(f"rds:cluster {cluster['DBClusterIdentifier']} {self._settled(cluster['Status'])}"
+                         for cluster in self._paginate('rds', 'describe_db_clusters', 'DBClusters'))
+            environments = self.aws.get_boto3_client('elasticbeanstalk').describe_environments()['Environments']
+            # Terminating environments disappear from the listing when they are terminated
+            lines.extend(f"elasticbeanstalk {environment['EnvironmentName']} {self._settled(environment['Status'])}"
+                         for environment in environments if environment['Status'] != 'Terminating')
+            lines.extend(f"tagged {resource['ResourceARN']} " +
+                         ' '.join(sorted(f"{tag['Key']}={tag['Value']}" for tag in resource['Tags']))
+                         for resource in self._paginate('resourcegroupstaggingapi', 'get_resources',
+                                                        'ResourceTagMappingList',
+                                                        ResourceTypeFilters=['s3', 'elasticbeanstalk:environment']))
+        except ClientError as e:
+            self.logger.warning("Unable to compute the fingerprint of the account: %s", e)
+            return None
+        digest = hashlib.sha256()
+        for line in sorted(lines):
+            digest.update(line.encode('utf-8') + b"\n")
+        return digest.hexdigest()
+
+    def is_repeat(self, operation):
+        """
+        Return True when the last run was a completed operation run and nothing changed since.
+        """
+        marker = self.load()
+        if marker is None or marker.get('operation') != operation or marker.get('status') != 'completed':
+            return False
+        age = time.time() - marker.get('completed_at', 0)
+        if age > self.max_age:
+            self.logger.info("The last %s completed %.0f seconds ago, running it again", operation, age)
+            return False
+        fingerprint = self.get_fingerprint()
+        if fingerprint is None or fingerprint != marker.get('fingerprint'):
+            self.logger.info("The resources changed since the last %s completed, running it again", operation)
+            return False
+        self.logger.info("The last %s completed %.0f seconds ago (%s) and the resources did not change since",
+                         operation, age, marker.get('completed_at_utc'))
+        return True
+
+    def _save(self, marker):
+        self.s3_client.put_object(Bucket=self.state_bucket_name, Key=self.KEY, Body=json.dumps(marker),
+                                  ServerSideEncryption='AES256')
+
+    def begin(self, operation, selection=None):
+        self._save({'operation': operation, 'status': 'running', 'selection': selection, 'started_at': time.time()})
+
+    def complete(self, operation):
+        self._save({
+            'operation': operation,
+            'status': 'completed',
+            'fingerprint': self.get_fingerprint(),
+            'completed_at': time.time(),
+            'completed_at_utc': datetime.datetime.now(datetime.timezone.utc).isoformat()
+        })
@@ -0,0 +1,271 @@
+import io
+import json
+import tarfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+from .LogPipeline import LogSampler
+
+
+class MultipartUploadWriter(io.RawIOBase):
+    """
+    Write-only file object that streams everything written to it into an S3 multipart upload.
+    At most one part (part_size bytes) is kept in memory at any time.
+    """
+
+    def __init__(self, client, bucket_name, key, part_size):
+        super().__init__()
+        self.client = client
+        self.bucket_name = bucket_name
+        self.key = key
+        self.part_size = part_size
+        self.buffer = bytearray()
+        self.parts = []
+        self.size = 0
+        self.upload_id = client.create_multipart_upload(
+            Bucket=bucket_name, Key=key, ServerSideEncryption='AES256'
+        )['UploadId']
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer.extend(data)
+        self.size += len(data)
+        while len(self.buffer) >= self.part_size:
+            self._upload_part(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+        return len(data)
+
+    def close(self):
+        if self.closed:
+            return
+        if len(self.buffer) > 0 or len(self.parts) == 0:
+            self._upload_part(bytes(self.buffer))
+            self.buffer = bytearray()
+        self.client.complete_multipart_upload(
+            Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id,
+            MultipartUpload={'Parts': self.parts}
+        )
+        super().close()
+
+    def abort(self):
+        self.client.abort_multipart_upload(Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id)
+        super().close()
+
+    def _upload_part(self, body):
+        part_number = len(self.parts) + 1
+        response = self.client.upload_part(
+            Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id, PartNumber=part_number, Body=body
+        )
+        self.parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+
+
+class S3Archive:
+    """
+    Packed backup of a bucket: small objects are streamed into tar archives in the backup bucket,
+    large objects are copied server side as in the regular backup. The index stored next to the
+    archives holds key, metadata and ACL of every packed object. The ACLs are neither read nor put back for buckets
+    with ACLs disabled (object ownership BucketOwnerEnforced).
+
+    Layout in the backup bucket:
+        <bucket>/.ass-archive/index.json
+        <bucket>/.ass-archive/archive-00000.tar
+        <bucket>/<key>                          (objects larger than max_object_size)
+    """
+
+    ARCHIVE_FOLDER = '.ass-archive'
+
+    def __init__(self, logger, s3_client, max_object_size, part_size, archive_size, workers, log_sample_rate=1000):
+        self.logger = logger
+        self.max_object_size = max_object_size
+        self.part_size = max(part_size, 5 * 1024 * 1024)
+        self.archive_size = max(archive_size, self.part_size)
+        self.workers = max(workers, 1)
+        self.log_sample_rate = log_sample_rate
+        self.s3_client = s3_client
+
+    @staticmethod
+    def get_index_key(bucket_name):
+        return f"{bucket_name}/{S3Archive.ARCHIVE_FOLDER}/index.json"
+
+    @staticmethod
+    def get_archive_key(bucket_name, number):
+        return f"{bucket_name}/{S3Archive.ARCHIVE_FOLDER}/archive-{number:05d}.tar"
+
+    def has_archive(self, bucket_name, backup_bucket_name):
+        try:
+            self.s3_client.head_object(Bucket=backup_bucket_name, Key=self.get_index_key(bucket_name))
+            return True
+        except ClientError:
+            return False
+
+    def acls_enabled(self, bucket_name):
+        """
+        Return False when the object ownership of the bucket disables ACLs, True otherwise.
+        """
+        try:
+            rules = self.s3_client.get_bucket_ownership_controls(Bucket=bucket_name)['OwnershipControls']['Rules']
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'OwnershipControlsNotFoundError':
+                self.logger.warning("Cannot get the object ownership of %s, assuming ACLs are enabled: %s",
+                                    bucket_name, e)
+            return True
+        return not any(rule['ObjectOwnership'] == 'BucketOwnerEnforced' for rule in rules)
+
+    def _fetch_object(self, bucket_name, obj, acls_enabled):
+        response = self.s3_client.get_object(Bucket=bucket_name, Key=obj['Key'])
+        acl = self.s3_client.get_object_acl(Bucket=bucket_name, Key=obj['Key']) if acls_enabled else None
+        entry = {
+            'key': obj['Key'],
+            'size': obj['Size'],
+            'last_modified': obj['LastModified'].timestamp(),
+            'content_type': response.get('ContentType', 'binary/octet-stream'),
+            'metadata': response.get('Metadata', {}),
+            'acl': {'Owner': acl['Owner'], 'Grants': acl['Grants']} if acl is not None else None
+        }
+        return entry, response['Body'].read()
+
+    def _add_to_tar(self, tar, entry, data):
+        tar_info = tarfile.TarInfo(name=entry['key'])
+        tar_info.size = len(data)
+        tar_info.mtime = entry['last_modified']
+        tar.addfile(tar_info, io.BytesIO(data))
+
+    def pack_bucket(self, origin_bucket_name, backup_bucket_name):
+        """
+        Stream all objects of origin_bucket_name into the backup bucket. Objects are fetched in parallel
+        in batches of a few times the number of workers, so memory stays bounded by one multipart part
+        plus one batch of small objects.
+        """
+        index = {'bucket': origin_bucket_name, 'archives': []}
+        batch = []
+        batch_size = self.workers * 4
+        state = {'writer': None, 'tar': None, 'archive': None}
+        sampler = LogSampler(self.logger, self.log_sample_rate)
+        acls_enabled = self.acls_enabled(origin_bucket_name)
+
+        def open_archive():
+            key = self.get_archive_key(origin_bucket_name, len(index['archives']))
+            self.logger.info("Start writing archive s3://%s/%s", backup_bucket_name, key)
+            state['writer'] = MultipartUploadWriter(self.s3_client, backup_bucket_name, key, self.part_size)
+            state['tar'] = tarfile.open(fileobj=state['writer'], mode='w|', format=tarfile.PAX_FORMAT)
+            state['archive'] = {'key': key, 'objects': []}
+
+        def close_archive():
+            if state['tar'] is not None:
+                state['tar'].close()
+                state['writer'].close()
+                index['archives'].append(state['archive'])
+                self.logger.info("Finished writing archive %s (%s objects)",
+                                 state['archive']['key'], len(state['archive']['objects']))
+                state['tar'] = None
+
+        def flush(executor):
+            for entry, data in executor.map(lambda o: self._fetch_object(origin_bucket_name, o, acls_enabled), batch):
+                if state['tar'] is None:
+                    open_archive()
+                self._add_to_tar(state['tar'], entry, data)
+                sampler.debug("Packed %s in %s", entry['key'], state['archive']['key'])
+                state['archive']['objects'].append(entry)
+                if state['writer'].size >= self.archive_size:
+                    close_archive()
+            batch.clear()
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                for page in self.s3_client.get_paginator('list_objects_v2').paginate(Bucket=origin_bucket_name):
+                    for obj in page.get('Contents', []):
+                        if obj['Size'] > self.max_object_size:
+                            copy_source = {'Bucket': origin_bucket_name, 'Key': obj['Key']}
+                            self.s3_client.copy(copy_source, backup_bucket_name, f"{origin_bucket_name}/{obj['Key']}")
+                            sampler.debug("Copied %s/%s (too large to pack)", origin_bucket_name, obj['Key'])
+                            continue
+                        batch.append(obj)
+                        if len(batch) >= batch_size:
+                            flush(executor)
+                flush(executor)
+            close_archive()
+        except Exception:
+            if state['tar'] is not None:
+                state['writer'].abort()
+            raise
+
+        self.s3_client.put_object(
+            Bucket=backup_bucket_name,
+            Key=self.get_index_key(origin_bucket_name),
+            Body=json.dumps(index),
+            ServerSideEncryption='AES256'
+        )
+        self.logger.info("Packed %s objects of %s in %s archive(s)",
+                         sum((len(a['objects']) for a in index['archives'])),
+                         origin_bucket_name,
+                         len(index['archives']))
+
+    def _put_object(self, bucket_name, entry, data, acl, acls_enabled):
+        arguments = {
+            'Bucket': bucket_name,
+            'Key': entry['key'],
+            'Body': data,
+            'ContentType': entry['content_type'],
+            'Metadata': entry['metadata']
+        }
+        if acl:
+            arguments['ACL'] = acl
+        self.s3_client.put_object(**arguments)
+
+        if not acls_enabled or acl or entry['acl'] is None:
+            return
+        if any(grant['Grantee'].get('ID') != entry['acl']['Owner'].get('ID') for grant in entry['acl']['Grants']):
+            try:
+                self.s3_client.put_object_acl(Bucket=bucket_name, Key=entry['key'], AccessControlPolicy=entry['acl'])
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'AccessControlListNotSupported':
+                    raise
+
+    def _restore_archive(self, bucket_name, backup_bucket_name, archive, acl, acls_enabled, executor, in_flight):
+        entries = {entry['key']: entry for entry in archive['objects']}
+        futures = []
+        sampler = LogSampler(self.logger, self.log_sample_rate)
+        body = self.s3_client.get_object(Bucket=backup_bucket_name, Key=archive['key'])['Body']
+        with tarfile.open(fileobj=body, mode='r|') as tar:
+            for member in tar:
+                # tar turns keys with a trailing slash (folder markers) into directories without the slash
+                entry = entries.get(member.name) or entries[f"{member.name}/"]
+                member_file = tar.extractfile(member)
+                data = member_file.read() if member_file is not None else b''
+                in_flight.acquire()
+                future = executor.submit(self._put_object, bucket_name, entry, data, acl, acls_enabled)
+                future.add_done_callback(lambda f: in_flight.release())
+                futures.append(future)
+                sampler.debug("Restoring %s from %s", entry['key'], archive['key'])
+        for future in futures:
+            future.result()
+        self.s3_client.delete_object(Bucket=backup_bucket_name, Key=archive['key'])
+        self.logger.info("Restored %s objects from %s", len(futures), archive['key'])
+
+    def unpack_bucket(self, bucket_name, backup_bucket_name, acl=None):
+        """
+        Restore all archived objects of bucket_name. Archives are streamed in parallel and every object is
+        put back with its original metadata. The ACL is the canned ACL passed in (from the bucket tag), or
+        the ACL recorded in the index when no canned ACL is passed. Neither is used when the bucket has ACLs disabled.
+        """
+        index_key = self.get_index_key(bucket_name)
+        index = json.loads(self.s3_client.get_object(Bucket=backup_bucket_name, Key=index_key)['Body'].read())
+        in_flight = threading.BoundedSemaphore(self.workers * 4)
+        acls_enabled = self.acls_enabled(bucket_name)
+        if not acls_enabled and acl:
+            self.logger.warning("Bucket %s has ACLs disabled, not applying the canned ACL %s", bucket_name, acl)
+            acl = None
+
+        with ThreadPoolExecutor(max_workers=self.workers) as put_executor, \
+                ThreadPoolExecutor(max_workers=max(min(self.workers, len(index['archives'])), 1)) as archive_executor:
+            futures = [
+                archive_executor.submit(self._restore_archive, bucket_name, backup_bucket_name, archive, acl,
+                                        acls_enabled, put_executor, in_flight)
+                for archive in index['archives']
+            ]
+            for future in futures:
+                future.result()
+
+        self.s3_client.delete_object(Bucket=backup_bucket_name, Key=index_key)
@@ -0,0 +1,122 @@
+import gzip
+import json
+from botocore.exceptions import ClientError
+from .ShardedLister import ShardedLister
+
+
+class S3Snapshot:
+    """
+    Empties and restores a bucket without copying any object. On stop, versioning is enabled and every current
+    object gets a delete marker, with one DeleteObjects request per 1000 keys. The key, the version and the delete
+    marker of every object are kept in a manifest in the state bucket, s3-snapshot/<bucket>.jsonl.gz. On start,
+    exactly those delete markers are deleted, which makes the saved versions current again.
+
+    Only buckets that are not deleted with their stack can be snapshotted: a bucket with versions is not empty
+    for CloudFormation. Buckets with a lifecycle rule that expires noncurrent versions are refused, the rule would
+    delete the hidden objects.
+    """
+
+    BATCH_SIZE = 1000
+
+    def __init__(self, logger, client, lister, state_bucket_name, workers=16):
+        self.logger = logger
+        self.client = client
+        self.lister = lister
+        self.state_bucket_name = state_bucket_name
+        self.workers = workers
+
+    def get_manifest_key(self, bucket_name):
+        return f"s3-snapshot/{bucket_name}.jsonl.gz"
+
+    def has_manifest(self, bucket_name):
+        try:
+            self.client.head_object(Bucket=self.state_bucket_name, Key=self.get_manifest_key(bucket_name))
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ['404', 'NoSuchKey']:
+                raise
+            return False
+
+    def _load_manifest(self, bucket_name):
+        if not self.has_manifest(bucket_name):
+            return []
+        body = self.client.get_object(Bucket=self.state_bucket_name, Key=self.get_manifest_key(bucket_name))['Body']
+        return [json.loads(line) for line in gzip.decompress(body.read()).decode('utf-8').splitlines()]
+
+    def _save_manifest(self, bucket_name, entries):
+        body = gzip.compress(''.join(json.dumps(entry, separators=(',', ':')) + "\n" for entry in entries)
+                             .encode('utf-8'))
+        self.client.put_object(Bucket=self.state_bucket_name, Key=self.get_manifest_key(bucket_name), Body=body,
+                               ServerSideEncryption='AES256')
+
+    def _check_lifecycle(self, bucket_name):
+        try:
+            rules = self.client.get_bucket_lifecycle_configuration(Bucket=bucket_name)['Rules']
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'NoSuchLifecycleConfiguration':
+                raise
+            return
+        for rule in rules:
+            if rule.get('Status') == 'Enabled' and 'NoncurrentVersionExpiration' in rule:
+                raise Exception(f"Bucket {bucket_name} has a lifecycle rule ({rule.get('ID', '')}) that expires "
+                                f"noncurrent versions, it cannot be snapshotted")
+
+    def take(self, bucket_name):
+        """
+        Hide all current objects of bucket_name behind delete markers and add them to the manifest. Objects hidden
+        by an earlier snapshot that was not restored yet stay in the manifest.
+        """
+        self._check_lifecycle(bucket_name)
+        if self.client.get_bucket_versioning(Bucket=bucket_name).get('Status') != 'Enabled':
+            self.logger.info("Enabling versioning of bucket %s", bucket_name)
+            self.client.put_bucket_versioning(Bucket=bucket_name, VersioningConfiguration={'Status': 'Enabled'})
+
+        entries = self._load_manifest(bucket_name)
+        if len(entries) > 0:
+            self.logger.warning("Bucket %s already has a snapshot of %s objects that was not restored, adding to it",
+                                bucket_name, len(entries))
+
+        def hide(versions):
+            response = self.client.delete_objects(Bucket=bucket_name, Delete={
+                'Objects': [{'Key': version['Key']} for version in versions],
+                'Quiet': False
+            })
+            version_ids = {version['Key']: version['VersionId'] for version in versions}
+            for deleted in response.get('Deleted', []):
+                entries.append({'Key': deleted['Key'], 'VersionId': version_ids[deleted['Key']],
+                                'DeleteMarkerVersionId': deleted['DeleteMarkerVersionId']})
+            for error in response.get('Errors', []):
+                self.logger.error("Hiding %s in %s failed: %s", error['Key'], bucket_name, error['Message'])
+
+        # Current versions only, delete markers have no size
+        current_versions = (version for version in self.lister.list(bucket_name, versions=True)
+                            if version.get('IsLatest') and 'Size' in version)
+        try:
+            ShardedLister.for_each_batch(current_versions, hide, self.workers, self.BATCH_SIZE)
+        finally:
+            # Save what was hidden, also when a batch failed
+            self._save_manifest(bucket_name, entries)
+        self.logger.info("Bucket %s is emptied with a snapshot of %s objects", bucket_name, len(entries))
+
+    def restore(self, bucket_name):
+        """
+        Delete the delete markers in the manifest of bucket_name and delete the manifest.
+        """
+        entries = self._load_manifest(bucket_name)
+        self.logger.info("Restoring %s objects of bucket %s from its snapshot", len(entries), bucket_name)
+        failed = []
+
+        def unhide(batch):
+            response = self.client.delete_objects(Bucket=bucket_name, Delete={
+                'Objects': [{'Key': entry['Key'], 'VersionId': entry['DeleteMarkerVersionId']} for entry in batch],
+                'Quiet': True
+            })
+            for error in response.get('Errors', []):
+                self.logger.error("Restoring %s in %s failed: %s", error['Key'], bucket_name, error['Message'])
+                failed.append(error['Key'])
+
+        ShardedLister.for_each_batch(entries, unhide, self.workers, self.BATCH_SIZE)
+        if len(failed) > 0:
+            raise Exception(f"Restoring {len(failed)} objects of bucket {bucket_name} from its snapshot failed")
+        self.client.delete_object(Bucket=self.state_bucket_name, Key=self.get_manifest_key(bucket_name))
+        self.logger.info("Bucket %s is restored from its snapshot", bucket_name)
@@ -0,0 +1,176 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from .LogPipeline import log_context
+from .TimeBudget import TimeBudgetExhausted
+
+
+class Phase:
+    __slots__ = ['name', 'function', 'depends_on', 'start_time', 'end_time']
+
+    def __init__(self, name, function, depends_on):
+        self.name = name
+        self.function = function
+        self.depends_on = list(depends_on)
+        self.start_time = None
+        self.end_time = None
+
+    def duration(self):
+        return self.end_time - self.start_time
+
+
+class Scheduler:
+    """
+    Runs the top-level phases of a script as a dependency graph: a phase starts as soon as all phases it
+    depends on have finished, independent phases run at the same time. When a phase fails, no new phases
+    are started, the running phases are allowed to finish and the first exception is raised.
+
+    When a RunHistory is passed, the phase durations are recorded and phases that are ready at the same time are
+    started longest first. When a Profiler is passed, every phase runs under that profiler, one phase at a time so
+    the profile of a phase holds only its own work. When a TimeBudget is
+    passed, phases that finished in the previous invocation are skipped, and TimeBudgetExhausted is raised after
+    the running phases finished when a phase cannot be started within the budget.
+    """
+
+    def __init__(self, logger, workers=4, profiler=None, time_budget=None, run_history=None):
+        self.logger = logger
+        # The profilers see the whole process, phases that run at the same time would end up in each other's profiles
+        self.workers = 1 if profiler is not None else max(workers, 1)
+        self.profiler = profiler
+        self.time_budget = time_budget
+        self.run_history = run_history
+        self.phases = dict()
+
+    def add_phase(self, name, function, depends_on=()):
+        for dependency in depends_on:
+            if dependency not in self.phases:
+                raise ValueError(f"Phase {name} depends on unknown phase {dependency}")
+        self.phases[name] = Phase(name, function, depends_on)
+
+    def _run_phase(self, phase):
+        phase.start_time = time.time()
+        self.logger.info("Start of phase %s", phase.name)
+        try:
+            with log_context(phase=phase.name):
+                if self.profiler is not None:
+                    return self.profiler.run(phase.name, phase.function)
+                return phase.function()
+        finally:
+            phase.end_time = time.time()
+            self.logger.info("End of phase %s after %.1f seconds", phase.name, phase.duration())
+
+    def _can_start(self, phase, done):
+        if self.time_budget is None:
+            return True
+        if self.time_budget.is_finished(phase.name):
+            self.logger.info("Skipping phase %s, it finished in the previous invocation", phase.name)
+            done.add(phase.name)
+            return False
+        # The units in the phase are gated on their own durations, a whole phase may take longer than the budget
+        return self.time_budget.can_start_phase(phase.name)
+
+    def get_estimate(self, phase):
+        if self.run_history is None:
+            return 0
+        return self.run_history.get_estimate('phase', phase.name)
+
+    def predict_duration(self):
+        """
+        Return the predicted duration of the run: the longest chain of phase estimates through the dependency graph.
+        """
+        finish_times = dict()
+        # A phase can only depend on phases added before it
+        for phase in self.phases.values():
+            start = max((finish_times[dependency] for dependency in phase.depends_on), default=0)
+            finish_times[phase.name] = start + self.get_estimate(phase)
+        return max(finish_times.values(), default=0)
+
+    def get_plan(self):
+        """
+        Return the phases with their dependencies, estimates and predicted start times, in the order they start.
+        Phases that finished in the previous invocation are marked as skipped.
+        """
+        finish_times = dict()
+        plan = []
+        for phase in self.phases.values():
+            skipped = self.time_budget is not None and self.time_budget.is_finished(phase.name)
+            start = max((finish_times[dependency] for dependency in phase.depends_on), default=0)
+            estimate = 0 if skipped else self.get_estimate(phase)
+            finish_times[phase.name] = start + estimate
+            plan.append({'phase': phase.name, 'depends_on': phase.depends_on, 'estimate': estimate, 'start': start,
+                         'skipped': skipped})
+        return sorted(plan, key=lambda p: (p['start'], -p['estimate']))
+
+    def log_plan(self):
+        for step in self.get_plan():
+            self.logger.info("Phase %s: %s at %.0f seconds, takes %.0f seconds%s", step['phase'],
+                             'skipped' if step['skipped'] else 'starts', step['start'], step['estimate'],
+                             f" (after {', '.join(step['depends_on'])})" if len(step['depends_on']) > 0 else '')
+        self.logger.info("Predicted run time is %.0f seconds", self.predict_duration())
+
+    def run(self):
+        start_time = time.time()
+        done = set()
+        running = dict()
+        error = None
+        # Phases that are ready at the same time are started longest first, in the order they were added otherwise
+        start_order = sorted(self.phases.values(), key=lambda p: -self.get_estimate(p))
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while True:
+                if error is None:
+                    # Skipped phases can make other phases ready
+                    skipped = True
+                    while skipped and error is None:
+                        skipped = False
+                        for phase in start_order:
+                            if (phase.name not in done and phase not in running.values() and
+                                    all(dependency in done for dependency in phase.depends_on)):
+                                if self._can_start(phase, done):
+                                    running[executor.submit(self._run_phase, phase)] = phase
+                                elif phase.name in done:
+                                    skipped = True
+                                else:
+                                    error = TimeBudgetExhausted(f"Time budget exhausted before phase {phase.name}")
+                                    break
+                if len(running) == 0:
+                    break
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    phase = running.pop(future)
+                    try:
+                        future.result()
+                        done.add(phase.name)
+                        if self.run_history is not None:
+                            self.run_history.record('phase', phase.name, phase.duration())
+                        if self.time_budget is not None:
+                            self.time_budget.finish_phase(phase.name)
+                    except Exception as e:
+                        self.logger.error("Phase %s failed, not starting new phases", phase.name)
+                        error = error or e
+
+        self.log_critical_path(time.time() - start_time)
+        if error is not None:
+            raise error
+
+    def get_critical_path(self):
+        """
+        Return the chain of finished phases that determined the end time: starting from the phase that finished
+        last, follow the dependency that finished last.
+        """
+        finished = [phase for phase in self.phases.values() if phase.end_time is not None]
+        if len(finished) == 0:
+            return []
+        path = [max(finished, key=lambda p: p.end_time)]
+        while True:
+            dependencies = [self.phases[name] for name in path[0].depends_on if self.phases[name].end_time is not None]
+            if len(dependencies) == 0:
+                return path
+            path.insert(0, max(dependencies, key=lambda p: p.end_time))
+
+    def log_critical_path(self, total_duration):
+        path = self.get_critical_path()
+        if len(path) == 0:
+            return
+        self.logger.info("Critical path (%.1f seconds in total): %s", total_duration,
+                         " -> ".join(f"{phase.name} ({phase.duration():.1f}s)" for phase in path))
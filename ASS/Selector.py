@@ -0,0 +1,105 @@
+import hashlib
+
+
+class Selector:
+    """
+    Narrows a run to a part of the account. A selector is built from expressions like:
+
+    * stack=<prefix>: stacks with a name starting with prefix
+    * tag=<key> or tag=<key>=<value>: resources with the tag (and value)
+    * type=<type>: one of TYPES
+    * order=<order> or order=<min>-<max>: stacks and Beanstalk environments with a deletion order in the range
+
+    Expressions of the same kind are alternatives, expressions of different kinds must all match (tag expressions
+    must all match too). Selecting on stack name only matches stacks and selecting on the deletion order only
+    matches stacks and Beanstalk environments, so the other resource types are left out of the run.
+    """
+
+    TYPES = ['cloudformation', 's3', 'rds', 'elasticbeanstalk']
+    KINDS = ['stack', 'tag', 'type', 'order']
+    # Inventory sections of every resource type, the load balancers and distributions are only used to empty the
+    # access log buckets before the stacks are deleted
+    SECTIONS = {
+        'cloudformation': ['cloudformation', 'elbv2', 'cloudfront'],
+        's3': ['s3'],
+        'rds': ['rds_instances', 'rds_clusters'],
+        'elasticbeanstalk': ['elasticbeanstalk', 'elasticbeanstalk_terminated'],
+    }
+
+    def __init__(self, expressions=None):
+        self.expressions = sorted(expressions or [])
+        self.stack_prefixes = []
+        self.tags = []
+        self.types = []
+        self.orders = []
+        for expression in self.expressions:
+            self._add(expression)
+
+    def _add(self, expression):
+        kind, _, value = expression.partition('=')
+        kind = kind.strip().lower()
+        if kind not in self.KINDS or value == '':
+            raise ValueError(f"Invalid selector {expression}, use one of "
+                             f"{', '.join(kind + '=...' for kind in self.KINDS)}")
+        if kind == 'stack':
+            self.stack_prefixes.append(value)
+        elif kind == 'tag':
+            key, separator, tag_value = value.partition('=')
+            self.tags.append((key, tag_value if separator else None))
+        elif kind == 'type':
+            if value.lower() not in self.TYPES:
+                raise ValueError(f"Invalid resource type {value}, use one of {', '.join(self.TYPES)}")
+            self.types.append(value.lower())
+        else:
+            lower, separator, upper = value.partition('-')
+            try:
+                self.orders.append((int(lower), int(upper) if separator else int(lower)))
+            except ValueError:
+                raise ValueError(f"Invalid selector {expression}, use order=<n> or order=<n>-<m>") from None
+
+    def is_empty(self):
+        return len(self.expressions) == 0
+
+    def get_id(self):
+        """
+        Return a short id of the selection, to keep the run state of targeted runs apart.
+        """
+        return hashlib.sha256(' '.join(self.expressions).encode('utf-8')).hexdigest()[:12]
+
+    def allows_type(self, resource_type):
+        if len(self.types) > 0 and resource_type not in self.types:
+            return False
+        if len(self.stack_prefixes) > 0 and resource_type != 'cloudformation':
+            return False
+        if len(self.orders) > 0 and resource_type not in ['cloudformation', 'elasticbeanstalk']:
+            return False
+        return True
+
+    def allows_section(self, section):
+        return any(self.allows_type(resource_type) for resource_type, sections in self.SECTIONS.items()
+                   if section in sections)
+
+    def matches_stack_name(self, stack_name):
+        return len(self.stack_prefixes) == 0 or any(stack_name.startswith(prefix) for prefix in self.stack_prefixes)
+
+    def matches_tags(self, tags):
+        """
+        Return True when tags (a list of dicts with Key and Value) holds all selected tags.
+        """
+        tag_dict = {tag['Key']: tag['Value'] for tag in tags}
+        return all(key in tag_dict and (value is None or tag_dict[key] == value) for key, value in self.tags)
+
+    def matches_order(self, order):
+        return len(self.orders) == 0 or any(lower <= order <= upper for lower, upper in self.orders)
+
+    def has_tags(self):
+        return len(self.tags) > 0
+
+    def get_tag_filters(self):
+        """
+        Return the selected tags as TagFilters for the Resource Groups Tagging API get_resources.
+        """
+        return [{'Key': key, 'Values': [value]} if value is not None else {'Key': key} for key, value in self.tags]
+
+    def __str__(self):
+        return ', '.join(self.expressions) if not self.is_empty() else 'everything'
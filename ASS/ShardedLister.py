@@ -0,0 +1,177 @@
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ShardedLister:
+    """
+    Lists the keys (or the versions) of a bucket with several concurrent listings. The keyspace is split into shards:
+
+    * by common prefix, when a listing with Delimiter='/' finds enough prefixes
+    * by StartAfter (KeyMarker for versions) ranges between RANGE_BOUNDARIES otherwise, for flat buckets
+
+    Shards are listed in list_workers threads and the items are streamed through a bounded queue, so the full key
+    list is never kept in memory. for_each and for_each_batch hand the items to worker threads as they arrive.
+    """
+
+    RANGE_BOUNDARIES = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+    MIN_PREFIX_SHARDS = 4
+    MAX_DEPTH = 3
+    DONE = object()
+
+    def __init__(self, logger, client, list_workers=16, queue_size=10000):
+        self.logger = logger
+        self.client = client
+        self.list_workers = max(list_workers, 1)
+        self.queue_size = queue_size
+
+    @staticmethod
+    def _page_items(page, versions):
+        if versions:
+            return page.get('Versions', []) + page.get('DeleteMarkers', [])
+        return page.get('Contents', [])
+
+    def list_shard(self, bucket_name, prefix, lower, upper, versions=False):
+        """
+        Generator of the items with lower < key <= upper (None for an open end) below prefix, a shard returned by
+        get_shards.
+        """
+        arguments = {'Bucket': bucket_name, 'Prefix': prefix}
+        if lower is not None:
+            arguments['KeyMarker' if versions else 'StartAfter'] = lower
+        operation = 'list_object_versions' if versions else 'list_objects_v2'
+        for page in self.client.get_paginator(operation).paginate(**arguments):
+            items = self._page_items(page, versions)
+            for item in items:
+                if upper is None or item['Key'] <= upper:
+                    yield item
+            # Pages are sorted on key, the range ends in the first page with a key past upper
+            if upper is not None and any(item['Key'] > upper for item in items):
+                return
+
+    def _list_range(self, bucket_name, prefix, lower, upper, versions, put):
+        for item in self.list_shard(bucket_name, prefix, lower, upper, versions):
+            put(item)
+
+    def get_shards(self, bucket_name, prefix, versions, put, depth=0):
+        """
+        Return the shards of the keyspace below prefix as (prefix, lower, upper) tuples. Items directly below prefix
+        found while looking for common prefixes are put right away. When there are only a few prefixes, the shards
+        of those prefixes are used instead.
+        """
+        operation = 'list_object_versions' if versions else 'list_objects_v2'
+        paginator = self.client.get_paginator(operation)
+        prefixes = []
+        top_level_items = []
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix, Delimiter='/'):
+            prefixes.extend(common_prefix['Prefix'] for common_prefix in page.get('CommonPrefixes', []))
+            top_level_items.extend(self._page_items(page, versions))
+            if len(top_level_items) > len(prefixes) and page.get('IsTruncated'):
+                # Mostly keys without a delimiter, split on key ranges instead
+                boundaries = [f"{prefix}{character}" for character in self.RANGE_BOUNDARIES]
+                lowers = [None] + boundaries
+                uppers = boundaries + [None]
+                return [(prefix, lower, upper) for lower, upper in zip(lowers, uppers)]
+
+        for item in top_level_items:
+            put(item)
+        if 0 < len(prefixes) < self.MIN_PREFIX_SHARDS and depth < self.MAX_DEPTH:
+            return [shard for common_prefix in prefixes
+                    for shard in self.get_shards(bucket_name, common_prefix, versions, put, depth + 1)]
+        return [(common_prefix, None, None) for common_prefix in prefixes]
+
+    def list(self, bucket_name, prefix='', versions=False):
+        """
+        Generator of the objects (dicts with at least Key and Size) or, when versions is set, the object versions
+        and delete markers (dicts with at least Key and VersionId) in bucket_name below prefix.
+        """
+        items = queue.Queue(maxsize=self.queue_size)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    items.put(item, timeout=1)
+                    return
+                except queue.Full:
+                    pass
+            raise InterruptedError("Listing was cancelled")
+
+        def produce():
+            try:
+                shards = self.get_shards(bucket_name, prefix, versions, put)
+                self.logger.debug("Listing %s/%s in %s shards", bucket_name, prefix, len(shards))
+                with ThreadPoolExecutor(max_workers=self.list_workers) as executor:
+                    futures = [executor.submit(self._list_range, bucket_name, shard_prefix, lower, upper, versions,
+                                               put)
+                               for shard_prefix, lower, upper in shards]
+                    for future in futures:
+                        future.result()
+                put(self.DONE)
+            except Exception as e:
+                if not stop.is_set():
+                    put(e)
+
+        producer = threading.Thread(target=produce, name=f"list-{bucket_name}", daemon=True)
+        producer.start()
+        try:
+            while True:
+                item = items.get()
+                if item is self.DONE:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            producer.join()
+
+    @staticmethod
+    def _close(items):
+        # Closing a generator of list stops its listing threads
+        close = getattr(items, 'close', None)
+        if close is not None:
+            close()
+
+    @classmethod
+    def for_each(cls, items, function, workers):
+        """
+        Call function for every item with up to workers calls running, raise the first exception. items is closed
+        when it is a generator, also when a call raised before all items were taken.
+        """
+        in_flight = threading.BoundedSemaphore(workers * 2)
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = set()
+                for item in items:
+                    in_flight.acquire()
+                    future = executor.submit(function, item)
+                    future.add_done_callback(lambda f: in_flight.release())
+                    futures.add(future)
+                    for done in [f for f in futures if f.done()]:
+                        futures.discard(done)
+                        done.result()
+                for future in futures:
+                    future.result()
+        finally:
+            cls._close(items)
+
+    @classmethod
+    def for_each_batch(cls, items, function, workers, batch_size=1000):
+        """
+        Call function for every batch of up to batch_size items with up to workers calls running.
+        """
+        def batches():
+            batch = []
+            for item in items:
+                batch.append(item)
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+            if len(batch) > 0:
+                yield batch
+
+        try:
+            cls.for_each(batches(), function, workers)
+        finally:
+            cls._close(items)
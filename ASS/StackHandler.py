@@ -0,0 +1,143 @@
+import time
+from botocore.exceptions import ClientError
+from .FailureClassifier import FailureClassifier
+from .ResourceHandler import Resource, ResourceHandler
+
+
+class StackFailed(Exception):
+    """
+    The deletion or creation of a stack failed, reasons holds the failure reasons reported by the StackPoller.
+    """
+
+    def __init__(self, stack_name, operation, reasons):
+        super().__init__(f"Stack {stack_name} failed {operation}: {'; '.join(reasons)}")
+        self.reasons = reasons
+
+
+class StackHandler(ResourceHandler):
+    """
+    Deletes (operation delete, on stop) or creates (operation create, on start) the tagged CloudFormation stacks.
+    The scripts find the stacks (dicts with stack_name and stack_deletion_order) and pass the function that starts
+    the deletion or creation of one stack: it returns the create_stack arguments on start, None when the stack is
+    left alone.
+
+    The stacks of a level are polled with one StackPoller sweep. A failed creation is classified from the stack
+    events: a permanent failure fails the level right away, retryable failures are retried up to 3 attempts in
+    total. prepare_level is called with the stacks of the next level once a level was started, to prepare them
+    while the level is waited for.
+    """
+
+    kind = 'stack'
+
+    def __init__(self, cfg, aws, operation, stacks, start_stack, prepare_level=None, get_priority=None):
+        super().__init__(cfg, aws, operation)
+        self.stacks = stacks
+        self.start_stack = start_stack
+        self.prepare_level = prepare_level
+        self.get_stack_priority = get_priority
+        self.reverse_order = operation == 'create'
+        self.attempts = 3 if operation == 'create' else 1
+        self.retry_delay = cfg.get_cfn_retry_delay()
+        self.client = aws.get_boto3_client('cloudformation')
+        self.poller = cfg.get_stack_poller(self.client)
+        self.classifier = FailureClassifier()
+        self.finished = dict()
+        self.failures = dict()
+        self.levels = []
+
+    def discover(self):
+        resources = [Resource(stack['stack_name'], order=stack['stack_deletion_order'], data={'stack': stack})
+                     for stack in self.stacks]
+        self.levels = sorted({resource.order for resource in resources}, reverse=self.reverse_order)
+        if self.prepare_level is not None and len(self.levels) > 0:
+            self.prepare_level(self._get_level_stacks(self.levels[0]))
+        return resources
+
+    def _get_level_stacks(self, order):
+        return [stack for stack in self.stacks if stack['stack_deletion_order'] == order]
+
+    def get_priority(self, resource):
+        return self.get_stack_priority(resource.data['stack']) if self.get_stack_priority is not None else 0
+
+    def act(self, resource):
+        resource.data['arguments'] = self.start_stack(resource.data['stack'])
+        resource.data['skipped'] = self.operation == 'create' and resource.data['arguments'] is None
+        resource.data['since'] = time.time()
+        resource.data['seen_event_ids'] = set()
+
+    def level_started(self, resources):
+        index = self.levels.index(resources[0].order) + 1
+        if self.prepare_level is not None and index < len(self.levels):
+            self.prepare_level(self._get_level_stacks(self.levels[index]))
+
+    def refresh(self, resources):
+        polled = [resource for resource in resources if not resource.data['skipped']]
+        if len(polled) == 0:
+            return
+        self.finished, self.failures = self.poller.sweep(
+            [resource.name for resource in polled], self.operation,
+            {resource.name: resource.data['since'] for resource in polled},
+            {resource.name: resource.data['seen_event_ids'] for resource in polled})
+
+    def is_done(self, resource):
+        if resource.data['skipped']:
+            return True
+        if resource.name in self.failures:
+            self.aws.get_inventory().invalidate_stack(resource.name)
+            reasons = self.failures.pop(resource.name)
+            self.logger.error("Stack %s failed %s (attempt %s of %s), check the CloudFormation logs.",
+                              resource.name, self.operation, resource.attempt, self.attempts)
+            for reason in self.classifier.get_causes(reasons):
+                self.logger.error(reason)
+            raise StackFailed(resource.name, self.operation, self.classifier.get_causes(reasons))
+        if resource.name in self.finished:
+            self.aws.get_inventory().invalidate_stack(resource.name)
+            self.logger.info("Stack %s finished %s (%s)", resource.name, self.operation,
+                             self.finished.pop(resource.name) or 'gone')
+            return True
+        return False
+
+    def is_retryable(self, resource, error):
+        return isinstance(error, StackFailed) and not self.classifier.is_permanent(error.reasons)
+
+    def retry(self, resources):
+        """
+        Retry the creation of failed stacks. A stack created with rollback disabled keeps the resources that were
+        created and is retried in place by updating it with the same template, so only the failed resources are
+        created again. Other failed stacks are deleted together, and created from scratch once all deletions
+        finished.
+        """
+        stack_names = [resource.name for resource in resources]
+        # A failed creation may still be in progress or rolling back, a retry is only possible when it finished
+        self.poller.wait(stack_names, 'settle', timeout=self.cfg.get_deadline('stack', 'settle'))
+        statuses = self.poller.get_statuses(stack_names)
+        deleted = []
+        for resource in resources:
+            self.aws.get_inventory().invalidate_stack(resource.name)
+            arguments = resource.data['arguments']
+            if statuses.get(resource.name) in ['CREATE_FAILED', 'UPDATE_FAILED']:
+                self.logger.info("Retrying the failed resources of stack %s (%s) in place", resource.name,
+                                 statuses[resource.name])
+                try:
+                    self.client.update_stack(StackName=resource.name, UsePreviousTemplate=True,
+                                             Parameters=arguments['Parameters'], Capabilities=arguments['Capabilities'],
+                                             Tags=arguments['Tags'], DisableRollback=True)
+                    resource.data['since'] = time.time()
+                    continue
+                except ClientError as e:
+                    self.logger.warning("Stack %s cannot be retried in place, recreating it: %s", resource.name, e)
+
+            self.logger.info("Start deletion of stack %s", resource.name)
+            self.client.delete_stack(StackName=resource.name)
+            deleted.append(resource)
+
+        if len(deleted) == 0:
+            return
+        delete_failures = self.poller.wait([resource.name for resource in deleted], 'delete',
+                                           timeout=self.cfg.get_deadline('stack', 'delete'))
+        if len(delete_failures) > 0:
+            raise Exception(f"Deletion of {', '.join(delete_failures)} failed")
+        self.logger.info("Deletion of stack(s) %s was successful", ', '.join(resource.name for resource in deleted))
+        for resource in deleted:
+            self.client.create_stack(**resource.data['arguments'])
+            resource.data['since'] = time.time()
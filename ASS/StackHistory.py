@@ -0,0 +1,127 @@
+import datetime
+import json
+import os
+from botocore.exceptions import ClientError
+
+
+class StackHistory:
+    """
+    Persistent cache of deleted CloudFormation stacks, keyed by StackId. A DELETE_COMPLETE stack never changes, so
+    its name, deletion time and tags are only described once.
+
+    The watermark is the newest DeletionTime seen in list_stacks. Deleted stacks at or before the watermark that are
+    not in the cache were seen before and were not worth describing (nested stacks or older deletions of a stack
+    name), they are not described again.
+
+    The cache is stored as JSON in the state bucket, or in a local file when path is set.
+    """
+
+    STATE_KEY = 'stack-history/deleted-stacks.json'
+
+    def __init__(self, logger, client, s3_client, state_bucket_name, path=None):
+        self.logger = logger
+        self.client = client
+        self.s3_client = s3_client
+        self.state_bucket_name = state_bucket_name
+        self.path = path
+        self.watermark = None
+        self.stacks = dict()
+        self.loaded = False
+        self.changed = False
+
+    def _load(self):
+        try:
+            if self.path:
+                if not os.path.exists(self.path):
+                    return
+                with open(self.path) as history_file:
+                    saved = json.load(history_file)
+            else:
+                saved = json.loads(self.s3_client.get_object(
+                    Bucket=self.state_bucket_name, Key=self.STATE_KEY)['Body'].read().decode('utf-8'))
+            watermark = datetime.datetime.fromisoformat(saved['watermark']) if saved.get('watermark') else None
+            stacks = saved['stacks']
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ['NoSuchKey', 'NoSuchBucket']:
+                raise
+            return
+        except (ValueError, KeyError, OSError) as e:
+            # All deleted stacks are described again, and the history is replaced when it is saved
+            self.logger.warning("The stack history %s cannot be read, starting with an empty history: %s",
+                                self.path or f"s3://{self.state_bucket_name}/{self.STATE_KEY}", e)
+            return
+        self.watermark = watermark
+        self.stacks = stacks
+        self.logger.info("Loaded %s deleted stacks from the stack history (watermark %s)",
+                         len(self.stacks), saved.get('watermark'))
+
+    def _save(self):
+        if not self.changed:
+            return
+        saved = json.dumps({
+            'watermark': self.watermark.isoformat() if self.watermark is not None else None,
+            'stacks': self.stacks
+        })
+        if self.path:
+            with open(self.path, 'w') as history_file:
+                history_file.write(saved)
+        else:
+            self.s3_client.put_object(Bucket=self.state_bucket_name, Key=self.STATE_KEY, Body=saved,
+                                      ServerSideEncryption='AES256')
+        self.logger.info("Saved %s deleted stacks to the stack history", len(self.stacks))
+
+    def list_deleted_stacks(self):
+        """
+        Return the summaries of all DELETE_COMPLETE stacks. list_stacks has no time filter and does not sort on
+        DeletionTime, so the full history is listed, but it only returns summaries.
+        """
+        summaries = []
+        for page in self.client.get_paginator('list_stacks').paginate(StackStatusFilter=['DELETE_COMPLETE']):
+            summaries.extend(page['StackSummaries'])
+        return summaries
+
+    def get_stacks(self, summaries):
+        """
+        Return a dict with StackId as key and a dict with the StackName, DeletionTime and Tags of the stack as value
+        for the deleted stacks in summaries. Stacks that are not in the cache and are newer than the watermark are
+        described, older unknown stacks are left out.
+        """
+        if not self.loaded:
+            self._load()
+            self.loaded = True
+        result = dict()
+        described = 0
+        for summary in summaries:
+            stack_id = summary['StackId']
+            if stack_id not in self.stacks:
+                if self.watermark is not None and summary['DeletionTime'] <= self.watermark:
+                    continue
+                stack = self.client.describe_stacks(StackName=stack_id)['Stacks'][0]
+                self.stacks[stack_id] = {
+                    'StackName': stack['StackName'],
+                    'DeletionTime': stack['DeletionTime'].isoformat(),
+                    'Tags': stack.get('Tags', [])
+                }
+                self.changed = True
+                described += 1
+            result[stack_id] = self.stacks[stack_id]
+        self.logger.info("Described %s new deleted stacks, %s taken from the stack history",
+                         described, len(result) - described)
+        return result
+
+    def update(self, summaries, advance=True):
+        """
+        Move the watermark to the newest deletion in summaries (the full list_stacks history), drop the stacks that
+        are no longer in the history and save the cache. The watermark is kept when advance is False, because not
+        all new stacks were described.
+        """
+        if advance and len(summaries) > 0:
+            newest = max(summary['DeletionTime'] for summary in summaries)
+            if self.watermark is None or newest > self.watermark:
+                self.watermark = newest
+                self.changed = True
+        stack_ids = {summary['StackId'] for summary in summaries}
+        for stack_id in [stack_id for stack_id in self.stacks if stack_id not in stack_ids]:
+            del self.stacks[stack_id]
+            self.changed = True
+        self._save()
@@ -0,0 +1,170 @@
+import time
+from botocore.exceptions import ClientError
+
+
+class StackPoller:
+    """
+    Tracks a group of CloudFormation stacks that are being created or deleted, replacing one boto3 waiter per
+    stack. Every tick does a single describe_stacks sweep for all stacks still in flight (or one describe per
+    stack when only a few are left), the interval starts short and backs off while nothing changes.
+
+    For stacks that are still in progress, new stack events are checked for *_FAILED resources, so a failing
+    creation is reported as soon as the first resource fails instead of after the rollback has finished.
+    """
+
+    # A stack created with rollback disabled is retried in place with an update
+    SUCCESS_STATUSES = {
+        'create': ['CREATE_COMPLETE', 'UPDATE_COMPLETE'],
+        'delete': ['DELETE_COMPLETE'],
+    }
+    IN_PROGRESS_STATUSES = {
+        'create': ['CREATE_IN_PROGRESS', 'REVIEW_IN_PROGRESS', 'UPDATE_IN_PROGRESS',
+                   'UPDATE_COMPLETE_CLEANUP_IN_PROGRESS'],
+        'delete': ['DELETE_IN_PROGRESS'],
+    }
+
+    def __init__(self, logger, client, min_interval=5, max_interval=30, backoff=1.5, timeout=3600,
+                 check_events=True, sweep_threshold=3):
+        self.logger = logger
+        self.client = client
+        self.min_interval = min_interval
+        self.max_interval = max(max_interval, min_interval)
+        self.backoff = backoff
+        self.timeout = timeout
+        self.check_events = check_events
+        self.sweep_threshold = sweep_threshold
+
+    def _describe(self, stack_names):
+        """
+        Return a dict with the current status of each stack in stack_names, stacks that do not exist (anymore)
+        are left out.
+        """
+        statuses = dict()
+        if len(stack_names) <= self.sweep_threshold:
+            for stack_name in stack_names:
+                try:
+                    stack = self.client.describe_stacks(StackName=stack_name)['Stacks'][0]
+                    statuses[stack_name] = stack['StackStatus']
+                except ClientError as e:
+                    if 'does not exist' not in e.response['Error']['Message']:
+                        raise
+        else:
+            for page in self.client.get_paginator('describe_stacks').paginate():
+                for stack in page['Stacks']:
+                    if stack['StackName'] in stack_names:
+                        statuses[stack['StackName']] = stack['StackStatus']
+        return statuses
+
+    def get_statuses(self, stack_names):
+        return self._describe(stack_names)
+
+    def _get_failed_events(self, stack_name, since, seen_event_ids):
+        """
+        Return the reasons of the *_FAILED events of stack_name newer than since that were not seen before.
+        Only the first page of events is read, it holds the most recent events.
+        """
+        reasons = []
+        try:
+            events = self.client.describe_stack_events(StackName=stack_name)['StackEvents']
+        except ClientError:
+            return reasons
+        for event in events:
+            if event['Timestamp'].timestamp() < since or event['EventId'] in seen_event_ids:
+                continue
+            seen_event_ids.add(event['EventId'])
+            if event['ResourceStatus'].endswith('_FAILED'):
+                reasons.append(f"{event['LogicalResourceId']} ({event['ResourceType']}): {event['ResourceStatus']} "
+                               f"{event.get('ResourceStatusReason', '')}".strip())
+        return reasons
+
+    def _is_done(self, operation, status):
+        if operation == 'settle':
+            return status is None or not status.endswith('_IN_PROGRESS')
+        if status is None:
+            return operation == 'delete'
+        return status in self.SUCCESS_STATUSES[operation]
+
+    def _is_in_progress(self, operation, status):
+        if operation == 'settle':
+            return not self._is_done(operation, status)
+        return status in self.IN_PROGRESS_STATUSES[operation]
+
+    def sweep(self, stack_names, operation, since, seen_event_ids):
+        """
+        Check stack_names once (one sweep) for operation.
+        :param since: dict with the time the operation was started for every stack, older events are ignored
+        :param seen_event_ids: dict with the ids of the events already checked for every stack, updated
+        :return: a dict with the stacks that finished and their status (None when gone), and a dict with the stacks
+                 that failed and their failure reasons
+        """
+        statuses = self._describe(stack_names)
+        finished = dict()
+        failures = dict()
+        for stack_name in sorted(stack_names):
+            status = statuses.get(stack_name)
+            if self._is_done(operation, status):
+                finished[stack_name] = status
+                continue
+
+            reasons = []
+            if self.check_events and operation != 'settle' and status is not None:
+                reasons = self._get_failed_events(stack_name, since[stack_name], seen_event_ids[stack_name])
+            if not self._is_in_progress(operation, status) or len(reasons) > 0:
+                if len(reasons) == 0 and operation != 'settle' and status is not None:
+                    reasons = self._get_failed_events(stack_name, since[stack_name], seen_event_ids[stack_name])
+                failures[stack_name] = reasons or [f"Stack is in state {status or 'gone'}"]
+        return finished, failures
+
+    def wait(self, stack_names, operation, on_finished=None, timeout=None, on_failed=None):
+        """
+        Wait until every stack in stack_names has finished operation ('create', 'delete' or 'settle', which waits
+        until the stack is no longer in an *_IN_PROGRESS state).
+        :param on_finished: called with the stack name and the number of seconds waited for every stack that
+                            finished successfully
+        :param timeout: seconds to wait at most, the timeout of the poller when None
+        :param on_failed: called with the stack name and the failure reasons as soon as a stack fails, the other
+                          stacks are still waited for
+        :return: dict with the failed stacks as keys and the list of failure reasons as values, empty on success
+        """
+        timeout = timeout if timeout is not None else self.timeout
+        start_time = time.time()
+        pending = set(stack_names)
+        since = {stack_name: start_time for stack_name in stack_names}
+        seen_event_ids = {stack_name: set() for stack_name in stack_names}
+        failures = dict()
+        interval = self.min_interval
+
+        self.logger.info("Waiting for %s of %s stack(s): %s", operation, len(pending), ', '.join(sorted(pending)))
+        while len(pending) > 0:
+            finished, failed = self.sweep(pending, operation, since, seen_event_ids)
+
+            for stack_name, status in finished.items():
+                self.logger.info("Stack %s finished %s (%s) after %.0f seconds",
+                                 stack_name, operation, status or 'gone', time.time() - start_time)
+                pending.discard(stack_name)
+                if on_finished is not None:
+                    on_finished(stack_name, time.time() - start_time)
+            for stack_name, reasons in failed.items():
+                self.logger.error("Stack %s failed %s: %s", stack_name, operation, '; '.join(reasons))
+                failures[stack_name] = reasons
+                pending.discard(stack_name)
+                if on_failed is not None:
+                    on_failed(stack_name, reasons)
+
+            if len(pending) == 0:
+                break
+            if time.time() - start_time > timeout:
+                for stack_name in sorted(pending):
+                    self.logger.error("Stack %s did not finish %s within %s seconds", stack_name, operation, timeout)
+                    failures[stack_name] = [f"Timed out after {timeout} seconds"]
+                    if on_failed is not None:
+                        on_failed(stack_name, failures[stack_name])
+                break
+
+            changed = len(finished) + len(failed) > 0
+            interval = self.min_interval if changed else min(interval * self.backoff, self.max_interval)
+            self.logger.debug("%s stack(s) still waiting for %s, next check in %.0fs",
+                              len(pending), operation, interval)
+            time.sleep(interval)
+
+        return failures
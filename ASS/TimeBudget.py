@@ -0,0 +1,135 @@
+import contextlib
+import datetime
+import json
+import threading
+import time
+from botocore.exceptions import ClientError
+
+
+class TimeBudgetExhausted(Exception):
+    pass
+
+
+class TimeBudget:
+    """
+    Keeps a run within a time budget (in seconds, None for no budget). A unit of work (an order level of stacks,
+    RDS or BeanStalk environments, or a bucket) is only started when the remaining time is more than the unit
+    needed in the previous runs, according to the RunHistory. The first unit of an invocation is always started,
+    so every invocation makes progress, also when a unit took longer than the budget before. Phases are only
+    stopped by the units in them, a phase is started as long as there is time left. When a unit cannot be started,
+    TimeBudgetExhausted is raised and the script exits with exit_code, so the run can be continued by starting the
+    script again.
+
+    The phases and units that finished are kept in the state bucket as soon as they finish, they are skipped when
+    the script is started again with a budget within resume_window seconds.
+    """
+
+    def __init__(self, logger, s3_client, state_bucket_name, script_name, run_history, budget=None, start_time=None,
+                 resume_window=3600, exit_code=75):
+        self.logger = logger
+        self.s3_client = s3_client
+        self.state_bucket_name = state_bucket_name
+        self.key = f"run-state/{script_name}-progress.json"
+        self.run_history = run_history
+        self.budget = budget
+        self.resume_window = resume_window
+        self.exit_code = exit_code
+        self.start_time = start_time if start_time is not None else time.time()
+        self.finished_phases = []
+        self.finished_units = []
+        self.started_units = 0
+        self.lock = threading.Lock()
+
+    def load(self):
+        try:
+            saved = json.loads(self.s3_client.get_object(
+                Bucket=self.state_bucket_name, Key=self.key)['Body'].read().decode('utf-8'))
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ['NoSuchKey', 'NoSuchBucket']:
+                raise
+            return
+        age = time.time() - saved.get('saved_at', 0)
+        finished = saved.get('finished_phases', []) + saved.get('finished_units', [])
+        if self.budget is not None and len(finished) > 0 and age <= self.resume_window:
+            self.finished_phases = saved.get('finished_phases', [])
+            self.finished_units = saved.get('finished_units', [])
+            self.logger.info("Continuing the run of %.0f seconds ago, finished phases: %s, finished units: %s",
+                             age, ', '.join(self.finished_phases), len(self.finished_units))
+
+    def save(self, completed=False):
+        """
+        Save the progress, the finished phases and units are cleared when the run is completed.
+        """
+        with self.lock:
+            body = json.dumps({
+                'saved_at': time.time(),
+                'saved_at_utc': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                'finished_phases': [] if completed else list(self.finished_phases),
+                'finished_units': [] if completed else list(self.finished_units)
+            })
+        self.s3_client.put_object(Bucket=self.state_bucket_name, Key=self.key, Body=body,
+                                  ServerSideEncryption='AES256')
+
+    def get_remaining(self):
+        if self.budget is None:
+            return None
+        return self.budget - (time.time() - self.start_time)
+
+    def is_finished(self, phase_name):
+        return phase_name in self.finished_phases
+
+    def can_start_phase(self, phase_name):
+        remaining = self.get_remaining()
+        if remaining is None or remaining > 0 or self.started_units == 0:
+            return True
+        self.logger.warning("Not starting phase %s, the time budget is used up", phase_name)
+        return False
+
+    def can_start(self, kind, name):
+        remaining = self.get_remaining()
+        if remaining is None:
+            return True
+        # The longest recorded duration of the unit, a unit that does not fit is not started
+        estimate = self.run_history.get_max(kind, name)
+        if remaining > estimate:
+            return True
+        if self.started_units == 0:
+            self.logger.warning("Starting %s %s, %.0f seconds left and it took up to %.0f seconds before, but it is "
+                                "the first unit of this invocation", kind, name, remaining, estimate)
+            return True
+        self.logger.warning("Not starting %s %s, %.0f seconds left and it took up to %.0f seconds before",
+                            kind, name, remaining, estimate)
+        return False
+
+    def finish_phase(self, phase_name):
+        with self.lock:
+            self.finished_phases.append(phase_name)
+
+    def is_unit_finished(self, kind, name):
+        with self.lock:
+            finished = f"{kind}:{name}" in self.finished_units
+        if finished:
+            self.logger.info("Skipping %s %s, it finished in the previous invocation", kind, name)
+        return finished
+
+    @contextlib.contextmanager
+    def unit(self, kind, name):
+        """
+        Run the block as a unit of work: raise TimeBudgetExhausted when it cannot be started, record its duration
+        in the run history and keep it as finished when it finishes. Callers skip the units for which
+        is_unit_finished returns True.
+        """
+        with self.lock:
+            can_start = self.can_start(kind, name)
+            if can_start:
+                self.started_units += 1
+        if not can_start:
+            raise TimeBudgetExhausted(f"Time budget exhausted before {kind} {name}")
+        start_time = time.time()
+        yield
+        self.run_history.record(kind, name, time.time() - start_time)
+        with self.lock:
+            self.finished_units.append(f"{kind}:{name}")
+        if self.budget is not None:
+            # Kept right away, the invocation may be stopped before it saves its progress
+            self.save()
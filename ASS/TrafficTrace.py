@@ -0,0 +1,329 @@
+import base64
+import collections
+import datetime
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+from urllib.parse import urlsplit
+from botocore.awsrequest import AWSResponse
+from botocore.response import StreamingBody
+
+
+class TraceReplayError(Exception):
+    pass
+
+
+def _request_key(request):
+    """
+    Return a hash of the URL and the body of a botocore request, the same request in a recorded and a replayed run
+    has the same key. Streaming request bodies (e.g. put_object with a file) are left out.
+    """
+    url = urlsplit(request.url)
+    digest = hashlib.sha256(f"{request.method} {url.netloc}{url.path}?{url.query}".encode('utf-8'))
+    body = request.body
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    if isinstance(body, (bytes, bytearray)):
+        digest.update(body)
+    return digest.hexdigest()
+
+
+# Response fields that hold secrets per service id, replaced by REDACTED in the trace: JSON keys for ssm and
+# secrets-manager (SSM parameters are read with decryption), XML elements for sts (temporary credentials)
+SECRET_FIELDS = {
+    'ssm': ['Value'],
+    'secrets-manager': ['SecretString', 'SecretBinary'],
+    'sts': ['AccessKeyId', 'SecretAccessKey', 'SessionToken'],
+}
+REDACTED = 'redacted'
+
+
+def _redact_json(document, keys):
+    if isinstance(document, dict):
+        return {key: REDACTED if key in keys else _redact_json(value, keys) for key, value in document.items()}
+    if isinstance(document, list):
+        return [_redact_json(value, keys) for value in document]
+    return document
+
+
+def _redact(service, body):
+    """
+    Return body with the values of the SECRET_FIELDS of service replaced by REDACTED, so the response can still be
+    parsed when it is replayed. A JSON body that cannot be parsed is dropped.
+    """
+    keys = SECRET_FIELDS.get(service)
+    if keys is None or len(body) == 0:
+        return body
+    if body.lstrip().startswith(b'<'):
+        for key in keys:
+            body = re.sub(rf'<{key}>[^<]*</{key}>'.encode('utf-8'), f'<{key}>{REDACTED}</{key}>'.encode('utf-8'), body)
+        return body
+    try:
+        return json.dumps(_redact_json(json.loads(body), keys)).encode('utf-8')
+    except ValueError:
+        return b''
+
+
+def _operation(event_name):
+    # Events are named <event>.<service id>.<operation>
+    _, service, operation = event_name.split('.', 2)
+    return service, operation
+
+
+class TrafficRecorder:
+    """
+    Records every HTTP request botocore sends and the response it receives, with its duration, as one JSON line per
+    request in path. Retried requests are recorded once per attempt, so real throttling is part of the trace.
+
+    The handlers are registered on the events of a boto3 session, so all clients created from that session are
+    recorded. Streaming response bodies (get_object) are read completely and handed to the caller from memory.
+    Secrets in the responses (SECRET_FIELDS) are replaced before they are written, the file is only readable by its
+    owner.
+    """
+
+    def __init__(self, logger, path, region=None):
+        self.logger = logger
+        self.path = path
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.start_time = time.time()
+        self.count = 0
+        self.trace_file = os.fdopen(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w')
+        # O_CREAT does not change the mode of an existing file
+        os.chmod(path, 0o600)
+        self._write({'trace': 1, 'region': region,
+                     'recorded_at': datetime.datetime.now(datetime.timezone.utc).isoformat()})
+
+    def register(self, events):
+        events.register('before-call', self._before_call)
+        events.register('before-send', self._before_send)
+        events.register('response-received', self._response_received)
+        events.register('after-call', self._after_call)
+
+    def _write(self, entry):
+        with self.lock:
+            self.trace_file.write(json.dumps(entry, separators=(',', ':')) + "\n")
+
+    def _before_call(self, model, **kwargs):
+        self.local.protocol = model.service_model.protocol
+        self.local.pending = None
+
+    def _before_send(self, request, event_name, **kwargs):
+        service, operation = _operation(event_name)
+        self.local.entry = {
+            'service': service,
+            'operation': operation,
+            'protocol': getattr(self.local, 'protocol', None),
+            'key': _request_key(request),
+            'started': round(time.time() - self.start_time, 3)
+        }
+        self.local.send_time = time.time()
+
+    def _response_received(self, response_dict, **kwargs):
+        entry = getattr(self.local, 'entry', None)
+        if entry is None or response_dict is None:
+            return
+        self.local.entry = None
+        entry['duration'] = round(time.time() - self.local.send_time, 3)
+        entry['status'] = response_dict['status_code']
+        entry['headers'] = dict(response_dict['headers'])
+        body = response_dict['body']
+        if isinstance(body, (bytes, bytearray)):
+            entry['body'] = base64.b64encode(_redact(entry['service'], bytes(body))).decode('ascii')
+            self._add(entry)
+        else:
+            # A streaming body, it is read in after-call
+            self.local.pending = entry
+
+    def _after_call(self, parsed, model, **kwargs):
+        entry = getattr(self.local, 'pending', None)
+        if entry is None:
+            return
+        self.local.pending = None
+        payload = model.output_shape.serialization.get('payload') if model.output_shape is not None else None
+        body = b''
+        if payload is not None and isinstance(parsed.get(payload), StreamingBody):
+            body = parsed[payload].read()
+            parsed[payload] = StreamingBody(_RecordedBody(body), len(body))
+        entry['body'] = base64.b64encode(_redact(entry['service'], body)).decode('ascii')
+        self._add(entry)
+
+    def _add(self, entry):
+        self._write(entry)
+        with self.lock:
+            self.count += 1
+
+    def close(self):
+        with self.lock:
+            self.trace_file.close()
+        self.logger.info("Recorded %s AWS requests to %s", self.count, self.path)
+
+
+class _RecordedBody:
+    """
+    The raw body of a response served from memory, with the read and stream methods botocore uses.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.position = 0
+
+    def read(self, amt=None):
+        end = len(self.data) if amt is None else self.position + amt
+        chunk = self.data[self.position:end]
+        self.position += len(chunk)
+        return chunk
+
+    def stream(self, **kwargs):
+        chunk = self.read()
+        if len(chunk) > 0:
+            yield chunk
+
+    def close(self):
+        pass
+
+
+class TrafficReplayer:
+    """
+    Serves the responses of a trace recorded by TrafficRecorder instead of sending the requests, from a before-send
+    handler, so botocore parses the responses and applies its retry logic as it would for real responses.
+
+    A request gets the next recorded response of the same request (same URL and body), or of the same operation
+    when the request was not recorded. The last response of a request is repeated when it is asked more often than
+    it was recorded, e.g. when the stacks are polled more often. Every response is delayed by its recorded duration
+    multiplied by latency_scale.
+
+    faults maps a fault to the probability it is injected instead of (or, for waiter, into) a response:
+
+    * throttling: a throttling error (SlowDown for S3)
+    * 5xx: an internal error with status 500
+    * waiter: a resource that is polled for its status (stacks, databases) is reported as failed
+    """
+
+    FAULTS = ['throttling', '5xx', 'waiter']
+    WAITER_FAILURES = {
+        'DescribeStacks': (re.compile(rb'<StackStatus>(CREATE|DELETE)_(COMPLETE|IN_PROGRESS)</StackStatus>'),
+                           rb'<StackStatus>\1_FAILED</StackStatus>'),
+        'DescribeDBInstances': (re.compile(rb'<DBInstanceStatus>[a-z-]+</DBInstanceStatus>'),
+                                rb'<DBInstanceStatus>failed</DBInstanceStatus>'),
+    }
+
+    def __init__(self, logger, path, latency_scale=1.0, faults=None, seed=None):
+        self.logger = logger
+        self.path = path
+        self.latency_scale = latency_scale
+        self.faults = faults if faults is not None else dict()
+        for fault in self.faults:
+            if fault not in self.FAULTS:
+                raise ValueError(f"Unknown fault {fault}, must be one of {', '.join(self.FAULTS)}")
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.by_request = collections.defaultdict(collections.deque)
+        self.by_operation = collections.defaultdict(collections.deque)
+        self.counts = collections.Counter()
+        self.region = None
+        self._load()
+
+    def _load(self):
+        entries = 0
+        with open(self.path) as trace_file:
+            for line in trace_file:
+                entry = json.loads(line)
+                if 'trace' in entry:
+                    self.region = entry.get('region')
+                    continue
+                self.by_request[entry['key']].append(entry)
+                self.by_operation[(entry['service'], entry['operation'])].append(entry)
+                entries += 1
+        self.logger.info("Replaying AWS traffic from %s (%s responses, latency scale %s, faults %s)",
+                         self.path, entries, self.latency_scale, self.faults or 'none')
+
+    def register(self, events):
+        events.register('before-call', self._before_call)
+        events.register('before-send', self._before_send)
+
+    def _before_call(self, model, **kwargs):
+        self.local.protocol = model.service_model.protocol
+
+    @staticmethod
+    def _next(entries):
+        # The last response is kept to answer repeated requests
+        return entries.popleft() if len(entries) > 1 else entries[0]
+
+    def _find(self, service, operation, key):
+        with self.lock:
+            if len(self.by_request[key]) > 0:
+                self.counts['replayed'] += 1
+                return self._next(self.by_request[key])
+            if len(self.by_operation[(service, operation)]) > 0:
+                self.counts['unmatched'] += 1
+                return self._next(self.by_operation[(service, operation)])
+        raise TraceReplayError(f"No response for {service} {operation} in the trace {self.path}")
+
+    def _error(self, status, code, message):
+        protocol = getattr(self.local, 'protocol', 'query')
+        if protocol in ['json', 'rest-json']:
+            return status, {'Content-Type': 'application/x-amz-json-1.1'}, json.dumps(
+                {'__type': code, 'message': message}).encode('utf-8')
+        if protocol == 'rest-xml':
+            return status, {'Content-Type': 'application/xml'}, (
+                f"<Error><Code>{code}</Code><Message>{message}</Message><RequestId>replay</RequestId></Error>"
+            ).encode('utf-8')
+        return status, {'Content-Type': 'text/xml'}, (
+            f"<ErrorResponse><Error><Type>Sender</Type><Code>{code}</Code><Message>{message}</Message></Error>"
+            f"<RequestId>replay</RequestId></ErrorResponse>").encode('utf-8')
+
+    def _inject(self, fault):
+        probability = self.faults.get(fault, 0)
+        if probability <= 0:
+            return False
+        with self.lock:
+            if self.random.random() >= probability:
+                return False
+            self.counts[fault] += 1
+            return True
+
+    def _before_send(self, request, event_name, **kwargs):
+        service, operation = _operation(event_name)
+        entry = self._find(service, operation, _request_key(request))
+        if self.latency_scale > 0:
+            time.sleep(entry['duration'] * self.latency_scale)
+
+        status, headers, body = entry['status'], entry['headers'], base64.b64decode(entry['body'])
+        if self._inject('throttling'):
+            if service == 's3':
+                status, headers, body = self._error(503, 'SlowDown', 'Please reduce your request rate.')
+            else:
+                status, headers, body = self._error(400, 'Throttling', 'Rate exceeded')
+        elif self._inject('5xx'):
+            status, headers, body = self._error(500, 'InternalError', 'We encountered an internal error.')
+        elif status < 300 and operation in self.WAITER_FAILURES and self._inject('waiter'):
+            pattern, replacement = self.WAITER_FAILURES[operation]
+            body = pattern.sub(replacement, body)
+        headers = {name: value for name, value in headers.items() if name.lower() != 'content-length'}
+        headers['Content-Length'] = str(len(body))
+        return AWSResponse(request.url, status, headers, _RecordedBody(body))
+
+    def close(self):
+        self.logger.info("Replayed %s AWS requests, %s matched on the operation only, injected %s throttling, "
+                         "%s 5xx and %s waiter failures", self.counts['replayed'] + self.counts['unmatched'],
+                         self.counts['unmatched'], self.counts['throttling'], self.counts['5xx'],
+                         self.counts['waiter'])
+
+
+def parse_faults(faults):
+    """
+    Parse a fault specification like 'throttling=0.05,5xx=0.01' into a dict of fault and probability.
+    """
+    result = dict()
+    for fault in faults.split(','):
+        if fault.strip() == '':
+            continue
+        name, probability = fault.split('=', 1)
+        result[name.strip().lower()] = float(probability)
+    return result
@@ -0,0 +1,274 @@
+import json
+import random
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+
+
+class WorkLease:
+    def __init__(self, unit_id, document, etag):
+        self.unit_id = unit_id
+        self.document = document
+        self.etag = etag
+        self.lost = False
+        # Renewing and finishing both rewrite the unit with the last ETag
+        self.lock = threading.Lock()
+
+
+class WorkQueue:
+    """
+    A queue of work units in the state bucket, shared by several processes. The planner writes the units, every
+    process (the planner too) claims units, does them and marks them done:
+
+    * work-queue/<name>/queue.json: the status of the queue (open or closed) and the generation of the plan
+    * work-queue/<name>/units/<id>.json: a unit with its payload, its status and the lease of the process doing it
+    * work-queue/<name>/done/<generation>/<id> and failed/<generation>/<id>: markers, so the progress is known from
+      two listings. The markers are kept per plan, a process that finishes a unit of an earlier plan cannot mark the
+      unit with the same id of the current plan
+
+    A unit is claimed by rewriting it with IfMatch on the ETag that was read, so only one process wins. The owner
+    renews its lease while it works. A unit with an expired lease (the process was lost) is claimed again, up to
+    max_attempts times, after which it fails.
+    """
+
+    PREFIX = 'work-queue'
+    LOST_RACE_CODES = ['PreconditionFailed', 'ConditionalRequestConflict', 'NoSuchKey', '412', '409']
+
+    def __init__(self, logger, client, state_bucket_name, name, units=4, lease_seconds=300, max_attempts=3,
+                 poll_interval=10):
+        self.logger = logger
+        self.client = client
+        self.state_bucket_name = state_bucket_name
+        self.name = name
+        self.units = max(units, 1)
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.owner = f"{socket.gethostname()}-{uuid.uuid4().hex[:8]}"
+        self.leases = dict()
+        self.lock = threading.Lock()
+
+    def _key(self, *parts):
+        return '/'.join([self.PREFIX, self.name, *parts])
+
+    def _list(self, *parts):
+        prefix = self._key(*parts) + '/'
+        keys = []
+        for page in self.client.get_paginator('list_objects_v2').paginate(Bucket=self.state_bucket_name,
+                                                                         Prefix=prefix):
+            keys.extend(item['Key'][len(prefix):] for item in page.get('Contents', []))
+        return keys
+
+    def _put(self, key, document, **conditions):
+        return self.client.put_object(Bucket=self.state_bucket_name, Key=key, Body=json.dumps(document),
+                                      ServerSideEncryption='AES256', **conditions)['ETag']
+
+    def _lost_race(self, e):
+        return e.response['Error']['Code'] in self.LOST_RACE_CODES
+
+    @classmethod
+    def list_open(cls, logger, client, state_bucket_name, **kwargs):
+        """
+        Return a WorkQueue for every open queue in the state bucket.
+        """
+        queues = []
+        for page in client.get_paginator('list_objects_v2').paginate(Bucket=state_bucket_name,
+                                                                    Prefix=f"{cls.PREFIX}/", Delimiter='/'):
+            for common_prefix in page.get('CommonPrefixes', []):
+                name = common_prefix['Prefix'][len(cls.PREFIX) + 1:-1]
+                queue = cls(logger, client, state_bucket_name, name, **kwargs)
+                if queue.get_status() == 'open':
+                    queues.append(queue)
+        return queues
+
+    def _load(self):
+        try:
+            return json.loads(self.client.get_object(Bucket=self.state_bucket_name, Key=self._key('queue.json'))
+                              ['Body'].read().decode('utf-8'))
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ['NoSuchKey', '404']:
+                raise
+            return None
+
+    def get_status(self):
+        queue = self._load()
+        return queue['status'] if queue is not None else None
+
+    def _delete_all(self):
+        keys = [self._key(kind, key) for kind in ['units', 'done', 'failed'] for key in self._list(kind)]
+        for start in range(0, len(keys), 1000):
+            self.client.delete_objects(Bucket=self.state_bucket_name, Delete={
+                'Objects': [{'Key': key} for key in keys[start:start + 1000]], 'Quiet': True})
+
+    def plan(self, units):
+        """
+        Replace the queue with units, a list of (id, payload) tuples, and open it. The ids are unique within the
+        queue and must be valid in an S3 key.
+        """
+        # Processes do not claim units while the units are replaced
+        self._put(self._key('queue.json'), {'status': 'planning', 'planned_at': time.time()})
+        self._delete_all()
+        generation = uuid.uuid4().hex
+        for unit_id, payload in units:
+            self._put(self._key('units', f"{unit_id}.json"),
+                      {'id': unit_id, 'generation': generation, 'payload': payload, 'status': 'pending',
+                       'attempts': 0})
+        self._put(self._key('queue.json'), {'status': 'open', 'generation': generation, 'units': len(units),
+                                            'planned_at': time.time()})
+        self.logger.info("Planned %s work units in queue %s", len(units), self.name)
+
+    def close(self):
+        self._put(self._key('queue.json'), {'status': 'closed', 'closed_at': time.time()})
+        self._delete_all()
+        self.logger.info("Closed queue %s", self.name)
+
+    def claim(self, unit_id, generation=None):
+        """
+        Return a WorkLease on the unit, None when it is done, failed, leased by another process, another process
+        claimed it first or it belongs to another plan than generation.
+        """
+        try:
+            response = self.client.get_object(Bucket=self.state_bucket_name, Key=self._key('units', f"{unit_id}.json"))
+        except ClientError as e:
+            if self._lost_race(e):
+                return None
+            raise
+        document = json.loads(response['Body'].read().decode('utf-8'))
+        if generation is not None and document['generation'] != generation:
+            return None
+        if document['status'] in ['done', 'failed']:
+            return None
+        if document['status'] == 'leased' and document['lease_expires'] > time.time():
+            return None
+        if document['attempts'] >= self.max_attempts:
+            document['status'] = 'failed'
+            self._finish(WorkLease(unit_id, document, response['ETag']), 'failed')
+            return None
+        if document['status'] == 'leased':
+            self.logger.warning("The lease of %s on unit %s of queue %s expired, claiming it",
+                                document['owner'], unit_id, self.name)
+
+        document.update(status='leased', owner=self.owner, lease_expires=time.time() + self.lease_seconds,
+                        attempts=document['attempts'] + 1)
+        try:
+            etag = self._put(self._key('units', f"{unit_id}.json"), document, IfMatch=response['ETag'])
+        except ClientError as e:
+            if self._lost_race(e):
+                return None
+            raise
+        return WorkLease(unit_id, document, etag)
+
+    def renew(self, lease):
+        with lease.lock:
+            if lease.lost or lease.document['status'] != 'leased':
+                return
+            lease.document['lease_expires'] = time.time() + self.lease_seconds
+            try:
+                lease.etag = self._put(self._key('units', f"{lease.unit_id}.json"), lease.document,
+                                       IfMatch=lease.etag)
+            except ClientError as e:
+                if not self._lost_race(e):
+                    raise
+                self.logger.warning("Lost the lease on unit %s of queue %s", lease.unit_id, self.name)
+                lease.lost = True
+
+    def _finish(self, lease, status, error=None):
+        with lease.lock:
+            lease.document.update(status=status, error=error, lease_expires=0)
+            try:
+                lease.etag = self._put(self._key('units', f"{lease.unit_id}.json"), lease.document,
+                                       IfMatch=lease.etag)
+            except ClientError as e:
+                if not self._lost_race(e):
+                    raise
+                # Another process owns the unit now, or the unit belongs to a newer plan, it is not marked
+                self.logger.warning("Unit %s of queue %s changed while it was done, not marking it %s",
+                                    lease.unit_id, self.name, status)
+                lease.lost = True
+                return
+        if status in ['done', 'failed']:
+            self._put(self._key(status, lease.document['generation'], lease.unit_id),
+                      {'owner': self.owner, 'error': error})
+
+    def _do(self, lease, handlers):
+        payload = lease.document['payload']
+        try:
+            handlers[payload['kind']](payload)
+            self._finish(lease, 'done')
+        except Exception as e:
+            self.logger.error("Unit %s of queue %s failed (attempt %s of %s): %s", lease.unit_id, self.name,
+                              lease.document['attempts'], self.max_attempts, e)
+            self._finish(lease, 'failed' if lease.document['attempts'] >= self.max_attempts else 'pending', str(e))
+        finally:
+            with self.lock:
+                self.leases.pop(lease.unit_id, None)
+
+    def _heartbeat(self, stop):
+        while not stop.wait(self.lease_seconds / 3):
+            with self.lock:
+                leases = list(self.leases.values())
+            for lease in leases:
+                self.renew(lease)
+
+    def drain(self, handlers, wait=True):
+        """
+        Claim and do units with handlers, a dict of functions by payload kind, up to units at a time. With wait,
+        return when every unit is done or failed and raise when a unit failed. Without wait, return when no unit
+        can be claimed. Return the number of units this process claimed.
+        """
+        queue = self._load()
+        if queue is None or queue['status'] != 'open':
+            self.logger.info("Queue %s is not open", self.name)
+            return 0
+        generation = queue['generation']
+
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat, args=(stop,), name=f"lease-{self.name}", daemon=True)
+        heartbeat.start()
+        slots = threading.BoundedSemaphore(self.units)
+        claimed_total = 0
+
+        def do(lease):
+            try:
+                self._do(lease, handlers)
+            finally:
+                slots.release()
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.units) as executor:
+                while True:
+                    finished = set(self._list('done', generation)) | set(self._list('failed', generation))
+                    remaining = [key[:-len('.json')] for key in self._list('units')
+                                 if key[:-len('.json')] not in finished]
+                    if len(remaining) == 0:
+                        break
+                    # Processes start at different units, so they rarely race for the same one
+                    random.shuffle(remaining)
+                    claimed = 0
+                    for unit_id in remaining:
+                        slots.acquire()
+                        lease = self.claim(unit_id, generation) if unit_id not in self.leases else None
+                        if lease is None:
+                            slots.release()
+                            continue
+                        claimed += 1
+                        claimed_total += 1
+                        with self.lock:
+                            self.leases[unit_id] = lease
+                        executor.submit(do, lease)
+                    if claimed == 0:
+                        if not wait:
+                            break
+                        self.logger.debug("Waiting for %s units of queue %s done by other processes",
+                                          len(remaining), self.name)
+                        time.sleep(self.poll_interval)
+        finally:
+            stop.set()
+
+        failed = self._list('failed', generation)
+        if wait and len(failed) > 0:
+            raise Exception(f"{len(failed)} units of queue {self.name} failed: {', '.join(sorted(failed)[:10])}")
+        return claimed_total
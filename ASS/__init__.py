@@ -1,3 +1,29 @@
 from .Config import Config
 from .AWS import AWS
 from .Notification import Notification
+from .S3Archive import S3Archive
+from .S3Snapshot import S3Snapshot
+from .Inventory import Inventory
+from .StackPoller import StackPoller
+from .AsyncEngine import AsyncEngine
+from .Scheduler import Scheduler
+from .RdsGate import RdsGate
+from .StackHistory import StackHistory
+from .TimeBudget import TimeBudget, TimeBudgetExhausted
+from .RunHistory import RunHistory
+from .ShardedLister import ShardedLister
+from .LogPipeline import LogSampler, log_context
+from .Profiler import Profiler
+from .TrafficTrace import TrafficRecorder, TrafficReplayer, TraceReplayError
+from .Selector import Selector
+from .ResourceHandler import Resource, ResourceHandler
+from .HandlerEngine import HandlerEngine
+from .RdsHandler import RdsHandler
+from .StackHandler import StackHandler, StackFailed
+from .BeanstalkHandler import BeanstalkHandler
+from .BucketHandler import BucketHandler
+from .FailureClassifier import FailureClassifier
+from .Daemon import Daemon, DaemonJob
+from .WorkQueue import WorkQueue, WorkLease
+from .FailFast import FailFast, LevelFailed
+from .RunMarker import RunMarker
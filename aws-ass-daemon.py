@@ -0,0 +1,30 @@
+import logging
+import signal
+from ASS import Config
+from ASS import AWS
+from ASS.Cli import load_script
+
+
+def main():
+    cfg = Config("aws-ass-daemon")
+    aws = AWS(cfg.get_logger())
+    cfg.get_logger().info("Region:       %s", aws.get_region())
+    cfg.get_logger().info("AccountId:    %s", aws.get_account_id())
+
+    scripts = {'stop': load_script('aws-ass-stop'), 'start': load_script('aws-ass-start')}
+
+    def run(operation, arguments):
+        aws.begin_run(cfg.get_daemon_inventory_max_age())
+        return scripts[operation].main(arguments, aws)
+
+    daemon = cfg.get_daemon(run, aws.get_inventory())
+    signal.signal(signal.SIGTERM, lambda signum, frame: daemon.shutdown())
+    signal.signal(signal.SIGINT, lambda signum, frame: daemon.shutdown())
+    try:
+        daemon.serve_forever()
+    finally:
+        logging.shutdown()
+
+
+if __name__ == '__main__':
+    main()
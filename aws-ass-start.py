@@ -1,17 +1,25 @@
-import boto3
-import botocore
+import argparse
+import datetime
+import functools
 import logging
 import json
-import datetime
 import os
-import time
+import re
+import sys
 from ASS import Config
 from ASS import AWS
+from ASS import BeanstalkHandler
+from ASS import LevelFailed
 from ASS import Notification
+from ASS import RdsHandler
+from ASS import StackHandler
+from ASS import log_context
+from ASS import TimeBudgetExhausted
 
 from botocore.exceptions import ClientError
 from botocore.exceptions import NoRegionError
 from botocore.exceptions import NoCredentialsError
+from concurrent.futures import ThreadPoolExecutor
 
 
 def is_nested_stack(logger, stack_list, stack_name):
@@ -21,36 +29,29 @@ def is_nested_stack(logger, stack_list, stack_name):
     stack (which would be the root stack) followed by a dash, it is a nested stack.
     """
 
-    logger.debug("Checking if stack %s is a nested stack" % stack_name)
+    logger.debug("Checking if stack %s is a nested stack", stack_name)
 
     for stack in stack_list:
         if stack_name.startswith(stack + '-'):
-            logger.debug("Stack %s is a nested stack" % stack_name)
+            logger.debug("Stack %s is a nested stack", stack_name)
             return True
 
-    logger.debug("Stack %s is not a nested stack" % stack_name)
+    logger.debug("Stack %s is not a nested stack", stack_name)
     return False
 
 
 def get_stack_names_and_creation_order(cfg, aws):
-    stack_list = []
     result = []
     most_recent_only_dict = dict()
     root_stacks_only_dict = dict()
-    client = aws.get_boto3_client('cloudformation')
+    history = aws.get_stack_history(cfg.get_state_bucket_name(aws.get_region(), aws.get_account_id()))
 
     try:
-        cfg.get_logger().info(f"Getting all CloudFormation Stacks ...")
-        response = client.list_stacks(StackStatusFilter=['DELETE_COMPLETE'])
-        cfg.get_logger().info(f"Successfully finished getting all CloudFormation templates")
-        stack_list.extend(response['StackSummaries'])
-        while 'NextToken' in response:
-            cfg.get_logger().info("Sleeping a second between calls to list_stacks to avoid rate errors")
-            time.sleep(1)
-            response = client.list_stacks(StackStatusFilter=['DELETE_COMPLETE'], NextToken=response['NextToken'])
-            stack_list.extend(response['StackSummaries'])
-
-        cfg.get_logger().info(f"Retrieve the most recently deleted stacks per stack name")
+        cfg.get_logger().info("Getting all CloudFormation Stacks ...")
+        stack_list = history.list_deleted_stacks()
+        cfg.get_logger().info("Successfully finished getting all CloudFormation templates")
+
+        cfg.get_logger().info("Retrieve the most recently deleted stacks per stack name")
         for stack in stack_list:
             stack_name = stack['StackName']
             if stack_name in most_recent_only_dict:
@@ -58,32 +59,36 @@ def get_stack_names_and_creation_order(cfg, aws):
                     most_recent_only_dict[stack_name] = stack
             else:
                 most_recent_only_dict[stack_name] = stack
-        cfg.get_logger().info(f"{len(most_recent_only_dict)} stacks in most recent only stack dict")
+        cfg.get_logger().info("%s stacks in most recent only stack dict", len(most_recent_only_dict))
 
-        cfg.get_logger().info(f"Remove nested stack from remaining stack list")
+        cfg.get_logger().info("Remove nested stack from remaining stack list")
         for stack in most_recent_only_dict.keys():
             if not is_nested_stack(cfg.get_logger(), most_recent_only_dict.keys(), stack):
                 root_stacks_only_dict[stack] = most_recent_only_dict[stack]
-        cfg.get_logger().info(f"{len(root_stacks_only_dict)} stacks in root only stack dict")
-
-        cfg.get_logger().info(f"Filter remaining stacks on existence of the stack_deletion_order tag")
-        for stack_name in root_stacks_only_dict:
-            response = client.describe_stacks(StackName=root_stacks_only_dict[stack_name]['StackId'])
-            stack = response['Stacks'][0]
-
-            if 'Tags' in stack:
-                for tag in stack['Tags']:
-                    if tag['Key'] == 'stack_deletion_order' and int(tag['Value']) > 0:
-                        result.append({"stack_name": stack['StackName'],
-                                       "stack_id": stack['StackId'],
-                                       "stack_deletion_order": int(tag['Value']),
-                                       "stack_deletion_time": stack['DeletionTime'],
-                                       "stack_tags": stack['Tags']
-                                       })
-                        break
+        cfg.get_logger().info("%s stacks in root only stack dict", len(root_stacks_only_dict))
+
+        selector = cfg.get_selector()
+        cfg.get_logger().info("Filter remaining stacks on existence of the stack_deletion_order tag")
+        deleted_stacks = history.get_stacks(stack for stack_name, stack in root_stacks_only_dict.items()
+                                            if selector.matches_stack_name(stack_name))
+        for stack_id, stack in deleted_stacks.items():
+            if not selector.matches_tags(stack['Tags']):
+                continue
+            for tag in stack['Tags']:
+                if (tag['Key'] == 'stack_deletion_order' and int(tag['Value']) > 0 and
+                        selector.matches_order(int(tag['Value']))):
+                    result.append({"stack_name": stack['StackName'],
+                                   "stack_id": stack_id,
+                                   "stack_deletion_order": int(tag['Value']),
+                                   "stack_deletion_time": stack['DeletionTime'],
+                                   "stack_tags": stack['Tags']
+                                   })
+                    break
+        # Stacks that were not selected are not described, they must stay after the watermark
+        history.update(stack_list, advance=selector.is_empty())
 
     except NoRegionError:
-        cfg.get_logger().error(f"No AWS Credentials provided!!!")
+        cfg.get_logger().error("No AWS Credentials provided!!!")
         Notification.send_notification(
             f"Account ID {aws.get_account_id()} aws-ass-start:",
             f"No AWS Credentials provided!!!"
@@ -101,320 +106,319 @@ def get_stack_names_and_creation_order(cfg, aws):
     return result
 
 
-def get_beanstalk_environment_deletion_order_from_state_bucket(cfg, aws, environment):
+def get_notifier(aws):
+    """
+    Return a function that sends a notification about this run.
+    """
+    return functools.partial(Notification.send_notification, f"Account ID {aws.get_account_id()} aws-ass-start:")
+
+
+def get_template_arguments(cfg, aws, stack, stack_dict):
+    """
+    Return the template argument for create_stack: TemplateBody for small templates, TemplateURL pointing to the
+    template cache in the state bucket otherwise. Stacks stopped without a cached template use the template of
+    the deleted stack, which is added to the cache.
+    """
     state_bucket_name = cfg.get_state_bucket_name(aws.get_region(), aws.get_account_id())
-    try:
-        cfg.get_logger().info(f"Get saved state data for {environment} from S3 bucket {state_bucket_name}")
-        environment_dict = json.loads(boto3.resource('s3').
-                                      Object(state_bucket_name, environment).
-                                      get()['Body'].
-                                      read().
-                                      decode('utf-8'))
-        cfg.get_logger().info("Saved data is: %s " % environment_dict)
-
-        return environment_dict
-    except Exception:
-        cfg.get_logger().warning(f"An error occurred retrieving stack information from the S3 state bucket")
-        cfg.get_logger().warning(f"Skipping this beanstalk environment, because it's an environment")
-        cfg.get_logger().warning(f"that was deleted outside the stop/start setup.")
-        return None
 
+    if 'template_key' in stack_dict:
+        template_key = stack_dict['template_key']
+        template_size = stack_dict['template_size']
+        template_body = None
+    else:
+        cfg.get_logger().info("No cached template for stack %s, get the template of the deleted stack",
+                              stack['stack_name'])
+        template_body = aws.get_boto3_client('cloudformation').get_template(
+            StackName=stack['stack_id'], TemplateStage='Processed'
+        )['TemplateBody']
+        template_key, template_size = aws.store_template(state_bucket_name, template_body)
+
+    if template_size <= cfg.get_inline_template_size():
+        if template_body is None:
+            template_body = aws.get_boto3_client('s3').get_object(
+                Bucket=state_bucket_name, Key=template_key
+            )['Body'].read().decode('utf-8')
+        elif not isinstance(template_body, str):
+            template_body = json.dumps(template_body)
+        return {'TemplateBody': template_body}
+
+    return {'TemplateURL': aws.get_s3_object_url(state_bucket_name, template_key)}
+
+
+def get_rds_dependencies(cfg, aws, stack):
+    """
+    Return the identifiers of the RDS instances and clusters the stack waits for: the space separated values of
+    the ass:cfn:depends-on-rds tag. When the deprecated SLEEP_SECONDS_AFTER_RDS_START is set, stacks without the
+    tag wait for all databases started in this run.
+    """
+    for tag in stack['stack_tags']:
+        if tag['Key'] == cfg.full_ass_tag('ass:cfn:depends-on-rds'):
+            return [identifier for identifier in re.split(r'[,\s]+', tag['Value']) if identifier != '']
 
-def get_deleted_beanstalk_environment_names_and_creation_order(cfg, aws):
-    result = []
+    if int(cfg.sleep_seconds_after_rds_start) > 0:
+        return aws.get_rds_gate().get_started()
+    return []
 
+
+def get_stack_create_arguments(cfg, aws, stack):
+    """
+    Load the saved parameters and the template of the stack. It has no effect on the stack, so it can be done
+    ahead of the creation (see prefetch_stack_level).
+    :return: the create_stack arguments, or None when a stack with the same name already exists
+    """
+    state_bucket_name = cfg.get_state_bucket_name(aws.get_region(), aws.get_account_id())
+    stack_dict = {}
+
+    # First check if stack with same name already exists
+    if aws.cfn_stack_exists(stack['stack_name']):
+        cfg.get_logger().warning("Skipping creation of stack %s because stack with same name already exists",
+                                 stack['stack_name'])
+        return None
+
+    # Get parameters from state_bucket_name
     try:
-        cfg.get_logger().info(f"Getting all terminated BeanStalk environments ...")
-        response = aws.get_boto3_client('elasticbeanstalk').describe_environments(
-            IncludeDeleted=True,
-            IncludedDeletedBackTo=datetime.datetime(2015, 1, 1)
+        cfg.get_logger().info("Get saved state for %s from S3 bucket %s", stack['stack_name'], state_bucket_name)
+        stack_dict = json.loads(
+            aws.get_boto3_client('s3').get_object(
+                Bucket=state_bucket_name, Key=stack['stack_name']
+            )['Body'].read().decode('utf-8')
         )
-        cfg.get_logger().info(f"Successfully finished getting all BeanStalk environments")
-        env_list = response['Environments']
-    except NoRegionError as e:
-        cfg.get_logger().error(f"No region provided!!!")
+        cfg.get_logger().info("Saved data is: %s ", stack_dict)
+    except Exception as e:
+        cfg.get_logger().debug(e)
+        cfg.get_logger().warning("An error occurred retrieving stack information from the S3 state bucket")
+        cfg.get_logger().warning("Continuing without restoring data from S3")
         Notification.send_notification(
             f"Account ID {aws.get_account_id()} aws-ass-start:",
-            f"No AWS Region provided!!!"
+            f"An error occurred retrieving stack information from the S3 state bucket"
         )
-        raise e
+        stack_dict['stack_parameters'] = []
 
-    for environment in env_list:
-        if environment['Status'] == 'Terminated':
-            # Get environment deletion order from s3 bucket
-            environment = get_beanstalk_environment_deletion_order_from_state_bucket(
-                cfg, aws, environment['EnvironmentName']
-            )
-            if environment is not None:
-                result.append(environment)
+    cfg.get_logger().info("Get template for stack %s", stack['stack_name'])
+    return dict(
+        StackName=stack['stack_name'],
+        **get_template_arguments(cfg, aws, stack, stack_dict),
+        Parameters=stack_dict['stack_parameters'],
+        Capabilities=['CAPABILITY_NAMED_IAM'],
+        Tags=stack['stack_tags'],
+        DisableRollback=cfg.get_cfn_disable_rollback()
+    )
 
-    return result
 
+def prefetch_stack_level(cfg, aws, executor, stacks, prepared):
+    """
+    Start loading the create_stack arguments of stacks in the background, prepared maps the stack names to the
+    futures. Without an executor (ASS_PREFETCH_WORKERS=0) the arguments are loaded when the stack is created.
+    """
+    if executor is None:
+        return
 
-def get_stack_template_and_create_template(cfg, aws, stack):
-    waiter = aws.get_boto3_client('cloudformation').get_waiter('stack_create_complete')
-    s3_client = aws.get_boto3_client('s3')
-    state_bucket_name = cfg.get_state_bucket_name(aws.get_region(), aws.get_account_id())
-    stack_dict = {}
-    retries = 3
+    def prefetch(stack):
+        with log_context(stack=stack['stack_name']):
+            return get_stack_create_arguments(cfg, aws, stack)
+
+    for stack in stacks:
+        prepared[stack['stack_name']] = executor.submit(prefetch, stack)
+    if len(stacks) > 0:
+        cfg.get_logger().info("Prefetching the saved state and templates of %s", ', '.join(
+            stack['stack_name'] for stack in stacks))
+
+
+def get_stack_template_and_create_template(cfg, aws, stack, prepared=None):
+    """
+    Start the creation of the stack from its saved parameters and template, prefetched in prepared when
+    available. Waiting for the creation is done for all stacks of an order level at once by the StackHandler.
+    :return: the create_stack arguments, or None when a stack with the same name already exists
+    """
+    future = prepared.pop(stack['stack_name'], None) if prepared is not None else None
 
     try:
-        # First check if stack with same name already exists
-        if not aws.cfn_stack_exists(stack['stack_name']):
-            # Get parameters from state_bucket_name
-            try:
-                cfg.get_logger().info(f"Get saved state for {stack['stack_name']} from S3 bucket {state_bucket_name}")
-                stack_dict = json.loads(
-                    boto3.resource('s3').
-                        Object(state_bucket_name, stack['stack_name']).
-                        get()['Body'].
-                        read().
-                        decode('utf-8')
-                )
-                cfg.get_logger().info("Saved data is: %s " % stack_dict)
-            except Exception as e:
-                cfg.get_logger().debug(e)
-                cfg.get_logger().warning("An error occurred retrieving stack information from the S3 state bucket")
-                cfg.get_logger().warning("Continuing without restoring data from S3")
-                Notification.send_notification(
-                    f"Account ID {aws.get_account_id()} aws-ass-start:",
-                    f"An error occurred retrieving stack information from the S3 state bucket"
-                )
-                stack_dict['stack_parameters'] = []
+        create_arguments = future.result() if future is not None else get_stack_create_arguments(cfg, aws, stack)
+        if create_arguments is None:
+            return None
 
-            cfg.get_logger().info("Get template string for template %s" % stack['stack_name'])
-            response = aws.get_boto3_client('cloudformation').get_template(
-                StackName=stack['stack_id'], TemplateStage='Processed'
-            )
-            cfg.get_logger().info("Copy the template to the template bucket %s" % cfg.get_template_bucket_name())
-            s3_client.put_object(
-                Bucket=cfg.get_template_bucket_name(),
-                Body=response['TemplateBody'],
-                Key=stack['stack_name'],
-                ServerSideEncryption='AES256'
-            )
-            template_url = 'https://s3.amazonaws.com/' + cfg.get_template_bucket_name() + '/' + stack['stack_name']
-
-            for counter in range(0, retries):
-                cfg.get_logger().info("Create the CloudFormation stack from the template of the deleted stack")
-                aws.get_boto3_client('cloudformation').create_stack(
-                    StackName=stack['stack_name'],
-                    TemplateURL=template_url,
-                    Parameters=stack_dict['stack_parameters'],
-                    Capabilities=['CAPABILITY_NAMED_IAM'],
-                    Tags=stack['stack_tags']
-                )
+        rds_dependencies = get_rds_dependencies(cfg, aws, stack)
+        if len(rds_dependencies) > 0:
+            cfg.get_logger().info("Stack %s waits for RDS %s", stack['stack_name'], ', '.join(rds_dependencies))
+            aws.get_rds_gate().wait_for(rds_dependencies)
 
-                cfg.get_logger().info(f"Wait for stack creation to finish, iteration {counter + 1} out of {retries}")
-                try:
-                    waiter.wait(StackName=stack['stack_name'])
-                    cfg.get_logger().info("Stack creation finished in  iteration %i out of %i" % (counter + 1, retries))
-                    # Leave the loop upon success
-                    break
-                except botocore.exceptions.WaiterError as e:
-                    if counter == retries - 1:
-                        cfg.get_logger().error(
-                            f"Stack re-creation for {stack['stack_name']} has failed, check the CloudFormation logs."
-                        )
-                        cfg.get_logger().error(e)
-                        Notification.send_notification(
-                            f"Account ID {aws.get_account_id()} aws-ass-start:",
-                            f"Stack re-creation for {stack['stack_name']} has failed, check the CloudFormation logs."
-                        )
-                        raise
-                    else:
-                        cfg.get_logger().warning("Stack creation failed, retrying after deletion ...")
-                        cfg.get_logger().info("Start deletion of stack %s" % stack['stack_name'])
-                        try:
-                            aws.get_boto3_client('cloudformation').delete_stack(StackName=stack['stack_name'])
-                            aws.get_boto3_client('cloudformation').get_waiter('stack_delete_complete') \
-                                .wait(StackName=stack['stack_name'])
-                            cfg.get_logger().info("Deletion of stack %s was successful" % stack['stack_name'])
-                        except Exception:
-                            cfg.get_logger().error("An error occurred while deleting stack {stack['stack_name']}")
-                            cfg.get_logger().error("No use to retry when stack already exists (in a failed state).")
-                            Notification.send_notification(
-                                f"Account ID {aws.get_account_id()} aws-ass-start:",
-                                f"An error occurred while deleting stack {stack['stack_name']}."
-                            )
-                            raise
-
-        else:
-            cfg.get_logger().warning("Skipping creation of stack %s because stack with same name already exists" %
-                                     stack['stack_name'])
+        cfg.get_logger().info("Create the CloudFormation stack from the template of the deleted stack")
+        aws.get_boto3_client('cloudformation').create_stack(**create_arguments)
+        aws.get_inventory().invalidate_stack(stack['stack_name'])
+        return create_arguments
 
     except ClientError as e:
         if e.response['Error']['Code'] == 'AlreadyExistsException':
             cfg.get_logger().warning(
-                "The stack already exists and probably is in a ROLLBACK_COMPLETE state and needs manual removal")
+                "The stack already exists and probably is in a ROLLBACK_COMPLETE or CREATE_FAILED state and needs "
+                "manual removal")
         raise
 
 
 def start_tagged_rds_clusters_and_instances(cfg, aws):
     if os.getenv('ASS_SKIP_RDS', '0') == '1':
-        cfg.get_logger().info(f"Skipping RDS tasks because "
-                              f"envvar ASS_SKIP_RDS is set")
+        cfg.get_logger().info("Skipping RDS tasks because "
+                              "envvar ASS_SKIP_RDS is set")
+        return True
+    if not cfg.is_selected('rds'):
         return True
-
-    def start_rds(rds_type, main_key, identifier_key, arn_key, status_key):
-
-        rds_client = aws.get_boto3_client('rds')
-
-        cfg.get_logger().info(f"Get list of all RDS {rds_type}s")
-        try:
-            if rds_type == 'instance':
-                response = rds_client.describe_db_instances()
-            elif rds_type == 'cluster':
-                response = rds_client.describe_db_clusters()
-            else:
-                raise Exception('rds_type must be one of instance or cluster')
-
-            for item in response[main_key]:
-                identifier = item[identifier_key]
-                arn = item[arn_key]
-                status = item[status_key]
-
-                if (aws.resource_has_tag(rds_client, arn, 'stop_or_start_with_cfn_stacks', 'yes') or
-                        aws.resource_has_tag(rds_client, arn, cfg.full_ass_tag('ass:rds:include'), 'yes')):
-                    cfg.get_logger().info(f"RDS {rds_type} {arn} is tagged with {cfg.full_ass_tag('ass:rds:include')} "
-                                          f"and tag value is yes")
-                    cfg.get_logger().info(f"Starting RDS {rds_type} {arn}")
-                    if status != 'stopped':
-                        cfg.get_logger().info(f"RDS {rds_type} {identifier} in state "
-                                              f"{status} (!= stopped): Skipping start")
-                    elif rds_type == 'instance' and 'DBClusterIdentifier' in item:
-                        # Skip instances that are part of a RDS Cluster, they will be processed
-                        # in the DBCluster part, when rds_type is 'cluster'
-                        cfg.get_logger().info("RDS %s %s is part of RDS Cluster %s: Skipping start".format(
-                            rds_type, item['DBInstanceIdentifier'], item['DBClusterIdentifier']
-                        ))
-                    else:
-                        if rds_type == 'instance':
-                            rds_client.start_db_instance(DBInstanceIdentifier=item['DBInstanceIdentifier'])
-                        elif rds_type == 'cluster':
-                            rds_client.start_db_cluster(DBClusterIdentifier=item['DBClusterIdentifier'])
-
-                        if (aws.resource_has_tag(rds_client, arn, 'start_wait_until_available', 'yes') or
-                                aws.resource_has_tag(
-                                    rds_client, arn, cfg.full_ass_tag('ass:rds:start-wait-until-available'), 'yes')):
-                            cfg.get_logger().info(f"RDS {identifier} is tagged with "
-                                                  f"{cfg.full_ass_tag('ass:rds:start-wait-until-available')} "
-                                                  f"and tag value is yes")
-                            if rds_type == 'cluster':
-                                cfg.get_logger().warning("No waiters in boto3 for Aurora Clusters (yet).")
-                                cfg.get_logger().warning("Cluster start will continue in parallel.")
-                            elif rds_type == 'instance':
-                                cfg.get_logger().info("Waiting until instance {} is available".format(identifier))
-                                rds_client.get_waiter('db_instance_available').wait(DBInstanceIdentifier=identifier)
-                                cfg.get_logger().info("Instance {} is available now".format(identifier))
-                            else:
-                                raise ValueError('rds_type must be one of instance or cluster')
-
-                        else:
-                            cfg.get_logger().info(f"Starting RDS {rds_type} {arn} successfully triggered")
-                else:
-                    cfg.get_logger().info("RDS {} {} is not tagged with {} or tag value is not yes".format(
-                        rds_type, arn, 'stop_or_start_with_cfn_stacks'))
-
-        except NoRegionError:
-            cfg.get_logger().error("No region provided!!!")
-            Notification.send_notification(
-                f"Account ID {aws.get_account_id()} aws-ass-start:",
-                f"No region provided."
-            )
-            raise
-        except NoCredentialsError:
-            cfg.get_logger().error("No credentials provided!!!")
-            Notification.send_notification(
-                f"Account ID {aws.get_account_id()} aws-ass-start:",
-                f"No credentials provided."
-            )
-            raise
-
-        cfg.get_logger().info(f"Finished getting list of all RDS {rds_type}s")
 
     cfg.get_logger().info("Starting RDS clusters and instances tagged with ass:rds:include=yes")
-    start_rds('instance', 'DBInstances', 'DBInstanceIdentifier', 'DBInstanceArn', 'DBInstanceStatus')
-    start_rds('cluster', 'DBClusters', 'DBClusterIdentifier', 'DBClusterArn', 'Status')
-    cfg.get_logger().info("Finished starting RDS clusters and instances tagged with ass:rds:include=yes")
-    cfg.get_logger().info(f"Start sleeping {cfg.sleep_seconds_after_rds_start} seconds after starting RDS clusters and instances")
-    time.sleep(int(cfg.sleep_seconds_after_rds_start))
-    cfg.get_logger().info(f"Done sleeping {cfg.sleep_seconds_after_rds_start} seconds after starting RDS clusters and instances")
-
-
-def resource_has_tag(client, resource_arn, tag_name, tag_value):
     try:
-        response = client.list_tags_for_resource(ResourceName=resource_arn)
-        for tag in response['TagList']:
-            if tag['Key'] == tag_name and tag['Value'] == tag_value:
-                return True
-    except Exception:
-        return False
-
-    return False
-
+        cfg.get_handler_engine(get_notifier(aws)).run(RdsHandler(cfg, aws, 'start'))
+    except NoRegionError:
+        cfg.get_logger().error("No region provided!!!")
+        Notification.send_notification(
+            f"Account ID {aws.get_account_id()} aws-ass-start:",
+            f"No region provided."
+        )
+        raise
+    except NoCredentialsError:
+        cfg.get_logger().error("No credentials provided!!!")
+        Notification.send_notification(
+            f"Account ID {aws.get_account_id()} aws-ass-start:",
+            f"No credentials provided."
+        )
+        raise
+    aws.get_inventory().invalidate('rds_instances')
+    aws.get_inventory().invalidate('rds_clusters')
+    cfg.get_logger().info("Finished starting RDS clusters and instances tagged with ass:rds:include=yes")
+    if int(cfg.sleep_seconds_after_rds_start) > 0:
+        cfg.get_logger().warning("SLEEP_SECONDS_AFTER_RDS_START is deprecated, stacks without the %s tag wait until "
+                                 "all started RDS clusters and instances are available instead of sleeping",
+                                 cfg.full_ass_tag('ass:cfn:depends-on-rds'))
 
 def create_deleted_tagged_cloudformation_stacks(cfg, aws):
     if os.getenv('ASS_SKIP_CLOUDFORMATION', '0') == '1':
-        cfg.get_logger().info(f"Skipping CloudFormation template creation because "
-                              f"envvar ASS_SKIP_CLOUDFORMATION is set")
+        cfg.get_logger().info("Skipping CloudFormation template creation because "
+                              "envvar ASS_SKIP_CLOUDFORMATION is set")
+        return True
+    if not cfg.is_selected('cloudformation'):
         return True
 
     result = get_stack_names_and_creation_order(cfg, aws)
+    workers = cfg.get_prefetch_workers()
+    prepared = dict()
 
-    for stack in sorted(result, key=lambda k: k['stack_deletion_order'], reverse=True):
-        get_stack_template_and_create_template(cfg, aws, stack)
-        cfg.get_logger().info(f"Creation of previously deleted tagged CloudFormation "
-                              f"stack {stack['stack_name']} ended successfully")
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        executor = executor if workers > 0 else None
+        # Stacks that do not wait for a database are created first
+        cfg.get_handler_engine(get_notifier(aws)).run(StackHandler(
+            cfg, aws, 'create', result,
+            lambda stack: get_stack_template_and_create_template(cfg, aws, stack, prepared),
+            prepare_level=lambda stacks: prefetch_stack_level(cfg, aws, executor, stacks, prepared),
+            get_priority=lambda stack: len(get_rds_dependencies(cfg, aws, stack))))
 
-    cfg.get_logger().info(f"Creation of all previously deleted tagged CloudFormation stacks ended successfully")
+    cfg.get_logger().info("Creation of all previously deleted tagged CloudFormation stacks ended successfully")
 
 
 def create_deleted_tagged_beanstalk_environments(cfg, aws):
     if os.getenv('ASS_SKIP_ELASTICBEANSTALK', '0') == '1':
-        cfg.get_logger().info(f"Skipping Elastic Beanstalk tasks because "
-                              f"envvar ASS_SKIP_ELASTICBEANSTALK is set")
+        cfg.get_logger().info("Skipping Elastic Beanstalk tasks because "
+                              "envvar ASS_SKIP_ELASTICBEANSTALK is set")
+        return True
+    if not cfg.is_selected('elasticbeanstalk'):
         return True
 
-    cfg.get_logger().info(f"Start creation of deleted BeanStalk environments tagged with environment_deletion_order")
+    cfg.get_logger().info("Start creation of deleted BeanStalk environments tagged with environment_deletion_order")
+    try:
+        cfg.get_handler_engine(get_notifier(aws)).run(BeanstalkHandler(cfg, aws, 'start'))
+    except LevelFailed:
+        cfg.get_logger().error("Async re-creation of terminated BeanStalk environments failed")
+        raise
+    except TimeBudgetExhausted:
+        raise
+    except Exception as e:
+        cfg.get_logger().error("Async re-creation of terminated BeanStalk environments failed")
+        Notification.send_notification(
+            f"Account ID {aws.get_account_id()} aws-ass-start:",
+            f"Async re-creation of terminated BeanStalk environments failed: {e}")
+        raise
 
-    result = get_deleted_beanstalk_environment_names_and_creation_order(cfg, aws)
+    cfg.get_logger().info("Creation of terminated BeanStalk environments ended")
 
-    for environment in sorted(result, key=lambda k: k['environment_deletion_order'], reverse=True):
-        try:
-            aws.get_boto3_client('elasticbeanstalk').rebuild_environment(EnvironmentId=environment['environment_id'])
-            cfg.get_logger().info(f"Async re-creation of terminated BeanStalk environment "
-                                  f"{environment['environment_name']} ended successfully")
-            cfg.get_logger().info(f"Please allow a few minutes for the environment to start.")
-        except Exception:
-            cfg.get_logger().error(f"Async re-creation of terminated BeanStalk environment "
-                                   f"{environment['environment_name']} failed")
-            Notification.send_notification(
-                f"Account ID {aws.get_account_id()} aws-ass-start:",
-                f"Async re-creation of terminated BeanStalk environment \n"
-                f"{environment['environment_name']} failed")
-            raise
+def restore_s3_lifecycle_configurations(cfg, aws):
+    if not cfg.is_selected('s3'):
+        return True
+
+    state_bucket_name = cfg.get_state_bucket_name(aws.get_region(), aws.get_account_id())
+    s3_client = aws.get_boto3_client('s3')
 
-    cfg.get_logger().info(f"Creation of terminated BeanStalk environments ended")
+    selected_bucket_names = None
+    if cfg.get_selector().has_tags():
+        selected_bucket_names = {bucket['Name'] for bucket in aws.get_inventory().get_buckets()}
+    cfg.get_logger().info("Restore lifecycle configurations of buckets emptied with expiration rules")
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=state_bucket_name, Prefix='s3-lifecycle/'):
+        for obj in page.get('Contents', []):
+            bucket_name = obj['Key'][len('s3-lifecycle/'):-len('.json')]
+            if selected_bucket_names is not None and bucket_name not in selected_bucket_names:
+                continue
+            # The expiration rules must not stay on a bucket in use, even when they have not emptied it yet
+            if datetime.datetime.now(datetime.timezone.utc) - obj['LastModified'] < datetime.timedelta(days=2):
+                cfg.get_logger().warning("Expiration rules of bucket %s were applied less than 2 days ago, the "
+                                         "bucket may not be empty yet", bucket_name)
+            try:
+                aws.restore_bucket_lifecycle(bucket_name, state_bucket_name)
+            except ClientError as e:
+                cfg.get_logger().error("Restoring the lifecycle configuration of bucket %s failed: %s", bucket_name, e)
+                Notification.send_notification(
+                    f"Account ID {aws.get_account_id()} aws-ass-start:",
+                    f"Restoring the lifecycle configuration of bucket {bucket_name} failed"
+                )
+                raise
 
 
 def restore_s3_backup(cfg, aws):
-    s3_client = aws.get_boto3_client('s3')
+    if not cfg.is_selected('s3'):
+        return True
+
+    archive = cfg.get_s3_archive(aws.get_boto3_client('s3'))
+    snapshot = aws.get_s3_snapshot(cfg.get_state_bucket_name(aws.get_region(), aws.get_account_id()))
+    engine = cfg.get_async_engine(aws.get_region(), aws.get_boto3_client('s3'))
+    backup_bucket_name = cfg.get_backup_bucket_name(aws.get_region(), aws.get_account_id())
+    queue = None
+    if engine is None and cfg.get_work_queue_enabled():
+        queue = aws.get_work_queue(cfg.get_state_bucket_name(aws.get_region(), aws.get_account_id()),
+                                   'aws-ass-start-bucket-restore')
+    async_bucket_acls = dict()
+    work_units = []
 
     try:
         cfg.get_logger().info("Start getting bucket names")
-        response = s3_client.list_buckets()
-        s3_list = response['Buckets']
-        cfg.get_logger().debug(response)
-        cfg.get_logger().debug(s3_list)
+        s3_list = aws.get_inventory().get_buckets()
+        cfg.get_logger().debug("Found %s buckets", len(s3_list))
         cfg.get_logger().info("Getting bucket names finished successfully")
         for bucket in s3_list:
             bucket_name = bucket['Name']
             bucket_arn = f"arn:aws:s3:::{bucket_name}"
-            cfg.get_logger().debug(f"Checking bucket {bucket_name} ({bucket_arn})")
+            cfg.get_logger().debug("Checking bucket %s (%s)", bucket_name, bucket_arn)
             if aws.s3_has_tag(bucket_name, cfg.full_ass_tag("ass:s3:backup-and-empty-bucket-on-stop"), "yes"):
-                cfg.get_logger().info(f"Bucket {bucket_name} will be restored")
-                aws.restore_bucket(bucket_name, cfg.get_backup_bucket_name(aws.get_region(), aws.get_account_id()))
+                cfg.get_logger().info("Bucket %s will be restored", bucket_name)
+                # A snapshot is restored whatever ASS_S3_BACKUP_MODE is now
+                if snapshot.has_manifest(bucket_name):
+                    with log_context(bucket=bucket_name), \
+                            cfg.get_time_budget().unit('bucket-snapshot-restore', bucket_name):
+                        snapshot.restore(bucket_name)
+                elif engine is not None and not archive.has_archive(bucket_name, backup_bucket_name):
+                    async_bucket_acls[bucket_name] = aws.get_restore_acl(bucket_name)
+                elif queue is not None and not archive.has_archive(bucket_name, backup_bucket_name):
+                    with log_context(bucket=bucket_name):
+                        work_units.extend(aws.plan_bucket_restore(bucket_name, backup_bucket_name))
+                elif not cfg.get_time_budget().is_unit_finished('bucket-restore', bucket_name):
+                    with log_context(bucket=bucket_name), cfg.get_time_budget().unit('bucket-restore', bucket_name):
+                        aws.restore_bucket(bucket_name, backup_bucket_name, archive)
+        if len(async_bucket_acls) > 0:
+            cfg.get_run_history().record_all('bucket-restore',
+                                             engine.restore_buckets(async_bucket_acls, backup_bucket_name))
+        if len(work_units) > 0:
+            with cfg.get_run_history().measure('bucket-restore-queue', queue.name):
+                queue.plan(work_units)
+                try:
+                    queue.drain(aws.get_work_handlers())
+                finally:
+                    # Also when the run failed, so the workers do not wait for a queue that is never finished
+                    queue.close()
     except NoRegionError:
         cfg.get_logger().error("No region provided!!!")
         Notification.send_notification(
@@ -433,32 +437,131 @@ def restore_s3_backup(cfg, aws):
         raise
 
 
-def main():
-    cfg = Config("aws-ass-start")
-    aws = AWS(cfg.get_logger())
+def get_discovery_sections(cfg):
+    sections = ['s3']
+    if os.getenv('ASS_SKIP_RDS', '0') != '1':
+        sections.extend(['rds_instances', 'rds_clusters'])
+    if os.getenv('ASS_SKIP_CLOUDFORMATION', '0') != '1':
+        sections.append('cloudformation')
+    if os.getenv('ASS_SKIP_ELASTICBEANSTALK', '0') != '1':
+        sections.append('elasticbeanstalk_terminated')
+    return [section for section in sections if cfg.get_selector().allows_section(section)]
 
-    try:
-        cfg.get_logger().info(f"Region:       {aws.get_region()}")
-        cfg.get_logger().info(f"AccountId:    {aws.get_account_id()}")
-        cfg.get_logger().info(f"State Bucket: {cfg.get_state_bucket_name(aws.get_region(), aws.get_account_id())}")
 
-        aws.create_bucket(cfg.get_template_bucket_name())
+def get_start_scheduler(cfg, aws):
+    """
+    Declare the start phases as a dependency graph: RDS is started before the stacks are created, BeanStalk
+    environments and bucket contents are restored after the stacks (that may own the buckets) exist again.
+    """
+    scheduler = cfg.get_scheduler()
+    scheduler.add_phase('start_tagged_rds_clusters_and_instances',
+                        lambda: start_tagged_rds_clusters_and_instances(cfg, aws))
+    scheduler.add_phase('restore_s3_lifecycle_configurations', lambda: restore_s3_lifecycle_configurations(cfg, aws))
+    scheduler.add_phase('create_deleted_tagged_cloudformation_stacks',
+                        lambda: create_deleted_tagged_cloudformation_stacks(cfg, aws),
+                        ['start_tagged_rds_clusters_and_instances'])
+    scheduler.add_phase('create_deleted_tagged_beanstalk_environments',
+                        lambda: create_deleted_tagged_beanstalk_environments(cfg, aws),
+                        ['create_deleted_tagged_cloudformation_stacks'])
+    scheduler.add_phase('restore_s3_backup', lambda: restore_s3_backup(cfg, aws),
+                        ['restore_s3_lifecycle_configurations', 'create_deleted_tagged_cloudformation_stacks'])
+    return scheduler
+
+
+def record_rds_start_durations(cfg, aws):
+    cfg.get_run_history().record_all('rds-start', aws.get_rds_gate().get_durations())
+
+
+def check_predicted_duration(cfg, aws, scheduler):
+    """
+    Log the run time predicted from the run history, and send a notification when it exceeds ASS_RUN_WINDOW.
+    """
+    predicted = scheduler.predict_duration()
+    cfg.get_logger().info("Predicted run time is %.0f seconds", predicted)
+    window = cfg.get_run_window()
+    if window is not None and predicted > window:
+        cfg.get_logger().warning("Predicted run time of %.0f seconds exceeds the window of %s seconds",
+                                 predicted, window)
+        Notification.send_notification(
+            f"Account ID {aws.get_account_id()} aws-ass-start:",
+            f"Predicted run time of {predicted:.0f} seconds exceeds the window of {window} seconds"
+        )
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description='Start the tagged resources of an AWS account')
+    parser.add_argument('--time-budget', type=int, default=None,
+                        help='Seconds the run may take, the run stops starting new work when the remaining time is '
+                             'less than the work needed before and exits with ASS_CONTINUE_EXIT_CODE (default 75)')
+    parser.add_argument('--select', action='append', default=None, metavar='EXPRESSION',
+                        help='Only start the selected resources: stack=<name prefix>, tag=<key>[=<value>], '
+                             'type=cloudformation|s3|rds|elasticbeanstalk or order=<min>[-<max>], can be repeated')
+    parser.add_argument('--force', action='store_true',
+                        help='Start the resources, also when the last run was a completed start and the stacks did not '
+                             'change since')
+    parser.add_argument('--plan', action='store_true',
+                        help='Show the phases that would run, with the durations of the previous runs, and exit '
+                             'without changing anything')
+    return parser.parse_args(argv)
+
+
+def main(argv=None, aws=None):
+    """
+    Run the script with the command line arguments argv. The daemon passes its warm AWS object.
+    """
+    arguments = parse_arguments(argv)
+    cfg = Config("aws-ass-start")
+    aws = aws or AWS(cfg.get_logger())
+    run_state = False
 
-        start_tagged_rds_clusters_and_instances(cfg, aws)
-        create_deleted_tagged_cloudformation_stacks(cfg, aws)
-        create_deleted_tagged_beanstalk_environments(cfg, aws)
-        restore_s3_backup(cfg, aws)
+    try:
+        cfg.get_logger().info("Region:       %s", aws.get_region())
+        cfg.get_logger().info("AccountId:    %s", aws.get_account_id())
+        cfg.get_logger().info("State Bucket: %s", cfg.get_state_bucket_name(aws.get_region(), aws.get_account_id()))
+
+        cfg.init_selector(arguments.select)
+        state_bucket_name = cfg.get_state_bucket_name(aws.get_region(), aws.get_account_id())
+        run_marker = cfg.get_run_marker(aws, state_bucket_name)
+        if not arguments.force and cfg.get_selector().is_empty() and run_marker.is_repeat('start'):
+            cfg.get_logger().info("Nothing to start, use --force to start again")
+            return
+        aws.get_inventory().set_selector(cfg.get_selector())
+        aws.get_inventory().discover(get_discovery_sections(cfg), operation='start')
+
+        cfg.init_run_state(aws.get_boto3_client('s3'), state_bucket_name, 'aws-ass-start', arguments.time_budget)
+        scheduler = get_start_scheduler(cfg, aws)
+        if arguments.plan:
+            scheduler.log_plan()
+            return
+        run_marker.begin('start', None if cfg.get_selector().is_empty() else str(cfg.get_selector()))
+        run_state = True
+        check_predicted_duration(cfg, aws, scheduler)
+        scheduler.run()
+        record_rds_start_durations(cfg, aws)
+        cfg.save_run_state(completed=True)
+        if cfg.get_selector().is_empty():
+            run_marker.complete('start')
+    except TimeBudgetExhausted as e:
+        cfg.get_logger().warning("%s, start aws-ass-start again to continue", e)
+        record_rds_start_durations(cfg, aws)
+        cfg.save_run_state()
+        sys.exit(cfg.get_time_budget().exit_code)
     except Exception as e:
+        if run_state:
+            record_rds_start_durations(cfg, aws)
+            cfg.save_run_state()
         cfg.get_logger().error("An exception occurred")
         cfg.get_logger().error(e)
-        Notification.send_notification(
-            f"Account ID {aws.get_account_id()} aws-ass-start:",
-            f"An exception occured"
-        )
+        # The failure of a level was notified when it happened
+        if not isinstance(e, LevelFailed):
+            Notification.send_notification(
+                f"Account ID {aws.get_account_id()} aws-ass-start:",
+                f"An exception occured"
+            )
+        return False
     finally:
-        if cfg.get_template_bucket_name():
-            aws.remove_bucket(cfg.get_template_bucket_name())
         logging.shutdown()
 
 
-main()
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,25 @@
 import time
 
-import boto3
+import argparse
+import functools
 import logging
 import json
 import os
+import sys
 from ASS import Config
 from ASS import AWS
+from ASS import BeanstalkHandler
+from ASS import BucketHandler
+from ASS import LevelFailed
 from ASS import Notification
+from ASS import RdsHandler
+from ASS import StackHandler
+from ASS import log_context
+from ASS import TimeBudgetExhausted
 
 from botocore.exceptions import ClientError
 from botocore.exceptions import NoRegionError
 from botocore.exceptions import NoCredentialsError
-from botocore.exceptions import WaiterError
 
 
 def is_nested_stack(stack):
@@ -23,9 +31,8 @@ def get_stack_names_and_deletion_order(cfg, aws, client):
 
     try:
         cfg.get_logger().info('Getting all CloudFormation Stacks ...')
-        response = client.describe_stacks()
+        stack_list = aws.get_inventory().get('cloudformation')
         cfg.get_logger().info('Successfully finished getting all CloudFormation templates')
-        stack_list = response['Stacks']
     except NoRegionError as e:
         cfg.get_logger().error("No region provided!!!")
         Notification.send_notification(
@@ -39,7 +46,7 @@ def get_stack_names_and_deletion_order(cfg, aws, client):
             for tag in stack['Tags']:
                 if (tag['Key'] == 'stack_deletion_order' or
                         tag['Key'] == cfg.full_ass_tag('ass:cfn:deletion-order')) and int(tag['Value']) > 0:
-                    if not is_nested_stack(stack):
+                    if not is_nested_stack(stack) and cfg.get_selector().matches_order(int(tag['Value'])):
                         if 'Parameters' in stack:
                             parameters = stack['Parameters']
                         else:
@@ -50,80 +57,79 @@ def get_stack_names_and_deletion_order(cfg, aws, client):
                                       "stack_deletion_order": int(tag['Value']),
                                       "stack_parameters": parameters
                                       }
+                        save_stack_template_to_state_bucket(cfg, aws, this_stack)
                         save_stack_parameters_to_state_bucket(cfg, aws, this_stack)
                         result.append(this_stack)
     return result
 
 
-def get_beanstalk_env_names_and_deletion_order(cfg, aws, client):
-    result = []
+def delete_stack(cfg, client, stack, aws):
+    """
+    Start the deletion of the stack, waiting for the deletion is done for all stacks of an order level at once
+    by the StackHandler.
+    """
+    with log_context(stack=stack['stack_name']):
+        cfg.get_logger().info("Start deletion of stack %s (deletion order is %i)",
+                              stack['stack_name'], stack['stack_deletion_order'])
+        client.delete_stack(StackName=stack['stack_name'])
+        aws.get_inventory().invalidate_stack(stack['stack_name'])
 
-    try:
-        cfg.get_logger().info('Getting all BeanStalk environments ...')
-        response = client.describe_environments()
-        cfg.get_logger().info('Successfully finished getting all BeanStalk environments')
-        env_list = response['Environments']
-    except NoRegionError as e:
-        cfg.get_logger().error("No region provided!!!")
-        Notification.send_notification(
-            f"Account ID {aws.get_account_id()} aws-ass-stop:",
-            f"No region provided."
-        )
-        raise e
+    return True
 
-    for environment in env_list:
-        try:
-            for tag in client.list_tags_for_resource(ResourceArn=environment['EnvironmentArn'])['ResourceTags']:
-                if tag['Key'] == 'environment_deletion_order' and int(tag['Value']) > 0:
-                    result.append({"environment_name": environment['EnvironmentName'],
-                                   "environment_id": environment['EnvironmentId'],
-                                   "environment_arn": environment['EnvironmentArn'],
-                                   "environment_deletion_order": int(tag['Value'])
-                                   })
-        except:
-            cfg.get_logger().error(f"Resource {environment['EnvironmentArn']} not found, continuing.")
-    return result
 
+def get_notifier(aws):
+    """
+    Return a function that sends a notification about this run.
+    """
+    return functools.partial(Notification.send_notification, f"Account ID {aws.get_account_id()} aws-ass-stop:")
 
-def delete_stack(cfg, client, stack, aws):
-    waiter = client.get_waiter('stack_delete_complete')
 
-    try:
-        cfg.get_logger().info("Start deletion of stack %s (deletion order is %i)" %
-                              (stack['stack_name'], stack['stack_deletion_order']))
-        client.delete_stack(StackName=stack['stack_name'])
-        waiter.wait(StackName=stack['stack_name'])
-    except WaiterError as e:
-        cfg.get_logger().error(
-            f"Stack deletion for {stack['stack_name']} has failed, check the CloudFormation logs.")
-        cfg.get_logger().error(e)
-        Notification.send_notification(
-            f"Account ID {aws.get_account_id()} aws-ass-stop:",
-            f"Stack deletion for {stack['stack_name']} has failed, check the CloudFormation logs."
-        )
-        raise
-    except Exception as e:
-        raise e
+def get_deleted_stack_names(cfg, aws):
+    """
+    Return the names of the stacks deleted by this run, their nested stacks included.
+    """
+    selector = cfg.get_selector()
+    stack_list = aws.get_inventory().get('cloudformation')
+    stack_ids = set()
+    for stack in stack_list:
+        orders = [int(tag['Value']) for tag in stack.get('Tags', [])
+                  if tag['Key'] in ['stack_deletion_order', cfg.full_ass_tag('ass:cfn:deletion-order')]]
+        if not is_nested_stack(stack) and any(order > 0 and selector.matches_order(order) for order in orders):
+            stack_ids.add(stack['StackId'])
+    return {stack['StackName'] for stack in stack_list
+            if stack['StackId'] in stack_ids or stack.get('RootId') in stack_ids}
 
-    return True
 
+def get_selected_stack_names(cfg, aws):
+    """
+    Return the names of the stacks deleted by a run narrowed by a selection, or None when the run is not narrowed.
+    """
+    if cfg.get_selector().is_empty():
+        return None
+    return get_deleted_stack_names(cfg, aws)
 
-def terminate_beanstalk_environment(cfg, aws, client, environment):
-    try:
-        cfg.get_logger().info("Start deletion of environment %s (deletion order is %i)" %
-                              (environment['environment_name'], environment['environment_deletion_order']))
-        client.terminate_environment(EnvironmentName=environment['environment_name'])
-    except Exception as e:
-        cfg.get_logger().error(
-            f"Environment deletion for {environment['environment_name']} has failed, check the logs.")
-        cfg.get_logger().error(e)
-        Notification.send_notification(
-            f"Account ID {aws.get_account_id()} aws-ass-stop:",
-            f"Stack deletion for {environment['environment_name']} has failed, check the CloudFormation logs."
-        )
-        raise
 
-    return True
+def is_owned_by_stacks(tags, stack_names):
+    """
+    Return True when tags (a list of dicts with Key and Value) show that the resource was created by one of the
+    stacks in stack_names, or when stack_names is None.
+    """
+    return stack_names is None or any(tag['Key'] == 'aws:cloudformation:stack-name' and tag['Value'] in stack_names
+                                      for tag in tags)
+
+
+def get_stack_load_balancers(lb_client, lb_list, stack_names):
+    """
+    Return the load balancers of lb_list created by the stacks in stack_names.
+    """
+    lb_arns = [lb['LoadBalancerArn'] for lb in lb_list]
+    owned = set()
+    # describe_tags accepts up to 20 load balancers
+    for start in range(0, len(lb_arns), 20):
+        for description in lb_client.describe_tags(ResourceArns=lb_arns[start:start + 20])['TagDescriptions']:
+            if is_owned_by_stacks(description['Tags'], stack_names):
+                owned.add(description['ResourceArn'])
+    return [lb for lb in lb_list if lb['LoadBalancerArn'] in owned]
 
 
 def get_lb_access_log_bucket(cfg, lb_client, lb, aws):
@@ -155,18 +161,19 @@ def get_lb_access_log_bucket(cfg, lb_client, lb, aws):
 
 
 def empty_bucket(cfg, bucket, aws):
+    if not aws.get_inventory().claim_bucket_emptying(bucket):
+        return
+
     try:
-        cfg.get_logger().info(f"Connect to bucket {bucket}")
-        s3 = boto3.resource('s3')
-        bucket = s3.Bucket(bucket)
-        cfg.get_logger().info(f"Start deletion of all objects in bucket {bucket}")
-        bucket.objects.all().delete()
-        cfg.get_logger().info(f"Finished deletion of all objects in bucket {bucket}")
+        cfg.get_logger().info("Connect to bucket %s", bucket)
+        cfg.get_logger().info("Start deletion of all objects in bucket %s", bucket)
+        aws.delete_all_objects(bucket)
+        cfg.get_logger().info("Finished deletion of all objects in bucket %s", bucket)
     except ClientError as e:
         if e.response['Error']['Code'] == 'NoSuchBucket':
-            cfg.get_logger().warning(f"Bucket ({bucket}) does not exist error when deleting objects, continuing")
+            cfg.get_logger().warning("Bucket (%s) does not exist error when deleting objects, continuing", bucket)
     except Exception as e:
-        cfg.get_logger().error(f"Error occurred while deleting all objects in {bucket}")
+        cfg.get_logger().error("Error occurred while deleting all objects in %s", bucket)
         cfg.get_logger().debug(e)
         Notification.send_notification(
             f"Account ID {aws.get_account_id()} aws-ass-stop: ",
@@ -177,7 +184,7 @@ def empty_bucket(cfg, bucket, aws):
 
 def disable_lb_access_logs(cfg, lb_client, lb, aws):
     try:
-        cfg.get_logger().info("Disable access logs for loadbalancer %s" % lb)
+        cfg.get_logger().info("Disable access logs for loadbalancer %s", lb)
         lb_client.modify_load_balancer_attributes(
             LoadBalancerArn=lb,
             Attributes=[
@@ -187,9 +194,9 @@ def disable_lb_access_logs(cfg, lb_client, lb, aws):
                 },
             ]
         )
-        cfg.get_logger().info(f"Access logs for loadbalancer {lb} successfully disabled")
+        cfg.get_logger().info("Access logs for loadbalancer %s successfully disabled", lb)
     except Exception:
-        cfg.get_logger().error(f"An error occurred while disabling the loadbalancer access logs")
+        cfg.get_logger().error("An error occurred while disabling the loadbalancer access logs")
         Notification.send_notification(
             f"Account ID {aws.get_account_id()} aws-ass-stop:",
             f"An error occurred while disabling the loadbalancer access logs"
@@ -198,20 +205,53 @@ def disable_lb_access_logs(cfg, lb_client, lb, aws):
 
 
 def backup_tagged_buckets(cfg, aws):
+    if not cfg.is_selected('s3'):
+        return True
+
+    if cfg.get_s3_backup_mode() == 'snapshot':
+        return snapshot_tagged_buckets(cfg, aws)
+
     backup_bucket_name = cfg.get_backup_bucket_name(aws.get_region(), aws.get_account_id())
     aws.create_bucket(backup_bucket_name, True)
+    archive = cfg.get_s3_archive(aws.get_boto3_client('s3')) if cfg.get_s3_backup_mode() == 'archive' else None
+    engine = cfg.get_async_engine(aws.get_region(), aws.get_boto3_client('s3')) if archive is None else None
+    queue = None
+    if archive is None and engine is None and cfg.get_work_queue_enabled():
+        queue = aws.get_work_queue(cfg.get_state_bucket_name(aws.get_region(), aws.get_account_id()),
+                                   'aws-ass-stop-bucket-backup')
+    async_bucket_names = []
+    work_units = []
 
-    s3_resource = boto3.resource('s3', region_name=aws.get_region())
     try:
         cfg.get_logger().info("Start getting S3-Buckets")
-        for bucket in s3_resource.buckets.all():
-            bucket_name = bucket.name
-            cfg.get_logger().debug(f"Checking bucket {bucket_name} for backup-and-empty tags")
+        for bucket in aws.get_inventory().get_buckets():
+            bucket_name = bucket['Name']
+            cfg.get_logger().debug("Checking bucket %s for backup-and-empty tags", bucket_name)
             if aws.s3_has_tag(bucket_name, cfg.full_ass_tag("ass:s3:backup-and-empty-bucket-on-stop"), "yes"):
-                cfg.get_logger().info(f"Bucket {bucket_name} will be backed up")
-                aws.backup_bucket(bucket_name, backup_bucket_name)
+                cfg.get_logger().info("Bucket %s will be backed up", bucket_name)
+                if engine is not None:
+                    async_bucket_names.append(bucket_name)
+                elif queue is not None:
+                    with log_context(bucket=bucket_name):
+                        work_units.extend(aws.plan_bucket_backup(bucket_name, backup_bucket_name))
+                elif not cfg.get_time_budget().is_unit_finished('bucket-backup', bucket_name):
+                    with log_context(bucket=bucket_name), cfg.get_time_budget().unit('bucket-backup', bucket_name):
+                        aws.backup_bucket(bucket_name, backup_bucket_name, archive)
+        if len(async_bucket_names) > 0:
+            cfg.get_run_history().record_all('bucket-backup',
+                                             engine.backup_buckets(async_bucket_names, backup_bucket_name))
+        if len(work_units) > 0:
+            with cfg.get_run_history().measure('bucket-backup-queue', queue.name):
+                queue.plan(work_units)
+                try:
+                    queue.drain(aws.get_work_handlers())
+                finally:
+                    # Also when the run failed, so the workers do not wait for a queue that is never finished
+                    queue.close()
+    except TimeBudgetExhausted:
+        raise
     except Exception as e:
-        cfg.get_logger().error(f"An error occurred while taking a backup of the buckets")
+        cfg.get_logger().error("An error occurred while taking a backup of the buckets")
         Notification.send_notification(
             f"Account ID {aws.get_account_id()} aws-ass-stop:",
             f"An error occurred while taking a backup of the buckets"
@@ -220,13 +260,48 @@ def backup_tagged_buckets(cfg, aws):
         raise
 
 
+def snapshot_tagged_buckets(cfg, aws):
+    """
+    Empty the buckets tagged for backup by hiding their objects behind delete markers (ASS_S3_BACKUP_MODE=snapshot).
+    The buckets are claimed for emptying, so they are not emptied again in this run.
+    """
+    snapshot = aws.get_s3_snapshot(cfg.get_state_bucket_name(aws.get_region(), aws.get_account_id()))
+    try:
+        cfg.get_logger().info("Start getting S3-Buckets")
+        for bucket in aws.get_inventory().get_buckets():
+            bucket_name = bucket['Name']
+            cfg.get_logger().debug("Checking bucket %s for backup-and-empty tags", bucket_name)
+            if aws.s3_has_tag(bucket_name, cfg.full_ass_tag("ass:s3:backup-and-empty-bucket-on-stop"), "yes"):
+                cfg.get_logger().info("Bucket %s will be snapshotted", bucket_name)
+                if aws.get_inventory().claim_bucket_emptying(bucket_name) and \
+                        not cfg.get_time_budget().is_unit_finished('bucket-snapshot', bucket_name):
+                    with log_context(bucket=bucket_name), cfg.get_time_budget().unit('bucket-snapshot', bucket_name):
+                        snapshot.take(bucket_name)
+    except TimeBudgetExhausted:
+        raise
+    except Exception as e:
+        cfg.get_logger().error("An error occurred while taking a snapshot of the buckets")
+        Notification.send_notification(
+            f"Account ID {aws.get_account_id()} aws-ass-stop:",
+            f"An error occurred while taking a snapshot of the buckets"
+            f"Details: \n Account-id: {aws.get_account_id()} \n Traceback: \n{e}"
+        )
+        raise
+
+
 def empty_lb_access_log_buckets(cfg, aws):
-    lb_client = boto3.client('elbv2', region_name=aws.get_region())
+    if not cfg.is_selected('cloudformation'):
+        return True
+
+    lb_client = aws.get_boto3_client('elbv2')
 
     try:
         cfg.get_logger().info("Start getting LB ARNs")
-        response = lb_client.describe_load_balancers()
-        lb_list = response['LoadBalancers']
+        lb_list = aws.get_inventory().get('elbv2')
+        stack_names = get_selected_stack_names(cfg, aws)
+        if stack_names is not None:
+            # A selection only empties the access log buckets of the load balancers of the selected stacks
+            lb_list = get_stack_load_balancers(lb_client, lb_list, stack_names)
         cfg.get_logger().info("Getting LB ARNs finished successfully")
     except NoRegionError:
         cfg.get_logger().error("No region provided!!!")
@@ -253,15 +328,45 @@ def empty_lb_access_log_buckets(cfg, aws):
             empty_bucket(cfg, bucket, aws)
 
 
+def get_empty_strategy(cfg, aws, bucket_name):
+    """
+    Return 'lifecycle' when the bucket should be emptied by expiration lifecycle rules, 'delete' when the objects
+    should be deleted by this script. The ass:s3:empty-strategy tag wins, otherwise the estimated object count
+    is compared with ASS_S3_LIFECYCLE_THRESHOLD (0 disables the lifecycle strategy).
+
+    Expiration rules take a day or more, so a bucket of a stack deleted by this run is always emptied by deleting
+    the objects (deleting the stack fails for a bucket that is not empty), and a bucket created by a stack is
+    never emptied with lifecycle rules unless it is tagged so.
+    """
+    tags = aws.get_inventory().get_bucket_tags(bucket_name)
+    stack_names = [tag['Value'] for tag in tags if tag['Key'] == 'aws:cloudformation:stack-name']
+    if aws.s3_has_tag(bucket_name, cfg.full_ass_tag('ass:s3:empty-strategy'), 'delete'):
+        cfg.get_logger().info("Bucket %s is tagged with empty strategy delete", bucket_name)
+        return 'delete'
+    if aws.s3_has_tag(bucket_name, cfg.full_ass_tag('ass:s3:empty-strategy'), 'lifecycle'):
+        if len(stack_names) > 0 and stack_names[0] in get_deleted_stack_names(cfg, aws):
+            cfg.get_logger().warning("Bucket %s is tagged with empty strategy lifecycle, but its stack %s is deleted "
+                                     "by this run, deleting the objects", bucket_name, stack_names[0])
+            return 'delete'
+        cfg.get_logger().info("Bucket %s is tagged with empty strategy lifecycle", bucket_name)
+        return 'lifecycle'
+
+    threshold = cfg.get_s3_lifecycle_threshold()
+    if threshold <= 0 or any(tag['Key'].startswith('aws:cloudformation:') for tag in tags):
+        return 'delete'
+
+    object_count = aws.estimate_object_count(bucket_name, cfg.get_s3_count_sample_pages())
+    cfg.get_logger().info("Bucket %s holds about %s objects (threshold is %s)", bucket_name, object_count, threshold)
+    return 'lifecycle' if object_count >= threshold else 'delete'
+
+
 def empty_tagged_s3_buckets(cfg, aws):
-    s3client = boto3.client('s3', region_name=aws.get_region())
+    if not cfg.is_selected('s3'):
+        return True
+
     try:
-        cfg.get_logger().info("Start getting bucket names")
-        response = s3client.list_buckets()
-        s3_list = response['Buckets']
-        cfg.get_logger().debug(response)
-        cfg.get_logger().debug(s3_list)
-        cfg.get_logger().info("Getting bucket names finished successfully")
+        cfg.get_handler_engine(get_notifier(aws)).run(
+            BucketHandler(cfg, aws, 'empty', lambda bucket_name: get_empty_strategy(cfg, aws, bucket_name)))
     except NoRegionError:
         cfg.get_logger().error("No region provided!!!")
         Notification.send_notification(
@@ -276,6 +381,8 @@ def empty_tagged_s3_buckets(cfg, aws):
             f"No credentials provided!!!"
         )
         raise
+    except (LevelFailed, TimeBudgetExhausted):
+        raise
     except Exception as e:
         cfg.get_logger().error("Empty_tagged_s3_buckets error!!!")
         Notification.send_notification(
@@ -285,26 +392,26 @@ def empty_tagged_s3_buckets(cfg, aws):
         )
         raise
 
-    for bucket in s3_list:
-        bucket_name = bucket['Name']
-        bucket_arn = f"arn:aws:s3:::{bucket_name}"
-        cfg.get_logger().debug(f"Checking bucket {bucket_name} ({bucket_arn})")
-        if (aws.s3_has_tag(bucket_name, cfg.full_ass_tag("ass:s3:clean-bucket-on-stop"), "yes") or
-            aws.s3_has_tag(bucket_name, cfg.full_ass_tag("ass:s3:backup-and-empty-bucket-on-stop"), "yes")):
-            cfg.get_logger().info(f"Bucket {bucket_name} will be cleaned")
-            aws.empty_bucket(bucket)
-
 
 def empty_cloudfront_access_log_buckets(cfg, aws):
-    s3_client = boto3.client('s3', region_name=aws.get_region())
-    cloudfront_client = boto3.client('cloudfront', region_name=aws.get_region())
+    if not cfg.is_selected('cloudformation'):
+        return True
+
+    s3_client = aws.get_boto3_client('s3')
+    cloudfront_client = aws.get_boto3_client('cloudfront')
 
     try:
-        if 'Items' in cloudfront_client.list_distributions()['DistributionList']:
+        cf_distibution_items = aws.get_inventory().get('cloudfront')
+        stack_names = get_selected_stack_names(cfg, aws)
+        if len(cf_distibution_items) > 0:
             cfg.get_logger().info("Cloudfront distribution found")
-            cf_distibution_items = cloudfront_client.list_distributions()['DistributionList']['Items']
 
             for distro in cf_distibution_items:
+                # A selection only empties the access log buckets of the distributions of the selected stacks
+                if stack_names is not None and not is_owned_by_stacks(
+                        cloudfront_client.list_tags_for_resource(Resource=distro['ARN'])['Tags']['Items'],
+                        stack_names):
+                    continue
                 if (int(aws.resource_has_tag(cloudfront_client, distro['ARN'], 'stack_deletion_order')) > 0 or
                         int(aws.resource_has_tag(cloudfront_client, distro['ARN'], cfg.full_ass_tag('ass:cfn:deletion-order'))) > 0):
                     # Distro Id
@@ -320,23 +427,24 @@ def empty_cloudfront_access_log_buckets(cfg, aws):
 
                     if ".s3.amazonaws.com" in distrib_log_bucket:
                         bucket = s3_client.list_objects_v2(Bucket=distrib_log_bucket[:-17])
-                        cfg.get_logger().info(f"Found the Bucket {bucket['Name']}")
+                        cfg.get_logger().info("Found the Bucket %s", bucket['Name'])
 
                         if distrib_config['Logging']['Enabled'] is True:
-                            cfg.get_logger().info(f"Disable Cloudfront logging ID: {distrib_id}")
+                            cfg.get_logger().info("Disable Cloudfront logging ID: %s", distrib_id)
                             distrib_config['Logging']['Enabled'] = False
                             response = cloudfront_client.update_distribution(Id=distrib_id,
                                                                              DistributionConfig=distrib_config,
                                                                              IfMatch=distrib_etag)
+                            aws.get_inventory().invalidate('cloudfront')
                             if response['ResponseMetadata']['HTTPStatusCode'] == 200:
                                 if 'Contents' in bucket:
                                     aws.empty_bucket(bucket)
                                 else:
-                                    cfg.get_logger().info(f"Bucket already empty: {bucket['Name']}")
+                                    cfg.get_logger().info("Bucket already empty: %s", bucket['Name'])
                             else:
-                                cfg.get_logger().warning(f"Error during disabling cloudfront logging ID: {distrib_id}")
+                                cfg.get_logger().warning("Error during disabling cloudfront logging ID: %s", distrib_id)
                     else:
-                        cfg.get_logger().info(f"Cloudfront logging disabled ID: {distrib_id}")
+                        cfg.get_logger().info("Cloudfront logging disabled ID: %s", distrib_id)
                         cfg.get_logger().info("No Cloudfront logging bucket found!")
         else:
             cfg.get_logger().info("No Cloudfront distribution")
@@ -363,125 +471,126 @@ def empty_cloudfront_access_log_buckets(cfg, aws):
         raise
 
 
-def do_pre_deletion_tasks(cfg, aws):
+def add_pre_deletion_tasks(cfg, aws, scheduler):
+    """
+    Add the pre deletion tasks to the scheduler and return their names. Buckets are backed up before any
+    bucket is emptied.
+    """
     if os.getenv('ASS_SKIP_PREDELETIONTASKS', '0') == '1':
-        cfg.get_logger().info(f"Skipping pre deletion tasks because "
-                              f"envvar ASS_SKIP_PREDELETIONTASKS is set")
-        return True
-    empty_cloudfront_access_log_buckets(cfg, aws)
-    backup_tagged_buckets(cfg, aws)
-    empty_lb_access_log_buckets(cfg, aws)
-    empty_tagged_s3_buckets(cfg, aws)
+        cfg.get_logger().info("Skipping pre deletion tasks because "
+                              "envvar ASS_SKIP_PREDELETIONTASKS is set")
+        return []
 
-    return True
+    scheduler.add_phase('empty_cloudfront_access_log_buckets', lambda: empty_cloudfront_access_log_buckets(cfg, aws))
+    scheduler.add_phase('backup_tagged_buckets', lambda: backup_tagged_buckets(cfg, aws))
+    scheduler.add_phase('empty_lb_access_log_buckets', lambda: empty_lb_access_log_buckets(cfg, aws),
+                        ['backup_tagged_buckets'])
+    scheduler.add_phase('empty_tagged_s3_buckets', lambda: empty_tagged_s3_buckets(cfg, aws),
+                        ['backup_tagged_buckets'])
 
+    return ['empty_cloudfront_access_log_buckets', 'backup_tagged_buckets', 'empty_lb_access_log_buckets',
+            'empty_tagged_s3_buckets']
 
-def stop_tagged_rds_clusters_and_instances(cfg, aws):
-    if os.getenv('ASS_SKIP_RDS', '0') == '1':
-        cfg.get_logger().info(f"Skipping RDS tasks because "
-                              f"envvar ASS_SKIP_RDS is set")
-        return True
 
-    def stop_rds(rds_type, main_key, identifier_key, arn_key, status_key):
-        rds_client = boto3.client('rds', region_name=aws.get_region())
+def get_stop_scheduler(cfg, aws):
+    """
+    Declare the stop phases as a dependency graph: stacks are deleted after the pre deletion tasks, RDS is stopped
+    after the stacks and BeanStalk environments that use it are gone. BeanStalk environments do not depend on the
+    pre deletion tasks and are terminated while those run.
+    """
+    scheduler = cfg.get_scheduler()
+    pre_deletion_tasks = add_pre_deletion_tasks(cfg, aws, scheduler)
+    scheduler.add_phase('delete_tagged_beanstalk_environments', lambda: delete_tagged_beanstalk_environments(cfg, aws))
+    scheduler.add_phase('delete_tagged_cloudformation_stacks', lambda: delete_tagged_cloudformation_stacks(cfg, aws),
+                        pre_deletion_tasks)
+    scheduler.add_phase('stop_tagged_rds_clusters_and_instances',
+                        lambda: stop_tagged_rds_clusters_and_instances(cfg, aws),
+                        ['delete_tagged_cloudformation_stacks', 'delete_tagged_beanstalk_environments'])
+    return scheduler
 
-        cfg.get_logger().info(f"Get list of all RDS {rds_type}s")
-        try:
-            if rds_type == 'instance':
-                response = rds_client.describe_db_instances()
-            elif rds_type == 'cluster':
-                response = rds_client.describe_db_clusters()
-            else:
-                raise Exception('rds_type should be one of instance or cluster')
-
-            for item in response[main_key]:
-                identifier = item[identifier_key]
-                arn = item[arn_key]
-                status = item[status_key]
-
-                if (aws.resource_has_tag(rds_client, arn, 'stop_or_start_with_cfn_stacks', 'yes') or
-                        aws.resource_has_tag(rds_client, arn, cfg.full_ass_tag('ass:rds:include'), 'yes')):
-                    cfg.get_logger().info(f"RDS {rds_type} {arn} is tagged with {cfg.full_ass_tag('ass:rds:include')} "
-                                          f"and tag value is yes")
-                    cfg.get_logger().info(f"Stopping RDS {rds_type} {arn}")
-                    if status != 'available':
-                        cfg.get_logger().info(f"RDS {rds_type} {identifier} is in state {status} "
-                                              f"( != available ): Skipping stop")
-                    elif rds_type == 'instance' and 'DBClusterIdentifier' in item:
-                        # Skip instances that are part of a RDS Cluster, they will be processed
-                        # in the DBCluster part, when rds_type is 'cluster'
-                        cfg.get_logger().info(f"RDS {rds_type} {item['DBInstanceIdentifier']} is part of RDS Cluster "
-                                              f"{item['DBClusterIdentifier']}: Skipping stop")
-                    else:
-                        if rds_type == 'instance':
-                            rds_client.stop_db_instance(DBInstanceIdentifier=identifier)
-                        elif rds_type == 'cluster':
-                            rds_client.stop_db_cluster(DBClusterIdentifier=identifier)
-                        else:
-                            raise Exception('rds_type should be on of instance or cluster')
-
-                        cfg.get_logger().info(f"Stopping RDS {rds_type} {arn} successfully triggered")
-                else:
-                    cfg.get_logger().info(f"RDS {rds_type} {arn} is not tagged with "
-                                          f"{cfg.full_ass_tag('ass:rds:include')}, or tag value is not yes")
-
-        except NoRegionError:
-            cfg.get_logger().error("No region provided!!!")
-            Notification.send_notification(
-                f"Account ID {aws.get_account_id()} aws-ass-stop:",
-                f"No region provided!!!"
-            )
-            raise
-        except NoCredentialsError:
-            cfg.get_logger().error("No credentials provided!!!")
-            Notification.send_notification(
-                f"Account ID {aws.get_account_id()} aws-ass-stop:",
-                f"No credentials provided!!!"
-            )
-            raise
 
-        cfg.get_logger().info(f"Finished getting list of all RDS {rds_type}s")
+def stop_tagged_rds_clusters_and_instances(cfg, aws):
+    if os.getenv('ASS_SKIP_RDS', '0') == '1':
+        cfg.get_logger().info("Skipping RDS tasks because "
+                              "envvar ASS_SKIP_RDS is set")
+        return True
+    if not cfg.is_selected('rds'):
+        return True
 
     cfg.get_logger().info("Stopping RDS clusters and instances tagged with ass:rds:include=yes")
-    stop_rds('instance', 'DBInstances', 'DBInstanceIdentifier', 'DBInstanceArn', 'DBInstanceStatus')
-    stop_rds('cluster', 'DBClusters', 'DBClusterIdentifier', 'DBClusterArn', 'Status')
+    try:
+        cfg.get_handler_engine(get_notifier(aws)).run(RdsHandler(cfg, aws, 'stop'))
+    except NoRegionError:
+        cfg.get_logger().error("No region provided!!!")
+        Notification.send_notification(
+            f"Account ID {aws.get_account_id()} aws-ass-stop:",
+            f"No region provided!!!"
+        )
+        raise
+    except NoCredentialsError:
+        cfg.get_logger().error("No credentials provided!!!")
+        Notification.send_notification(
+            f"Account ID {aws.get_account_id()} aws-ass-stop:",
+            f"No credentials provided!!!"
+        )
+        raise
+    aws.get_inventory().invalidate('rds_instances')
+    aws.get_inventory().invalidate('rds_clusters')
     cfg.get_logger().info("Finished stopping RDS clusters and instances tagged with ass:rds:include=yes")
 
-
 def delete_tagged_cloudformation_stacks(cfg, aws):
     if os.getenv('ASS_SKIP_CLOUDFORMATION', '0') == '1':
-        cfg.get_logger().info(f"Skipping CloudFormation template creation because "
-                              f"envvar ASS_SKIP_CLOUDFORMATION is set")
+        cfg.get_logger().info("Skipping CloudFormation template creation because "
+                              "envvar ASS_SKIP_CLOUDFORMATION is set")
+        return True
+    if not cfg.is_selected('cloudformation'):
         return True
 
-    cfg.get_logger().info(
-        f"Start deletion of CloudFormation stacks tagged with {cfg.full_ass_tag('ass:cfn:deletion-order')}"
-    )
-    client = boto3.client('cloudformation', region_name=aws.get_region())
+    cfg.get_logger().info("Start deletion of CloudFormation stacks tagged with %s",
+                          cfg.full_ass_tag('ass:cfn:deletion-order'))
+    client = aws.get_boto3_client('cloudformation')
 
     result = get_stack_names_and_deletion_order(cfg, aws, client)
-
-    for stack in sorted(result, key=lambda k: k['stack_deletion_order']):
-        delete_stack(cfg, client, stack, aws)
-        cfg.get_logger().info("Deletion of tagged CloudFormation stack %s ended successfully" % stack['stack_name'])
+    cfg.get_handler_engine(get_notifier(aws)).run(
+        StackHandler(cfg, aws, 'delete', result, lambda stack: delete_stack(cfg, client, stack, aws)))
 
     cfg.get_logger().info('Deletion of all tagged CloudFormation stacks ended successfully')
 
 
+def save_stack_template_to_state_bucket(cfg, aws, stack):
+    """
+    Store the processed template of the stack in the state bucket under its content hash and add the key and
+    size of the template to the stack information, so the start does not need the template of the deleted stack.
+    """
+    state_bucket_name = cfg.get_state_bucket_name(aws.get_region(), aws.get_account_id())
+    try:
+        cfg.get_logger().info("Saving template of stack %s to bucket %s", stack['stack_name'], state_bucket_name)
+        response = aws.get_boto3_client('cloudformation').get_template(
+            StackName=stack['stack_id'], TemplateStage='Processed'
+        )
+        stack['template_key'], stack['template_size'] = aws.store_template(state_bucket_name,
+                                                                           response['TemplateBody'])
+    except Exception:
+        cfg.get_logger().error("Error saving template of stack %s to bucket", stack['stack_name'])
+        Notification.send_notification(
+            f"Account ID {aws.get_account_id()} aws-ass-stop: ",
+            f"Error saving template of stack {stack['stack_name']} to bucket"
+        )
+        raise
+
+
 def save_stack_parameters_to_state_bucket(cfg, aws, stack):
     state_bucket_name = cfg.get_state_bucket_name(aws.get_region(), aws.get_account_id())
-    cfg.get_logger().info(f"Saving stack information for {stack['stack_name']} to bucket {state_bucket_name}")
+    cfg.get_logger().info("Saving stack information for %s to bucket %s", stack['stack_name'], state_bucket_name)
 
     try:
-        cfg.get_logger().info(f"Writing stack parameters to bucket")
-        boto3.resource('s3'). \
-            Bucket(state_bucket_name). \
-            put_object(Key=stack['stack_name'],
-                       Body=json.dumps(stack))
-        cfg.get_logger().info(f"Stack parameters successfully written to "
-                              f"s3://{state_bucket_name}/{stack['stack_name']}")
+        cfg.get_logger().info("Writing stack parameters to bucket")
+        aws.get_boto3_client('s3').put_object(Bucket=state_bucket_name, Key=stack['stack_name'],
+                                              Body=json.dumps(stack))
+        cfg.get_logger().info("Stack parameters successfully written to s3://%s/%s",
+                              state_bucket_name, stack['stack_name'])
     except Exception:
-        cfg.get_logger().error(f"Error saving beanstalk environment_deletion_order to bucket")
+        cfg.get_logger().error("Error saving beanstalk environment_deletion_order to bucket")
         Notification.send_notification(
             f"Account ID {aws.get_account_id()} aws-ass-stop: ",
             f"Error saving beanstalk environment_deletion_order to bucket"
@@ -489,86 +598,143 @@ def save_stack_parameters_to_state_bucket(cfg, aws, stack):
         raise
 
 
-def save_beanstalk_environment_deletion_order_to_state_bucket(cfg, aws, client, environment):
-    cfg.get_logger().info(
-        f"Looking for environment_deletion_order tag and saving in to bucket "
-        f"{cfg.get_state_bucket_name(aws.get_region(), aws.get_account_id())}"
-    )
-    for tag in client.list_tags_for_resource(ResourceArn=environment['environment_arn'])['ResourceTags']:
-        if tag['Key'] == 'environment_deletion_order':
-            try:
-                cfg.get_logger().info(f"Tag environment_deletion_order={tag['Value']} found")
-                boto3.resource('s3'). \
-                    Bucket(cfg.get_state_bucket_name(aws.get_region(), aws.get_account_id())). \
-                    put_object(Key=environment['environment_name'],
-                               Body=json.dumps(environment))
-                cfg.get_logger().info(
-                    f"Tag environment_deletion_order successfully written to "
-                    f"s3://{cfg.get_state_bucket_name(aws.get_region(), aws.get_account_id())}/{environment['environment_name']}"
-                )
-            except Exception:
-                cfg.get_logger().error(f"Error saving beanstalk environment_deletion_order to bucket")
-                Notification.send_notification(
-                    f"Account ID {aws.get_account_id()} aws-ass-stop:",
-                    f"Error saving beanstalk environment_deletion_order to bucket"
-                )
-                raise
-
-            break
-
-
 def delete_tagged_beanstalk_environments(cfg, aws):
     if os.getenv('ASS_SKIP_ELASTICBEANSTALK', '0') == '1':
-        cfg.get_logger().info(f"Skipping Elastic Beanstalk tasks because "
-                              f"envvar ASS_SKIP_ELASTICBEANSTALK is set")
+        cfg.get_logger().info("Skipping Elastic Beanstalk tasks because "
+                              "envvar ASS_SKIP_ELASTICBEANSTALK is set")
+        return True
+    if not cfg.is_selected('elasticbeanstalk'):
         return True
 
     cfg.get_logger().info("Start deletion of BeanStalk environments tagged with environment_deletion_order")
-    client = boto3.client('elasticbeanstalk', region_name=aws.get_region())
-
-    result = get_beanstalk_env_names_and_deletion_order(cfg, aws, client)
-
-    for environment in sorted(result, key=lambda k: k['environment_deletion_order']):
-        save_beanstalk_environment_deletion_order_to_state_bucket(cfg, aws, client, environment)
-        terminate_beanstalk_environment(cfg, aws, client, environment)
-        cfg.get_logger().info(
-            "Deletion of tagged BeanStalk environment %s ended successfully" % environment['environment_name'])
+    try:
+        cfg.get_handler_engine(get_notifier(aws)).run(BeanstalkHandler(cfg, aws, 'stop'))
+    except LevelFailed:
+        cfg.get_logger().error("Environment deletion has failed, check the logs.")
+        raise
+    except TimeBudgetExhausted:
+        raise
+    except Exception as e:
+        cfg.get_logger().error("Environment deletion has failed, check the logs.")
+        cfg.get_logger().error(e)
+        Notification.send_notification(
+            f"Account ID {aws.get_account_id()} aws-ass-stop:",
+            f"Environment deletion has failed: {e}"
+        )
+        raise
 
     cfg.get_logger().info('Deletion of all tagged BeanStalk environments ended successfully')
 
-
 def create_state_bucket(cfg, aws):
     state_bucket_name = cfg.get_state_bucket_name(aws.get_region(), aws.get_account_id())
     try:
-        cfg.get_logger().info("Create bucket %s if it does not already exist." % state_bucket_name)
-        s3 = boto3.resource('s3')
-        if s3.Bucket(state_bucket_name) in s3.buckets.all():
-            cfg.get_logger().info("Bucket %s already exists" % state_bucket_name)
+        cfg.get_logger().info("Create bucket %s if it does not already exist.", state_bucket_name)
+        s3 = aws.get_boto3_client('s3')
+        if aws.get_inventory().bucket_exists(state_bucket_name):
+            cfg.get_logger().info("Bucket %s already exists", state_bucket_name)
         else:
-            cfg.get_logger().info("Start creation of bucket %s" % state_bucket_name)
+            cfg.get_logger().info("Start creation of bucket %s", state_bucket_name)
             s3.create_bucket(Bucket=state_bucket_name,
                              CreateBucketConfiguration={'LocationConstraint': aws.get_region()})
-            cfg.get_logger().info("Finished creation of bucket %s" % state_bucket_name)
+            aws.get_inventory().add_bucket(state_bucket_name)
+            cfg.get_logger().info("Finished creation of bucket %s", state_bucket_name)
     except Exception:
         raise
 
 
-def main():
+def get_discovery_sections(cfg):
+    sections = ['s3']
+    if os.getenv('ASS_SKIP_PREDELETIONTASKS', '0') != '1':
+        sections.extend(['elbv2', 'cloudfront'])
+    if os.getenv('ASS_SKIP_CLOUDFORMATION', '0') != '1':
+        sections.append('cloudformation')
+    if os.getenv('ASS_SKIP_ELASTICBEANSTALK', '0') != '1':
+        sections.append('elasticbeanstalk')
+    if os.getenv('ASS_SKIP_RDS', '0') != '1':
+        sections.extend(['rds_instances', 'rds_clusters'])
+    return [section for section in sections if cfg.get_selector().allows_section(section)]
+
+
+def check_predicted_duration(cfg, aws, scheduler):
+    """
+    Log the run time predicted from the run history, and send a notification when it exceeds ASS_RUN_WINDOW.
+    """
+    predicted = scheduler.predict_duration()
+    cfg.get_logger().info("Predicted run time is %.0f seconds", predicted)
+    window = cfg.get_run_window()
+    if window is not None and predicted > window:
+        cfg.get_logger().warning("Predicted run time of %.0f seconds exceeds the window of %s seconds",
+                                 predicted, window)
+        Notification.send_notification(
+            f"Account ID {aws.get_account_id()} aws-ass-stop:",
+            f"Predicted run time of {predicted:.0f} seconds exceeds the window of {window} seconds"
+        )
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description='Stop the tagged resources of an AWS account')
+    parser.add_argument('--time-budget', type=int, default=None,
+                        help='Seconds the run may take, the run stops starting new work when the remaining time is '
+                             'less than the work needed before and exits with ASS_CONTINUE_EXIT_CODE (default 75)')
+    parser.add_argument('--select', action='append', default=None, metavar='EXPRESSION',
+                        help='Only stop the selected resources: stack=<name prefix>, tag=<key>[=<value>], '
+                             'type=cloudformation|s3|rds|elasticbeanstalk or order=<min>[-<max>], can be repeated')
+    parser.add_argument('--force', action='store_true',
+                        help='Stop the resources, also when the last run was a completed stop and the stacks did not '
+                             'change since')
+    parser.add_argument('--plan', action='store_true',
+                        help='Show the phases that would run, with the durations of the previous runs, and exit '
+                             'without changing anything')
+    return parser.parse_args(argv)
+
+
+def main(argv=None, aws=None):
+    """
+    Run the script with the command line arguments argv. The daemon passes its warm AWS object.
+    """
+    arguments = parse_arguments(argv)
     try:
         cfg = Config("aws-ass-stop")
-        aws = AWS(cfg.get_logger())
+        aws = aws or AWS(cfg.get_logger())
         cloudformation_s3 = cfg.get_state_bucket_name(aws.get_region(), aws.get_account_id())
 
-        cfg.get_logger().info("Region:       %s" % aws.get_region())
-        cfg.get_logger().info("AccountId:    %s" % aws.get_account_id())
-        cfg.get_logger().info("State Bucket: %s" % cfg.get_state_bucket_name(aws.get_region(), aws.get_account_id()))
+        cfg.get_logger().info("Region:       %s", aws.get_region())
+        cfg.get_logger().info("AccountId:    %s", aws.get_account_id())
+        cfg.get_logger().info("State Bucket: %s", cfg.get_state_bucket_name(aws.get_region(), aws.get_account_id()))
+
+        cfg.init_selector(arguments.select)
+        run_marker = cfg.get_run_marker(aws, cloudformation_s3)
+        if not arguments.force and cfg.get_selector().is_empty() and run_marker.is_repeat('stop'):
+            cfg.get_logger().info("Nothing to stop, use --force to stop again")
+            logging.shutdown()
+            return
+        aws.get_inventory().set_selector(cfg.get_selector())
+        aws.get_inventory().discover(get_discovery_sections(cfg), operation='stop')
+
+        cfg.init_run_state(aws.get_boto3_client('s3'), cloudformation_s3, 'aws-ass-stop', arguments.time_budget)
+        scheduler = get_stop_scheduler(cfg, aws)
+        if arguments.plan:
+            scheduler.log_plan()
+            logging.shutdown()
+            return
 
         # Cloudformation stop
         aws.create_bucket(cloudformation_s3)
-        do_pre_deletion_tasks(cfg, aws)
-        delete_tagged_cloudformation_stacks(cfg, aws)
-        delete_tagged_beanstalk_environments(cfg, aws)
-        stop_tagged_rds_clusters_and_instances(cfg, aws)
+        run_marker.begin('stop', None if cfg.get_selector().is_empty() else str(cfg.get_selector()))
+        check_predicted_duration(cfg, aws, scheduler)
+        try:
+            scheduler.run()
+        except TimeBudgetExhausted as e:
+            cfg.get_logger().warning("%s, start aws-ass-stop again to continue", e)
+            cfg.save_run_state()
+            logging.shutdown()
+            sys.exit(cfg.get_time_budget().exit_code)
+        except Exception:
+            cfg.save_run_state()
+            raise
+        cfg.save_run_state(completed=True)
+        if cfg.get_selector().is_empty():
+            run_marker.complete('stop')
 
         logging.shutdown()
     except Exception:
@@ -576,4 +742,5 @@ def main():
         raise
 
 
-main()
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+import logging
+import os
+import time
+from ASS import Config
+from ASS import AWS
+
+
+def main():
+    """
+    Help the stop and start runs with ASS_WORK_QUEUE=1: do the units of the open work queues in the state bucket
+    until no unit was claimed for ASS_WORKER_IDLE_TIMEOUT seconds. A queue that stays open without units to claim
+    (its run was lost) does not keep the worker running.
+    """
+    cfg = Config("aws-ass-worker")
+    aws = AWS(cfg.get_logger())
+    state_bucket_name = cfg.get_state_bucket_name(aws.get_region(), aws.get_account_id())
+    idle_timeout = int(os.getenv('ASS_WORKER_IDLE_TIMEOUT', '600'))
+    poll_interval = int(os.getenv('ASS_WORK_QUEUE_POLL_INTERVAL', '10'))
+
+    cfg.get_logger().info("Region:       %s", aws.get_region())
+    cfg.get_logger().info("AccountId:    %s", aws.get_account_id())
+    cfg.get_logger().info("State Bucket: %s", state_bucket_name)
+
+    try:
+        last_work = time.time()
+        while time.time() - last_work < idle_timeout:
+            claimed = 0
+            for queue in aws.get_open_work_queues(state_bucket_name):
+                cfg.get_logger().debug("Looking for work in queue %s", queue.name)
+                claimed += queue.drain(aws.get_work_handlers(), wait=False)
+            if claimed > 0:
+                last_work = time.time()
+            time.sleep(poll_interval)
+        cfg.get_logger().info("No work for %s seconds, stopping", idle_timeout)
+    finally:
+        logging.shutdown()
+
+
+if __name__ == '__main__':
+    main()
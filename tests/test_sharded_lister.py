@@ -0,0 +1,131 @@
+import logging
+import threading
+import unittest
+from ASS.ShardedLister import ShardedLister
+
+
+class FakeS3:
+    """
+    In-memory S3 client with the listings of ShardedLister, page_size keys and common prefixes per page.
+    """
+
+    def __init__(self, keys, page_size=2):
+        self.keys = sorted(keys)
+        self.page_size = page_size
+        self.pages = []
+
+    def get_paginator(self, operation):
+        return FakePaginator(self, operation)
+
+
+class FakePaginator:
+    def __init__(self, client, operation):
+        self.client = client
+        self.operation = operation
+
+    def paginate(self, Bucket, Prefix='', Delimiter=None, StartAfter=None, KeyMarker=None):
+        marker = StartAfter if self.operation == 'list_objects_v2' else KeyMarker
+        entries = []
+        for key in self.client.keys:
+            if not key.startswith(Prefix) or (marker is not None and key <= marker):
+                continue
+            rest = key[len(Prefix):]
+            if Delimiter is not None and Delimiter in rest:
+                common_prefix = Prefix + rest[:rest.index(Delimiter) + 1]
+                if ('prefix', common_prefix) not in entries:
+                    entries.append(('prefix', common_prefix))
+            else:
+                entries.append(('key', key))
+
+        for start in range(0, max(len(entries), 1), self.client.page_size):
+            entries_of_page = entries[start:start + self.client.page_size]
+            items = [{'Key': key, 'Size': 1, 'VersionId': 'v1'} for kind, key in entries_of_page if kind == 'key']
+            page = {'CommonPrefixes': [{'Prefix': key} for kind, key in entries_of_page if kind == 'prefix'],
+                    'IsTruncated': start + self.client.page_size < len(entries)}
+            page['Contents' if self.operation == 'list_objects_v2' else 'Versions'] = items
+            self.client.pages.append((self.operation, Prefix, Delimiter, marker))
+            yield page
+
+
+class ShardedListerTest(unittest.TestCase):
+    def lister(self, keys, page_size=2):
+        self.client = FakeS3(keys, page_size)
+        return ShardedLister(logging.getLogger('test'), self.client, list_workers=4)
+
+    def keys_of_shards(self, lister, shards, versions=False):
+        return [item['Key'] for prefix, lower, upper in shards
+                for item in lister.list_shard('bucket', prefix, lower, upper, versions)]
+
+    def test_list_shard_range(self):
+        lister = self.lister(['a', 'b', 'b1', 'c', 'd', 'd1', 'e'])
+        self.assertEqual([item['Key'] for item in lister.list_shard('bucket', '', 'b', 'd')], ['b1', 'c', 'd'])
+        self.assertEqual([item['Key'] for item in lister.list_shard('bucket', '', None, 'b')], ['a', 'b'])
+        self.assertEqual([item['Key'] for item in lister.list_shard('bucket', '', 'd', None)], ['d1', 'e'])
+        self.assertIn(('list_objects_v2', '', None, 'b'), self.client.pages)
+
+    def test_list_shard_versions_use_key_marker(self):
+        lister = self.lister(['a', 'b', 'c'])
+        self.assertEqual([item['Key'] for item in lister.list_shard('bucket', '', 'a', None, versions=True)],
+                         ['b', 'c'])
+        self.assertEqual(self.client.pages[0], ('list_object_versions', '', None, 'a'))
+
+    def test_list_shard_stops_at_the_page_past_upper(self):
+        lister = self.lister([f"k{number:02d}" for number in range(20)], page_size=3)
+        self.assertEqual([item['Key'] for item in lister.list_shard('bucket', '', None, 'k04')],
+                         ['k00', 'k01', 'k02', 'k03', 'k04'])
+        # k03-k05 is the first page with a key past k04, the pages after it are not listed
+        self.assertEqual(len(self.client.pages), 2)
+
+    def test_flat_bucket_is_split_on_ranges(self):
+        keys = ['0', '1x', '9', 'A', 'Zz', 'a', 'm', 'z', 'zz', '~tilde']
+        lister = self.lister(keys)
+        put = []
+        shards = lister.get_shards('bucket', '', False, put.append)
+        self.assertEqual(len(shards), len(ShardedLister.RANGE_BOUNDARIES) + 1)
+        self.assertEqual(put, [])
+        # Every key is in exactly one shard, also the keys on a boundary and past the last boundary
+        self.assertEqual(sorted(self.keys_of_shards(lister, shards)), sorted(keys))
+
+    def test_few_prefixes_are_split_recursively(self):
+        keys = ['top', 'a/1', 'a/2', 'b/x/1', 'b/y/1', 'b/y/2', 'b/z', 'b/w/1', 'b/v/1']
+        lister = self.lister(keys, page_size=100)
+        put = []
+        shards = lister.get_shards('bucket', '', False, put.append)
+        # a/ holds no prefixes, its keys are put while looking for them
+        self.assertEqual([item['Key'] for item in put], ['top', 'a/1', 'a/2', 'b/z'])
+        self.assertEqual(sorted(prefix for prefix, lower, upper in shards), ['b/v/', 'b/w/', 'b/x/', 'b/y/'])
+        self.assertEqual(sorted(self.keys_of_shards(lister, shards) + [item['Key'] for item in put]), sorted(keys))
+
+    def test_many_prefixes_are_not_split(self):
+        keys = [f"{prefix}/key" for prefix in 'abcdef']
+        lister = self.lister(keys, page_size=100)
+        shards = lister.get_shards('bucket', '', False, lambda item: None)
+        self.assertEqual(shards, [(f"{prefix}/", None, None) for prefix in 'abcdef'])
+
+    def test_list_returns_every_key_once(self):
+        keys = [f"{prefix}/{number}" for prefix in 'ab' for number in range(10)]
+        keys += [f"flat{number}" for number in range(50)]
+        lister = self.lister(keys, page_size=5)
+        self.assertEqual(sorted(item['Key'] for item in lister.list('bucket')), sorted(keys))
+
+    def test_for_each_stops_the_listing_when_a_call_raises(self):
+        lister = ShardedLister(logging.getLogger('test'), FakeS3([f"k{number:04d}" for number in range(2000)]),
+                               queue_size=10)
+
+        def fail(item):
+            raise ValueError(item['Key'])
+
+        # Kept referenced, so the generator is not closed by the garbage collector
+        items = lister.list('bucket')
+        with self.assertRaises(ValueError):
+            ShardedLister.for_each(items, fail, 2)
+        self.assertFalse(any(thread.name == 'list-bucket' for thread in threading.enumerate()))
+
+    def test_for_each_batch(self):
+        batches = []
+        ShardedLister.for_each_batch(iter(range(25)), batches.append, 2, batch_size=10)
+        self.assertEqual(sorted(len(batch) for batch in batches), [5, 10, 10])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+import io
+import json
+import logging
+import unittest
+from botocore.exceptions import ClientError
+from ASS.WorkQueue import WorkQueue
+
+
+class FakeS3:
+    """
+    In-memory S3 client with the calls of WorkQueue, put_object honours IfMatch like S3 conditional writes.
+    """
+
+    def __init__(self):
+        self.objects = dict()
+        self.version = 0
+
+    @staticmethod
+    def _error(code, status):
+        return ClientError({'Error': {'Code': code, 'Message': code},
+                            'ResponseMetadata': {'HTTPStatusCode': status}}, 'operation')
+
+    def put_object(self, Bucket, Key, Body, IfMatch=None, **kwargs):
+        if IfMatch is not None and (Key not in self.objects or self.objects[Key][1] != IfMatch):
+            raise self._error('PreconditionFailed', 412)
+        self.version += 1
+        etag = f'"{self.version}"'
+        self.objects[Key] = (Body.encode('utf-8'), etag)
+        return {'ETag': etag}
+
+    def get_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise self._error('NoSuchKey', 404)
+        body, etag = self.objects[Key]
+        return {'Body': io.BytesIO(body), 'ETag': etag}
+
+    def delete_objects(self, Bucket, Delete):
+        for item in Delete['Objects']:
+            self.objects.pop(item['Key'], None)
+
+    def get_paginator(self, operation):
+        return self
+
+    def paginate(self, Bucket, Prefix, Delimiter=None):
+        return [{'Contents': [{'Key': key} for key in sorted(self.objects) if key.startswith(Prefix)]}]
+
+    def get_document(self, key):
+        return json.loads(self.objects[key][0])
+
+
+class WorkQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.client = FakeS3()
+        self.logger = logging.getLogger('test')
+
+    def queue(self, **kwargs):
+        return WorkQueue(self.logger, self.client, 'state', 'test', poll_interval=0, **kwargs)
+
+    def unit(self, unit_id='u1'):
+        return self.client.get_document(f"work-queue/test/units/{unit_id}.json")
+
+    def generation(self):
+        return self.client.get_document('work-queue/test/queue.json')['generation']
+
+    def test_losing_a_claim_race(self):
+        planner, other = self.queue(), self.queue()
+        planner.plan([('u1', {'kind': 'copy'})])
+        get_object = self.client.get_object
+
+        def get_object_then_claim(**kwargs):
+            # The other process claims the unit between the read and the conditional write
+            response = get_object(**kwargs)
+            self.client.get_object = get_object
+            self.assertIsNotNone(other.claim('u1'))
+            return response
+
+        self.client.get_object = get_object_then_claim
+        self.assertIsNone(planner.claim('u1'))
+        self.assertEqual(self.unit()['owner'], other.owner)
+        self.assertEqual(self.unit()['attempts'], 1)
+
+    def test_expired_lease_is_taken_over(self):
+        lost, other = self.queue(lease_seconds=-1), self.queue()
+        lost.plan([('u1', {'kind': 'copy'})])
+        lost_lease = lost.claim('u1')
+        lease = other.claim('u1')
+        self.assertIsNotNone(lease)
+        self.assertEqual(self.unit()['owner'], other.owner)
+        self.assertEqual(self.unit()['attempts'], 2)
+
+        # The process that lost the lease can neither renew it nor mark the unit
+        lost.renew(lost_lease)
+        self.assertTrue(lost_lease.lost)
+        lost._finish(lost_lease, 'done')
+        self.assertEqual(self.unit()['status'], 'leased')
+        other._finish(lease, 'done')
+        self.assertEqual(self.unit()['status'], 'done')
+        self.assertIn(f"work-queue/test/done/{self.generation()}/u1", self.client.objects)
+
+    def test_unit_fails_after_max_attempts(self):
+        queue = self.queue(lease_seconds=-1, max_attempts=2)
+        queue.plan([('u1', {'kind': 'copy'})])
+        self.assertIsNotNone(queue.claim('u1'))
+        self.assertIsNotNone(queue.claim('u1'))
+        self.assertIsNone(queue.claim('u1'))
+        self.assertEqual(self.unit()['status'], 'failed')
+        self.assertIn(f"work-queue/test/failed/{self.generation()}/u1", self.client.objects)
+
+    def test_failed_attempts_count_towards_max_attempts(self):
+        queue = self.queue(max_attempts=2)
+        queue.plan([('u1', {'kind': 'copy'})])
+
+        def fail(payload):
+            raise Exception('copy failed')
+
+        with self.assertRaises(Exception):
+            queue.drain({'copy': fail})
+        self.assertEqual(self.unit()['status'], 'failed')
+        self.assertEqual(self.unit()['attempts'], 2)
+
+    def test_stale_generation_does_not_mark_a_newer_plan(self):
+        stale, planner = self.queue(), self.queue()
+        planner.plan([('u1', {'kind': 'copy'})])
+        old_generation = self.generation()
+        stale_lease = stale.claim('u1', old_generation)
+        planner.plan([('u1', {'kind': 'copy'})])
+        new_generation = self.generation()
+
+        self.assertIsNone(stale.claim('u1', old_generation))
+        stale._finish(stale_lease, 'done')
+        self.assertTrue(stale_lease.lost)
+        self.assertEqual(self.unit()['status'], 'pending')
+        self.assertEqual(self.unit()['generation'], new_generation)
+        self.assertNotIn(f"work-queue/test/done/{new_generation}/u1", self.client.objects)
+        self.assertNotIn(f"work-queue/test/done/{old_generation}/u1", self.client.objects)
+
+    def test_drain_does_all_units(self):
+        queue = self.queue()
+        queue.plan([(f"u{number}", {'kind': 'copy', 'number': number}) for number in range(5)])
+        done = []
+        self.assertEqual(queue.drain({'copy': lambda payload: done.append(payload['number'])}), 5)
+        self.assertEqual(sorted(done), list(range(5)))
+
+
+if __name__ == '__main__':
+    unittest.main()